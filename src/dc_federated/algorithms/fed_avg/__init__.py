@@ -1,3 +1,4 @@
 from .fed_avg_server import FedAvgServer
 from .fed_avg_worker import FedAvgWorker
 from .fed_avg_model_trainer import FedAvgModelTrainer
+from .fed_avg_edge_server import FedAvgEdgeServer
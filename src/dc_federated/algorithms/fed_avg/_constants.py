@@ -0,0 +1,12 @@
+"""
+Some constants to be used by the FedAvg classes.
+"""
+
+UPDATE_SIZE_KEY = 'update_size'
+UPDATE_MODEL_VERSION_KEY = 'update_model_version'
+SPARSE_UPDATE_KEY = 'sparse_update'
+SPARSE_INDICES_KEY = 'indices'
+SPARSE_VALUES_KEY = 'values'
+QUANTIZATION_KEY = 'quantization'
+QUANTIZED_DELTA_KEY = 'quantized_delta'
+FLOAT16_FORMAT = 'float16'
@@ -0,0 +1,254 @@
+"""
+Contains the implementation of an edge aggregator for the FedAvg algorithm,
+sitting between a group of FedAvg workers and the root FedAvgServer.
+"""
+
+from datetime import datetime
+
+import gevent
+
+from dc_federated.utils import get_host_ip
+from dc_federated.backend import DCFWorker, GLOBAL_MODEL, GLOBAL_MODEL_VERSION, WID_LEN, is_valid_model_dict
+from dc_federated.algorithms.fed_avg.fed_avg_server import FedAvgServer
+from dc_federated.algorithms.fed_avg._constants import UPDATE_SIZE_KEY, UPDATE_MODEL_VERSION_KEY, \
+    SPARSE_UPDATE_KEY
+from dc_federated.algorithms.tensor_container import serialize_state_dict, deserialize_state_dict
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=logging.INFO)
+
+
+class FedAvgEdgeServer(FedAvgServer):
+    """
+    An edge aggregator for the FedAvg algorithm. Towards its own workers it
+    is a FedAvgServer serving the global model of the root FedAvgServer.
+    Towards the root server it is a single worker: once update_lim updates
+    have been received from its workers, it uploads their weighted average
+    along with the total size of their training sets. The root server adds
+    the average weighted by that size to its running weighted sum, which is
+    the same as adding the updates of the workers one by one, so the root
+    server receives one upload per edge instead of one per worker. The
+    upload is labelled with the oldest root version the updates in it were
+    trained from, and the updates received so far are uploaded as soon as
+    a new root version arrives, so that the root server's staleness and
+    version checks see the upload as stale as its stalest update.
+
+    Parameters
+    ----------
+
+    global_model_trainer: FedAvgModelTrainer
+        The trainer for the model - only used for its model, which is
+        replaced by the global model of the root server.
+
+    key_list_file: str
+        The list of public keys of the workers of this edge server. No
+        authentication is performed if file not given.
+
+    root_private_key_file: str
+        Name of the private key file to authenticate the edge server to the
+        root server, whose key list must contain the corresponding public key.
+        No authentication is performed if None is passed.
+
+    root_server_protocol: str (default None)
+        The protocol of the root server, 'http' if None.
+
+    root_server_host_ip: str (default None)
+        The ip-address of the host of the root server, the machine IP if None.
+
+    root_server_port: int (default 8080)
+        The port of the root server.
+
+    update_lim: int (default 10)
+        Number of unique worker updates to aggregate before uploading them to
+        the root server.
+
+    root_update_codec: str (default 'zlib+shuffle')
+        The codec to compress the updates sent to the root server with.
+
+    root_model_codec: str (default 'zlib+shuffle')
+        The codec to ask the root server to compress the global model with.
+
+    **kwargs:
+        The other arguments of the FedAvgServer, e.g. server_port, for the
+        server the workers connect to. The asynchronous mode and rounds are
+        run by the root server, so async_buffer_size, round_sample_size and
+        round_deadline are not accepted.
+    """
+
+    def __init__(self,
+                 global_model_trainer,
+                 key_list_file,
+                 root_private_key_file,
+                 root_server_protocol=None,
+                 root_server_host_ip=None,
+                 root_server_port=8080,
+                 update_lim=10,
+                 root_update_codec='zlib+shuffle',
+                 root_model_codec='zlib+shuffle',
+                 **kwargs):
+        unsupported_args = [arg for arg in ['async_buffer_size', 'round_sample_size', 'round_deadline']
+                            if kwargs.get(arg) is not None]
+        if unsupported_args:
+            raise ValueError(f"An edge server cannot be given {', '.join(unsupported_args)} - the asynchronous "
+                             f"mode and rounds are run by the root server.")
+        super().__init__(global_model_trainer, key_list_file, update_lim=update_lim, **kwargs)
+
+        # the version of the last global model received from the root
+        # server, None until the first one is received.
+        self.root_model_version = None
+        # the oldest root version the updates in the running weighted sum
+        # were trained from, None if the sum is empty.
+        self.agg_base_version = None
+        self.root_worker = DCFWorker(
+            server_protocol='http' if root_server_protocol is None else root_server_protocol,
+            server_host_ip=get_host_ip() if not root_server_host_ip else root_server_host_ip,
+            server_port=root_server_port,
+            global_model_version_changed_callback=self.root_global_model_version_changed,
+            get_worker_version_of_global_model=lambda: self.root_model_version,
+            private_key_file=root_private_key_file,
+            long_poll_returns_model=True,
+            update_codec=root_update_codec,
+            model_codec=root_model_codec
+        )
+
+    def load_root_global_model(self, model_dict):
+        """
+        Loads the global model received from the root server as the global
+        model of this server, with the version of the root server, so that
+        the versions in the update metadata of the workers are root versions.
+
+        Parameters
+        ----------
+
+        model_dict: dict
+            The model dictionary returned by the root server.
+        """
+        state_dict, _ = deserialize_state_dict(model_dict[GLOBAL_MODEL])
+        self.global_model_trainer.load_model_from_state_dict(state_dict)
+        self.root_model_version = model_dict[GLOBAL_MODEL_VERSION]
+        self.model_version = self.root_model_version
+        self.record_global_model()
+
+    def root_global_model_version_changed(self, model_dict):
+        """
+        Callback for when the root server has a new global model: uploads the
+        worker updates aggregated so far, which were trained from earlier
+        root versions, loads the new model, in the aggregation thread if
+        aggregating in the background so that it does not change the model
+        history under an update being aggregated, and notifies the workers.
+
+        Parameters
+        ----------
+
+        model_dict: dict
+            The model dictionary returned by the root server.
+        """
+        if self.unique_updates_since_last_agg > 0:
+            self.upload_partial_update()
+        self.run_in_background(self.load_root_global_model, model_dict)
+        logger.info(f"Received global model version {self.model_version} from the root server.")
+        self.server.global_model_version_changed()
+
+    def record_base_version(self, base_version):
+        """
+        Records the root version an update added to the running weighted sum
+        was trained from, keeping the oldest one.
+
+        Parameters
+        ----------
+
+        base_version: int
+            The version of the global model the update was trained from, or
+            None if the update did not say, in which case the current
+            version is assumed.
+        """
+        if base_version is None:
+            base_version = self.model_version
+        if self.agg_base_version is None or base_version < self.agg_base_version:
+            self.agg_base_version = base_version
+
+    def add_to_agg_model(self, state_dict, update_size, quantization=None, base_version=None,
+                         quantized_delta=False):
+        self.record_base_version(base_version)
+        super().add_to_agg_model(state_dict, update_size, quantization, base_version, quantized_delta)
+
+    def add_sparse_to_agg_model(self, indices, values, base_version, update_size):
+        self.record_base_version(base_version)
+        super().add_sparse_to_agg_model(indices, values, base_version, update_size)
+
+    def serialize_partial_update(self):
+        """
+        Serializes the weighted average of the worker updates aggregated so
+        far, with the total size of their training sets as the update size
+        and the oldest root version they were trained from as its version,
+        and resets the running weighted sum.
+
+        Returns
+        -------
+
+        bytearray, int, int:
+            The serialized update, in the format of
+            FedAvgWorker.serialize_model(), its update size and its version.
+        """
+        update_size, base_version = self.agg_update_size, self.agg_base_version
+        self.agg_params.div_(update_size)
+        model_update = serialize_state_dict(
+            self.param_layout.unflatten(self.agg_params),
+            {UPDATE_SIZE_KEY: update_size, UPDATE_MODEL_VERSION_KEY: base_version})
+        self.agg_params.zero_()
+        self.agg_update_size = 0
+        self.agg_base_version = None
+        return model_update, update_size, base_version
+
+    def upload_partial_update(self):
+        """
+        Uploads the worker updates aggregated since the last upload to the
+        root server, as a single worker update.
+        """
+        num_updates = self.unique_updates_since_last_agg
+        self.unique_updates_since_last_agg = 0
+        model_update, update_size, base_version = self.run_in_background(self.serialize_partial_update)
+        self.last_global_model_update_timestamp = datetime.now()
+        self.iteration += 1
+
+        response = self.root_worker.send_model_update(
+            model_update,
+            {UPDATE_MODEL_VERSION_KEY: base_version,
+             UPDATE_SIZE_KEY: update_size,
+             SPARSE_UPDATE_KEY: False})
+        logger.info(f"Sent {num_updates} aggregated worker updates of total size {update_size}, trained "
+                    f"from root version {base_version} onwards, to the root server: {response}")
+
+    def agg_model(self):
+        """
+        Uploads the aggregated worker updates to the root server, as a single
+        worker update, once the number of unique updates received since the
+        last upload is above the threshold. The global model of this server
+        only changes when the root server sends a new one.
+
+        Returns
+        -------
+
+        bool:
+            False, as the global model is not updated.
+        """
+        if self.unique_updates_since_last_agg >= self.update_lim:
+            self.upload_partial_update()
+        return False
+
+    def start(self):
+        """
+        Registers with the root server and gets its global model, before
+        starting to follow its global model versions and to serve the workers.
+        """
+        self.root_worker.register_worker()
+        logger.info(f"Registered with the root server with worker id {self.root_worker.worker_id[0:WID_LEN]}")
+        model_dict = self.root_worker.get_global_model()
+        if not is_valid_model_dict(model_dict):
+            raise ValueError("Invalid global model received from the root server.")
+        self.root_global_model_version_changed(model_dict)
+
+        gevent.spawn(self.root_worker.run)
+        self.server.start_server()
@@ -60,7 +60,10 @@ class FedAvgModelTrainer(object):
         ----------
 
         state_dict: dict
-            The state dictionary to load the model from.
+            The state dictionary to load the model from. The tensors in it
+            may be reused by the caller afterwards, so they should be copied
+            into the model (as nn.Module.load_state_dict does) rather than
+            referenced.
         """
         pass
 
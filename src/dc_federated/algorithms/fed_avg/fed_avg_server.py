@@ -2,17 +2,26 @@
 Contains the implementation of the server side logic for the FedAvg algorithm.
 """
 
-import msgpack
-import io
+import random
 from datetime import datetime
 from collections import OrderedDict
 
+import gevent
+from gevent.queue import JoinableQueue
+from gevent.threadpool import ThreadPool
+
 import torch
 from dc_federated.backend import DCFServer, \
-    GLOBAL_MODEL_VERSION, GLOBAL_MODEL
+    GLOBAL_MODEL_VERSION, GLOBAL_MODEL, GLOBAL_MODEL_BASE_VERSION
 
 from dc_federated.backend._constants import *
 from dc_federated.algorithms.fed_avg.fed_avg_model_trainer import FedAvgModelTrainer
+from dc_federated.algorithms.fed_avg._constants import UPDATE_SIZE_KEY, UPDATE_MODEL_VERSION_KEY, \
+    SPARSE_UPDATE_KEY, SPARSE_INDICES_KEY, SPARSE_VALUES_KEY, QUANTIZATION_KEY, QUANTIZED_DELTA_KEY, \
+    FLOAT16_FORMAT
+from dc_federated.algorithms.param_vector import ParamLayout
+from dc_federated.algorithms.quantization import dequantize_int8_, cast_state_dict
+from dc_federated.algorithms.tensor_container import serialize_state_dict, deserialize_state_dict
 
 import logging
 
@@ -20,6 +29,30 @@ logger = logging.getLogger(__name__)
 logger.setLevel(level=logging.INFO)
 
 
+def polynomial_staleness_weight(staleness, exponent=0.5):
+    """
+    The default weight of an update in the asynchronous mode of the
+    FedAvgServer, given its staleness: (1 + staleness) ** -exponent.
+
+    Parameters
+    ----------
+
+    staleness: int
+        The number of global model versions published since the global model
+        the update was trained from.
+
+    exponent: float (default 0.5)
+        How fast the weight decreases with the staleness.
+
+    Returns
+    -------
+
+    float:
+        The weight, 1 for an update trained from the current global model.
+    """
+    return (1 + staleness) ** -exponent
+
+
 class FedAvgServer(object):
     """
     This class implements the server-side of the FedAvg algorithm using the
@@ -56,6 +89,71 @@ class FedAvgServer(object):
     ssl_certfile: str
         Must be a valid path to the certificate.
         This is mandatory if ssl_enabled is True, ignored otherwise.
+
+    model_history_size: int (default 3)
+        The number of most recent global model versions to keep, so that
+        workers holding one of them can be sent the difference to the current
+        global model instead of the whole model, and sparse updates trained
+        from one of them can be aggregated, as can int8 updates quantized as
+        the difference from one of them. 0 disables this.
+
+    model_delta_dtype: torch.dtype (default None)
+        If given, the floating point tensors in the difference between global
+        model versions are sent in this type (e.g. torch.float16). The
+        differences are then lossy, so the copy of the global model that
+        the workers apply them to drifts from the server's - the workers
+        ask for the whole model again every global_model_resync_interval
+        such differences. Full precision differences are exact.
+
+    aggregate_in_background: bool (default True)
+        Whether to deserialize and aggregate the worker updates, and test the
+        global model, in a background thread fed by a queue. If True, worker
+        updates are acknowledged as soon as they are queued, and the request
+        handlers are not blocked by the aggregation.
+
+    max_update_staleness: int (default None)
+        If given, worker updates trained from a global model more than this
+        many versions older than the current one are rejected before they
+        are decompressed. 0 only accepts updates trained from the current
+        global model. Stale updates are accepted if None.
+
+    async_buffer_size: int (default None)
+        If given, the server runs asynchronously: instead of waiting for
+        update_lim unique updates, it adds the difference between each update
+        and the global model it was trained from to a buffer, weighted by the
+        update size times staleness_weight, and publishes a new global model
+        - the current one plus the buffered differences divided by the total
+        update size - every async_buffer_size updates. The updates must be
+        trained from a global model still in the model history. update_lim
+        is ignored.
+
+    async_publish_interval: float (default None)
+        In the asynchronous mode, if given, a new global model is also
+        published once this many seconds have passed since the last one, if
+        any update is buffered.
+
+    staleness_weight: int -> float (default polynomial_staleness_weight)
+        In the asynchronous mode, the weight of an update given the number of
+        global model versions published since the one it was trained from.
+
+    round_sample_size: int (default None)
+        If given, the server runs explicit rounds of training: at the start of
+        each round it samples this many of the registered workers - more than
+        update_lim, to allow for the ones that drop out - and only sends the
+        new global model to them. The round closes, and the next global
+        model is published, when the first update_lim updates have arrived
+        or round_deadline seconds after it started, whichever is first. The
+        updates of the workers that were not sampled, or that arrive after
+        their round has closed, are rejected before they are decompressed.
+        The workers that register while the current round has fewer than
+        round_sample_size workers - e.g. during the first round, which
+        starts before any worker has registered - join it.
+
+    round_deadline: float (default None)
+        The maximum duration in seconds of a round, which must be given
+        along with round_sample_size. A round in which no update arrived
+        is restarted with newly sampled workers and the same global model,
+        as a new version.
     """
 
     def __init__(self,
@@ -66,13 +164,50 @@ class FedAvgServer(object):
                  server_port=8080,
                  ssl_enabled=False,
                  ssl_keyfile=None,
-                 ssl_certfile=None):
+                 ssl_certfile=None,
+                 model_history_size=3,
+                 model_delta_dtype=None,
+                 aggregate_in_background=True,
+                 max_update_staleness=None,
+                 async_buffer_size=None,
+                 async_publish_interval=None,
+                 staleness_weight=polynomial_staleness_weight,
+                 round_sample_size=None,
+                 round_deadline=None):
         logger.info(
             f"Initializing FedAvg server for model class {global_model_trainer.get_model().__class__.__name__}")
 
         self.worker_updates = {}
         self.global_model_trainer = global_model_trainer
         self.update_lim = update_lim
+        self.model_history_size = model_history_size
+        self.model_delta_dtype = model_delta_dtype
+        self.max_update_staleness = max_update_staleness
+        self.model_history = OrderedDict()
+        if async_buffer_size is not None and model_history_size <= 0:
+            raise ValueError("The asynchronous mode needs a model_history_size of at least 1.")
+        self.async_buffer_size = async_buffer_size
+        self.async_publish_interval = async_publish_interval
+        self.staleness_weight = staleness_weight
+        if round_sample_size is not None and (round_deadline is None or async_buffer_size is not None):
+            raise ValueError("Rounds need a round_deadline, and cannot be used in the asynchronous mode.")
+        self.round_sample_size = round_sample_size
+        self.round_deadline = round_deadline
+        # the workers sampled for the current round
+        self.round_workers = set()
+
+        # the running weighted sum of the worker updates, and a buffer to
+        # flatten each worker update into, as parameter vectors.
+        self.param_layout = ParamLayout(global_model_trainer.get_model().state_dict())
+        self.agg_params = self.param_layout.zeros()
+        self.update_params = self.param_layout.zeros()
+        self.agg_update_size = 0
+
+        self.aggregate_in_background = aggregate_in_background
+        if aggregate_in_background:
+            self.update_queue = JoinableQueue()
+            self.agg_threadpool = ThreadPool(1)
+            self.agg_greenlet = gevent.spawn(self.process_worker_updates)
 
         self.last_global_model_update_timestamp = datetime(1980, 10, 10)
         self.server = DCFServer(
@@ -89,16 +224,28 @@ class FedAvgServer(object):
             ssl_enabled=ssl_enabled,
             ssl_keyfile=ssl_keyfile,
             ssl_certfile=ssl_certfile,
-            model_check_interval = 1
+            return_global_model_delta_callback=self.return_global_model_delta,
+            stream_worker_updates=True,
+            check_update_metadata_callback=self.check_update_metadata,
+            convert_global_model_callback=self.convert_global_model,
+            is_worker_selected_callback=self.is_worker_selected if round_sample_size is not None else None
         )
 
         self.unique_updates_since_last_agg = 0
         self.iteration = 0
         self.model_version = 0
+        self.record_global_model()
+
+        publish_interval = round_deadline if round_sample_size is not None else \
+            async_publish_interval if async_buffer_size is not None else None
+        if publish_interval is not None:
+            self.publish_greenlet = gevent.spawn(self.publish_on_interval, publish_interval)
 
     def register_worker(self, worker_id):
         """
         Register the given worker_id by initializing its update to None.
+        When running rounds, the worker joins the current round if it has
+        fewer than round_sample_size workers.
 
         Parameters
         ----------
@@ -108,6 +255,14 @@ class FedAvgServer(object):
         """
         logger.info(f"Registered worker {worker_id[0:WID_LEN]}")
         self.worker_updates[worker_id] = None
+        if self.round_sample_size is not None and len(self.round_workers) < self.round_sample_size:
+            if len(self.round_workers) == 0:
+                # no worker could take part in the round so far, so its
+                # deadline starts now.
+                self.last_global_model_update_timestamp = datetime.now()
+            self.round_workers.add(worker_id)
+            logger.info(f"Worker {worker_id[0:WID_LEN]} joined the round of global model "
+                        f"version {self.model_version}.")
 
     def unregister_worker(self, worker_id):
         """
@@ -121,28 +276,136 @@ class FedAvgServer(object):
         """
         logger.info(f"Unregistered worker {worker_id[0:WID_LEN]}")
         self.worker_updates.pop(worker_id)
+        self.round_workers.discard(worker_id)
+
+    def sample_round_workers(self):
+        """
+        Samples round_sample_size of the registered workers, or all of them
+        if there are fewer, for the round starting with the current global
+        model version.
+        """
+        self.round_workers = set(random.sample(
+            list(self.worker_updates), min(self.round_sample_size, len(self.worker_updates))))
+        logger.info(f"Sampled {len(self.round_workers)} workers for the round of global model "
+                    f"version {self.model_version}.")
+
+    def is_worker_selected(self, worker_id):
+        """
+        Returns whether the worker was sampled for the current round, and so
+        should be sent the current global model.
+
+        Parameters
+        ----------
+
+        worker_id: str
+            The id of the worker.
+
+        Returns
+        -------
+
+        bool:
+            Whether the worker was sampled.
+        """
+        return worker_id in self.round_workers
 
     def return_global_model(self):
         """
-        Serializes the current global torch model, puts it in the proper
-        dictionary, and sends it back.
+        Serializes the state_dict of the current global torch model, puts it
+        in the proper dictionary, and sends it back.
 
         Returns
         ----------
 
         dict:
             A dictionary with keys:
-            GLOBAL_MODEL: serialized global model.
+            GLOBAL_MODEL: serialized state_dict of the global model.
             GLOBAL_MODEL_VERSION: version of the global model
         """
-        model_data = io.BytesIO()
-        torch.save(self.global_model_trainer.get_model(), model_data)
-
         return {
-            GLOBAL_MODEL: model_data.getvalue(),
+            GLOBAL_MODEL: serialize_state_dict(self.global_model_trainer.get_model().state_dict()),
             GLOBAL_MODEL_VERSION: self.model_version
         }
 
+    def record_global_model(self):
+        """
+        Adds a copy of the parameters of the current global model to the
+        model history, removing the oldest versions beyond model_history_size.
+        """
+        if self.model_history_size <= 0:
+            return
+        self.model_history[self.model_version] = \
+            self.param_layout.flatten(self.global_model_trainer.get_model().state_dict())
+        while len(self.model_history) > self.model_history_size:
+            self.model_history.popitem(last=False)
+
+    def return_global_model_delta(self, base_version):
+        """
+        Serializes the difference between the current global model and the
+        given earlier version of it, leaving out the unchanged parameters.
+
+        Parameters
+        ----------
+
+        base_version: int
+            The version of the global model that the worker has.
+
+        Returns
+        ----------
+
+        dict or None:
+            None if the base version is no longer in the model history,
+            otherwise a dictionary with keys:
+            GLOBAL_MODEL: serialized state_dict of the difference.
+            GLOBAL_MODEL_VERSION: version of the global model
+            GLOBAL_MODEL_BASE_VERSION: the base version of the difference.
+        """
+        if base_version not in self.model_history or \
+                self.model_version not in self.model_history:
+            return None
+
+        diff = self.model_history[self.model_version] - self.model_history[base_version]
+        if self.model_delta_dtype is not None:
+            diff = diff.to(self.model_delta_dtype)
+        delta = OrderedDict(
+            (key, val.clone()) for key, val in self.param_layout.unflatten(diff).items()
+            if torch.any(val))
+
+        return {
+            GLOBAL_MODEL: serialize_state_dict(delta),
+            GLOBAL_MODEL_VERSION: self.model_version,
+            GLOBAL_MODEL_BASE_VERSION: base_version
+        }
+
+    def convert_global_model(self, model_dict, model_format):
+        """
+        Converts the global model, or the difference between global model
+        versions, to half precision for the workers that ask for it. The
+        server keeps the model in full precision.
+
+        Parameters
+        ----------
+
+        model_dict: dict
+            The dictionary returned by return_global_model() or
+            return_global_model_delta().
+
+        model_format: str
+            The format requested by the worker.
+
+        Returns
+        -------
+
+        dict or None:
+            The dictionary with the model in half precision, or None if the
+            format is not FLOAT16_FORMAT.
+        """
+        if model_format != FLOAT16_FORMAT:
+            return None
+        state_dict, metadata = deserialize_state_dict(model_dict[GLOBAL_MODEL])
+        model_dict = dict(model_dict)
+        model_dict[GLOBAL_MODEL] = serialize_state_dict(cast_state_dict(state_dict, torch.float16), metadata)
+        return model_dict
+
     def is_global_model_most_recent(self, model_version):
         """
         Returns a default model update time of 2018/10/10.
@@ -162,10 +425,73 @@ class FedAvgServer(object):
         """
         return self.model_version == model_version
 
+    def check_update_metadata(self, worker_id, update_metadata):
+        """
+        Checks the metadata sent with a worker update before the update is
+        decompressed: the worker must be registered, the update must be for a
+        non-empty training set and, if max_update_staleness is given, trained
+        from a recent enough global model. Sparse updates, and all updates in
+        the asynchronous mode, must be trained from a global model still in
+        the model history, as must int8 updates quantized as the difference
+        from their global model. When running rounds, the update must be from a
+        worker sampled for the current round and trained from its global
+        model.
+
+        Parameters
+        ----------
+
+        worker_id: str
+            The id of the worker.
+
+        update_metadata: dict
+            The metadata sent by FedAvgWorker.send_model_update().
+
+        Returns
+        -------
+
+        bool:
+            Whether the update should be accepted.
+        """
+        if worker_id not in self.worker_updates:
+            logger.warning(f"Unregistered worker {worker_id[0:WID_LEN]} tried to send an update.")
+            return False
+
+        update_size = update_metadata.get(UPDATE_SIZE_KEY)
+        if update_size is not None and update_size <= 0:
+            logger.warning(f"Update from worker {worker_id[0:WID_LEN]} is for an empty training set.")
+            return False
+
+        if self.round_sample_size is not None and \
+                (worker_id not in self.round_workers or
+                 update_metadata.get(UPDATE_MODEL_VERSION_KEY) != self.model_version):
+            logger.warning(f"Update from worker {worker_id[0:WID_LEN]} is not for the current round of "
+                           f"global model version {self.model_version} - update dropped.")
+            return False
+
+        if self.max_update_staleness is not None:
+            update_version = update_metadata.get(UPDATE_MODEL_VERSION_KEY)
+            if not isinstance(update_version, int) or \
+                    self.model_version - update_version > self.max_update_staleness:
+                logger.warning(f"Update from worker {worker_id[0:WID_LEN]} trained from global model "
+                               f"version {update_version} is too stale - the current version is "
+                               f"{self.model_version}.")
+                return False
+
+        if (update_metadata.get(SPARSE_UPDATE_KEY) or update_metadata.get(QUANTIZED_DELTA_KEY) or
+                self.async_buffer_size is not None) and \
+                update_metadata.get(UPDATE_MODEL_VERSION_KEY) not in self.model_history:
+            logger.warning(f"Update from worker {worker_id[0:WID_LEN]} trained from global model "
+                           f"version {update_metadata.get(UPDATE_MODEL_VERSION_KEY)} which is no longer "
+                           f"in the model history.")
+            return False
+        return True
+
     def receive_worker_update(self, worker_id, model_update):
         """
-        Given an update for a worker, adds its update to the dictionary of updates.
-        It also agg_model() to update the global model if necessary.
+        Given an update for a worker, either queues it to be processed in the
+        background or processes it immediately - see process_worker_update().
+        The update is a file, so queued updates beyond the spool size of the
+        DCFServer wait on disk rather than in memory.
 
         Returns
         ----------
@@ -173,67 +499,341 @@ class FedAvgServer(object):
         str:
             String format of the last model update time.
         """
-        if worker_id in self.worker_updates:
-            # update the number of unique updates received
-            if self.worker_updates[worker_id] is None or \
-                    self.worker_updates[worker_id][0] < self.last_global_model_update_timestamp:
-                self.unique_updates_since_last_agg += 1
-            update_size, model_bytes = msgpack.unpackb(model_update)
-            self.worker_updates[worker_id] = (
-                datetime.now(),
-                update_size,
-                torch.load(io.BytesIO(model_bytes))
-            )
-            logger.info(f"Model update from worker {worker_id[0:WID_LEN]} accepted.")
-            if self.agg_model():
-                self.global_model_trainer.test()
-            return f"Update received for worker {worker_id[0:WID_LEN]}"
-        else:
+        if worker_id not in self.worker_updates:
             logger.warning(
                 f"Unregistered worker {worker_id[0:WID_LEN]} tried to send an update.")
+            model_update.close()
             return f"Please register before sending an update."
 
-    def agg_model(self):
+        if self.aggregate_in_background:
+            self.update_queue.put((worker_id, model_update))
+            return f"Update received for worker {worker_id[0:WID_LEN]}"
+        else:
+            return self.process_worker_update(worker_id, model_update)
+
+    def process_worker_updates(self):
         """
-        Updates the global model by aggregating all the most recent updates
-        from the workers, assuming that the number of unique updates received
-        since the last global model update is above the threshold.
+        Greenlet function that processes the queued worker updates in the order
+        they were received.
         """
-        if self.unique_updates_since_last_agg < self.update_lim:
-            return False
+        while True:
+            worker_id, model_update = self.update_queue.get()
+            try:
+                if worker_id is None:
+                    # queued by publish_on_interval()
+                    self.update_global_model()
+                else:
+                    self.process_worker_update(worker_id, model_update)
+            except Exception as e:
+                logger.error(f"Unable to process update from worker {worker_id[0:WID_LEN]}: "
+                             f"{str(e.__class__)} {str(e)}")
+            finally:
+                self.update_queue.task_done()
+
+    def run_in_background(self, func, *args):
+        """
+        Runs the function in the aggregation thread, if aggregating in the
+        background, and returns its result.
+        """
+        if self.aggregate_in_background:
+            return self.agg_threadpool.apply(func, args)
+        return func(*args)
+
+    def process_worker_update(self, worker_id, model_update):
+        """
+        Adds the update from the worker to the running weighted sum of the
+        updates received since the last global model update. It also calls
+        agg_model() to update the global model if necessary. Only the first
+        update from each worker since the last global model update is used.
 
-        logger.info("Updating the global model.\n")
+        Returns
+        ----------
+
+        str:
+            String format of the last model update time.
+        """
+        if worker_id not in self.worker_updates:
+            logger.warning(f"Worker {worker_id[0:WID_LEN]} was unregistered before its update was processed.")
+            model_update.close()
+            return f"Please register before sending an update."
 
-        def agg_params(key, state_dicts, update_sizes):
-            agg_val = state_dicts[0][key] * update_sizes[0]
-            for sd, sz in zip(state_dicts[1:], update_sizes[1:]):
-                agg_val = agg_val + sd[key] * sz
-            agg_val = agg_val / sum(update_sizes)
-            return torch.tensor(agg_val.cpu().clone().numpy())
+        if self.worker_updates[worker_id] is not None and \
+                self.worker_updates[worker_id][0] > self.last_global_model_update_timestamp:
+            logger.warning(f"Worker {worker_id[0:WID_LEN]} already sent an update since the last "
+                           f"global model update - update ignored.")
+            model_update.close()
+            return f"Update already received for worker {worker_id[0:WID_LEN]}"
 
-        # gather the model-updates to use for the update
-        state_dicts_to_update_with = []
-        update_sizes = []
+        if self.round_sample_size is not None and worker_id not in self.round_workers:
+            logger.warning(f"Update from worker {worker_id[0:WID_LEN]} arrived after its round closed - "
+                           f"update ignored.")
+            model_update.close()
+            return f"Round closed before the update from worker {worker_id[0:WID_LEN]} arrived"
+
+        update_size = self.run_in_background(self.add_worker_update_to_agg_model, model_update)
         # each item in the worker_updates dictionary contains a
-        # (timestamp update, update-size, model)
-        for wi in self.worker_updates:
-            if self.worker_updates[wi][0] > self.last_global_model_update_timestamp:
-                state_dicts_to_update_with.append(
-                    self.worker_updates[wi][2].state_dict())
-                update_sizes.append(self.worker_updates[wi][1])
+        # (timestamp update, update-size)
+        self.worker_updates[worker_id] = (datetime.now(), update_size)
+        self.unique_updates_since_last_agg += 1
+        logger.info(f"Model update from worker {worker_id[0:WID_LEN]} accepted.")
+        self.update_global_model()
+        return f"Update received for worker {worker_id[0:WID_LEN]}"
+
+    def update_global_model(self):
+        """
+        Calls agg_model() to update the global model if necessary, and if it
+        was updated, notifies the workers and tests it.
+        """
+        if self.agg_model():
+            self.server.global_model_version_changed()
+            self.run_in_background(self.global_model_trainer.test)
+
+    def publish_on_interval(self, interval):
+        """
+        Greenlet function that checks whether a new global model is due every
+        interval seconds after the last one - async_publish_interval in the
+        asynchronous mode, or round_deadline when running rounds. The check
+        is queued behind the worker updates if they are aggregated in the
+        background.
+
+        Parameters
+        ----------
+
+        interval: float
+            The number of seconds.
+        """
+        while True:
+            elapsed = (datetime.now() - self.last_global_model_update_timestamp).total_seconds()
+            if elapsed < interval:
+                gevent.sleep(interval - elapsed)
+                continue
+            if self.aggregate_in_background:
+                self.update_queue.put((None, None))
+            else:
+                self.update_global_model()
+            gevent.sleep(interval)
+
+    def add_worker_update_to_agg_model(self, model_update):
+        """
+        Deserializes the worker update and adds it to the running weighted sum
+        of the worker model parameters.
+
+        Parameters
+        ----------
+
+        model_update: file-like object
+            The file holding the update from the worker, as sent by
+            FedAvgWorker.send_model_update().
+
+        Returns
+        -------
+
+        int:
+            The size of the training set used for the worker model.
+        """
+        with model_update:
+            state_dict, metadata = deserialize_state_dict(model_update.read())
+        if self.round_sample_size is not None and metadata.get(UPDATE_MODEL_VERSION_KEY) != self.model_version:
+            raise ValueError(f"Update trained from global model version {metadata.get(UPDATE_MODEL_VERSION_KEY)} "
+                             f"arrived after its round closed.")
+        update_size = metadata[UPDATE_SIZE_KEY]
+        quantization = metadata.get(QUANTIZATION_KEY)
+        if metadata.get(SPARSE_UPDATE_KEY):
+            values = state_dict[SPARSE_VALUES_KEY]
+            if quantization is not None:
+                values = dequantize_int8_(values.float(), *quantization[SPARSE_VALUES_KEY])
+            self.add_sparse_to_agg_model(state_dict[SPARSE_INDICES_KEY], values,
+                                         metadata[UPDATE_MODEL_VERSION_KEY], update_size)
+        else:
+            self.add_to_agg_model(state_dict, update_size, quantization,
+                                  metadata.get(UPDATE_MODEL_VERSION_KEY),
+                                  metadata.get(QUANTIZED_DELTA_KEY, False))
+        return update_size
+
+    def get_base_params(self, base_version):
+        """
+        Returns the parameters of the global model an update was trained from.
+
+        Parameters
+        ----------
+
+        base_version: int
+            The version of the global model.
+
+        Returns
+        -------
+
+        torch.Tensor:
+            The parameter vector of the global model.
+        """
+        if base_version not in self.model_history:
+            raise ValueError(f"Global model version {base_version} of update is no longer "
+                             f"in the model history.")
+        return self.model_history[base_version]
 
-        # now update the global model
-        global_model_dict = OrderedDict()
-        for key in state_dicts_to_update_with[0].keys():
-            global_model_dict[key] = agg_params(
-                key, state_dicts_to_update_with, update_sizes)
+    def get_update_weight(self, base_version, update_size):
+        """
+        Returns the weight of an update in the running weighted sum: its
+        update size, discounted by its staleness in the asynchronous mode.
+
+        Parameters
+        ----------
+
+        base_version: int
+            The version of the global model the update was trained from.
+
+        update_size: int
+            The size of the training set used for the worker model.
 
-        self.global_model_trainer.load_model_from_state_dict(global_model_dict)
+        Returns
+        -------
+
+        float:
+            The weight.
+        """
+        if self.async_buffer_size is None:
+            return update_size
+        return update_size * self.staleness_weight(self.model_version - base_version)
+
+    def add_to_agg_model(self, state_dict, update_size, quantization=None, base_version=None,
+                         quantized_delta=False):
+        """
+        Adds the parameters in the state_dict, weighted by the update size, to
+        the running weighted sum of the worker model parameters - or in the
+        asynchronous mode, their difference from the global model they were
+        trained from, weighted by get_update_weight(). Quantized tensors are
+        dequantized in the buffer they are flattened into, and the global
+        model they were trained from is added back if they are differences.
+
+        Parameters
+        ----------
+
+        state_dict: dict
+            The state_dict of the worker model.
+
+        update_size: int
+            The size of the training set used for the worker model.
+
+        quantization: dict (default None)
+            The [scale, zero point] of each int8 quantized tensor of the
+            state_dict, by key - see quantization.quantize_state_dict().
+
+        base_version: int (default None)
+            The version of the global model the update was trained from,
+            needed in the asynchronous mode and for quantized differences.
+
+        quantized_delta: bool (default False)
+            Whether the quantized tensors are the differences from the global
+            model the update was trained from.
+        """
+        self.param_layout.flatten(state_dict, out=self.update_params)
+        if quantization is not None:
+            update_state_dict = self.param_layout.unflatten(self.update_params)
+            base_state_dict = self.param_layout.unflatten(self.get_base_params(base_version)) \
+                if quantized_delta else None
+            for key, (scale, zero_point) in quantization.items():
+                dequantize_int8_(update_state_dict[key], scale, zero_point)
+                if quantized_delta:
+                    update_state_dict[key].add_(base_state_dict[key])
+        if self.async_buffer_size is not None:
+            self.update_params.sub_(self.get_base_params(base_version))
+        self.agg_params.add_(self.update_params, alpha=self.get_update_weight(base_version, update_size))
+        self.agg_update_size += update_size
+
+    def add_sparse_to_agg_model(self, indices, values, base_version, update_size):
+        """
+        Adds the worker model given by a sparse update - the global model it
+        was trained from plus the differences at the given indices of the
+        parameter vector - weighted by the update size, to the running weighted
+        sum of the worker model parameters. In the asynchronous mode only the
+        differences are added, weighted by get_update_weight().
+
+        Parameters
+        ----------
+
+        indices: torch.Tensor
+            The indices of the differences in the parameter vector.
+
+        values: torch.Tensor
+            The differences from the global model at these indices.
+
+        base_version: int
+            The version of the global model the update was trained from.
+
+        update_size: int
+            The size of the training set used for the worker model.
+        """
+        base_params = self.get_base_params(base_version)
+        if indices.shape != values.shape or indices.dim() != 1:
+            raise ValueError(f"Sparse update has {tuple(indices.shape)} indices for "
+                             f"{tuple(values.shape)} values.")
+        if len(indices) > 0 and (indices.min() < 0 or indices.max() >= self.param_layout.numel):
+            raise ValueError(f"Sparse update has indices outside of the {self.param_layout.numel} parameters.")
+        if self.async_buffer_size is None:
+            self.agg_params.add_(base_params, alpha=update_size)
+        weight = self.get_update_weight(base_version, update_size)
+        self.agg_params.index_add_(0, indices.long(), values.to(self.agg_params.dtype) * weight)
+        self.agg_update_size += update_size
+
+    def is_agg_model_due(self):
+        """
+        Returns whether the global model should be updated: if the number of
+        unique updates received since the last global model update is above
+        the threshold - async_buffer_size in the asynchronous mode - or, in
+        the asynchronous mode, if any update was received and
+        async_publish_interval seconds have passed since the last update.
+        When running rounds, the round also closes at its deadline, if any
+        update was received or any worker can be sampled for the next round.
+
+        Returns
+        -------
+
+        bool:
+            Whether the global model should be updated.
+        """
+        elapsed = (datetime.now() - self.last_global_model_update_timestamp).total_seconds()
+        if self.round_sample_size is not None:
+            return self.unique_updates_since_last_agg >= self.update_lim or \
+                (elapsed >= self.round_deadline and
+                 (self.unique_updates_since_last_agg > 0 or len(self.worker_updates) > 0))
+        if self.async_buffer_size is None:
+            return self.unique_updates_since_last_agg >= self.update_lim
+        if self.unique_updates_since_last_agg >= self.async_buffer_size:
+            return True
+        return self.async_publish_interval is not None and self.unique_updates_since_last_agg > 0 and \
+            elapsed >= self.async_publish_interval
+
+    def agg_model(self):
+        """
+        Updates the global model from the running weighted sum of the updates
+        received from the workers, if is_agg_model_due(). In the asynchronous
+        mode the weighted sum of the differences is added to the current
+        global model. When running rounds, the workers for the next round are
+        sampled, and the global model is published unchanged as a new version
+        if no update was received in the round.
+        """
+        if not self.is_agg_model_due():
+            return False
+
+        if self.agg_update_size > 0:
+            logger.info("Updating the global model.\n")
+            self.agg_params.div_(self.agg_update_size)
+            if self.async_buffer_size is not None:
+                self.agg_params.add_(self.model_history[self.model_version])
+            self.global_model_trainer.load_model_from_state_dict(
+                self.param_layout.unflatten(self.agg_params))
+            self.agg_params.zero_()
+            self.agg_update_size = 0
+        else:
+            logger.info("No update received before the round deadline - starting a new round.")
 
         self.last_global_model_update_timestamp = datetime.now()
         self.unique_updates_since_last_agg = 0
         self.iteration += 1
         self.model_version += 1
+        self.record_global_model()
+        if self.round_sample_size is not None:
+            self.sample_round_workers()
 
         return True
 
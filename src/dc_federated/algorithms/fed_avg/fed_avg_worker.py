@@ -2,17 +2,22 @@
 Contains the worker side implementation of the FedAvg algorithm.
 """
 
-import io
+import math
 import time
 from datetime import datetime
 import logging
-import msgpack
 
 import torch
 
 from dc_federated.utils import get_host_ip
-from dc_federated.backend import GLOBAL_MODEL, GLOBAL_MODEL_VERSION, WID_LEN
+from dc_federated.backend import GLOBAL_MODEL, GLOBAL_MODEL_VERSION, GLOBAL_MODEL_BASE_VERSION, WID_LEN
 from dc_federated.backend import DCFWorker
+from dc_federated.algorithms.fed_avg._constants import UPDATE_SIZE_KEY, UPDATE_MODEL_VERSION_KEY, \
+    SPARSE_UPDATE_KEY, SPARSE_INDICES_KEY, SPARSE_VALUES_KEY, QUANTIZATION_KEY, QUANTIZED_DELTA_KEY, \
+    FLOAT16_FORMAT
+from dc_federated.algorithms.param_vector import ParamLayout, top_k_sparsify
+from dc_federated.algorithms.quantization import quantize_int8, dequantize_int8_, quantize_state_dict
+from dc_federated.algorithms.tensor_container import serialize_state_dict, deserialize_state_dict
 
 
 logger = logging.getLogger(__name__)
@@ -39,16 +44,89 @@ class FedAvgWorker(object):
 
     server_port: int
         The port at which the serer should listen to
+
+    long_poll_returns_model: bool (default True)
+        Whether to get the global model in the same request as the long-poll
+        for the global model version change.
+
+    accept_global_model_delta: bool (default True)
+        Whether to ask the server for the difference from the last global model
+        received instead of the whole global model. This requires keeping a copy
+        of the last global model in the worker.
+
+    update_codec: str (default 'zlib+shuffle')
+        The codec to compress the model updates with - see
+        dc_federated.backend._codecs. The byte-shuffle pre-filter groups
+        the bytes of the float32 parameters by significance, which makes
+        them compress better.
+
+    model_codec: str (default 'zlib+shuffle')
+        The codec to ask the server to compress the global model with.
+
+    sparse_update_fraction: float (default None)
+        If given (e.g. 0.01), only this fraction of the parameters is sent in
+        each update: those whose difference from the last global model
+        received is the largest, as index/value pairs. The differences not
+        sent are kept and added to the next update. The whole model is sent
+        if None, or if no global model has been received yet. The server
+        must have the global model the update was trained from in its model
+        history.
+
+    update_dtype: torch.dtype (default None)
+        If torch.int8, the floating point tensors of the updates are sent
+        quantized to int8, with a scale and zero point per tensor and
+        stochastic rounding so that the server's average is unbiased. Once
+        a global model has been received, its difference from the local
+        model is quantized rather than the weights themselves, which
+        needs the server to have that global model in its model history.
+
+    global_model_dtype: torch.dtype (default None)
+        If torch.float16, the server is asked to send the global model, and
+        the differences between global models, in half precision. The
+        server keeps the global model in full precision.
+
+    global_model_resync_interval: int (default 10)
+        The number of reduced precision differences - see global_model_dtype
+        and FedAvgServer(model_delta_dtype) - that the worker applies to its
+        copy of the global model before asking for the whole model again.
+        The rounding error of each difference is added to the copy, which
+        therefore drifts from the server's global model with every one of
+        them; the sparse and quantized updates computed against the copy
+        carry that drift into the server's aggregate. Differences in full
+        precision are exact and do not count.
     """
 
-    def __init__(self, fed_model_trainer, private_key_file, server_protocol=None, server_host_ip=None, server_port=None):
+    def __init__(self, fed_model_trainer, private_key_file, server_protocol=None, server_host_ip=None, server_port=None,
+                 long_poll_returns_model=True, accept_global_model_delta=True,
+                 update_codec='zlib+shuffle', model_codec='zlib+shuffle', sparse_update_fraction=None,
+                 update_dtype=None, global_model_dtype=None, global_model_resync_interval=10):
         self.fed_model = fed_model_trainer
 
         server_protocol = 'http' if server_protocol is None else 'https'
         server_host_ip = get_host_ip() if not server_host_ip else server_host_ip
         server_port = 8080 if not server_port else server_port
+        if update_dtype not in [None, torch.int8]:
+            raise ValueError(f"Unsupported update type {update_dtype} - expected torch.int8 or None.")
+        if global_model_dtype not in [None, torch.float16]:
+            raise ValueError(f"Unsupported global model type {global_model_dtype} - expected torch.float16 or None.")
+        self.update_dtype = update_dtype
 
         self.worker_version_of_global_model = 0
+        self.accept_global_model_delta = accept_global_model_delta
+        # the parameters of the last global model received, to apply the
+        # differences from the server to.
+        self.param_layout = ParamLayout(self.fed_model.get_model().state_dict())
+        self.global_params = None
+        # the number of reduced precision differences applied to the
+        # global_params since the whole global model was last received.
+        self.global_model_resync_interval = global_model_resync_interval
+        self.lossy_deltas_since_resync = 0
+
+        # the differences from the global model left out of the sparse
+        # updates sent so far, and a buffer to flatten the local model into.
+        self.sparse_update_fraction = sparse_update_fraction
+        self.residual_params = None
+        self.local_params = None
 
         self.worker = DCFWorker(
             server_protocol=server_protocol,
@@ -56,28 +134,135 @@ class FedAvgWorker(object):
             server_port=server_port,
             global_model_version_changed_callback=self.global_model_version_changed_callback,
             get_worker_version_of_global_model=lambda : self.worker_version_of_global_model,
-            private_key_file=private_key_file
+            private_key_file=private_key_file,
+            long_poll_returns_model=long_poll_returns_model,
+            get_global_model_delta_base_version=self.get_global_model_delta_base_version,
+            update_codec=update_codec,
+            model_codec=model_codec,
+            global_model_format=FLOAT16_FORMAT if global_model_dtype == torch.float16 else None
         )
 
-        self.global_model = None
         self.worker_id = None
 
         self.initialize()
 
     def serialize_model(self):
         """
-        Serializes the local model so that it can be sent over to the global
-        model.
+        Serializes the state_dict of the local model, along with the size of
+        the training set used for it and the version of the global model it
+        was trained from, so that it can be sent over to the server. If the
+        update is quantized to int8, the difference from the last global
+        model received is quantized when there is one.
 
         Returns
         -------
 
-        byte-string:
+        bytearray:
             A serialized version of the model.
         """
-        model_data = io.BytesIO()
-        torch.save(self.fed_model.get_model(), model_data)
-        return model_data.getvalue()
+        state_dict = self.fed_model.get_model().state_dict()
+        metadata = {UPDATE_SIZE_KEY: self.fed_model.get_per_session_train_size(),
+                    UPDATE_MODEL_VERSION_KEY: self.worker_version_of_global_model}
+        if self.update_dtype == torch.int8:
+            base_state_dict = None
+            if self.global_params is not None:
+                base_state_dict = self.param_layout.unflatten(self.global_params)
+                metadata[QUANTIZED_DELTA_KEY] = True
+            state_dict, metadata[QUANTIZATION_KEY] = quantize_state_dict(
+                state_dict, base_state_dict=base_state_dict)
+        return serialize_state_dict(state_dict, metadata)
+
+    def serialize_sparse_update(self):
+        """
+        Serializes the largest differences between the local model and the
+        last global model received, plus the differences left out of the
+        previous sparse updates, as index/value pairs into the parameter
+        vector. The differences left out of this update are kept for the
+        next one, along with the quantization error of the differences sent
+        if they are quantized.
+
+        Returns
+        -------
+
+        bytearray:
+            The serialized sparse update.
+        """
+        self.local_params = self.param_layout.flatten(
+            self.fed_model.get_model().state_dict(), out=self.local_params)
+        if self.residual_params is None:
+            self.residual_params = self.param_layout.zeros()
+        delta = self.residual_params.add_(self.local_params).sub_(self.global_params)
+
+        indices, values = top_k_sparsify(
+            delta, max(1, math.ceil(self.sparse_update_fraction * self.param_layout.numel)))
+
+        metadata = {UPDATE_SIZE_KEY: self.fed_model.get_per_session_train_size(),
+                    UPDATE_MODEL_VERSION_KEY: self.worker_version_of_global_model,
+                    SPARSE_UPDATE_KEY: True}
+        if self.update_dtype == torch.int8:
+            quantized_values, scale, zero_point = quantize_int8(values)
+            delta[indices] = values - dequantize_int8_(quantized_values.float(), scale, zero_point)
+            values = quantized_values
+            metadata[QUANTIZATION_KEY] = {SPARSE_VALUES_KEY: [scale, zero_point]}
+
+        index_dtype = torch.int32 if self.param_layout.numel < 2 ** 31 else torch.int64
+        return serialize_state_dict(
+            {SPARSE_INDICES_KEY: indices.to(index_dtype), SPARSE_VALUES_KEY: values}, metadata)
+
+    def get_global_model_delta_base_version(self):
+        """
+        Returns the version of the global model that differences from the
+        server can be applied to.
+
+        Returns
+        -------
+
+        int or None:
+            The version of the last global model received, or None if no global
+            model has been received, differences are not accepted, or the
+            whole model is due after global_model_resync_interval reduced
+            precision differences.
+        """
+        if not self.accept_global_model_delta or self.global_params is None or \
+                self.lossy_deltas_since_resync >= self.global_model_resync_interval:
+            return None
+        return self.worker_version_of_global_model
+
+    def load_global_model(self, model_dict):
+        """
+        Deserializes the global model in the model dictionary - applying it
+        to the last global model received if it is a difference from that -
+        and returns its state_dict.
+
+        Parameters
+        ----------
+
+        model_dict: dict
+            The model dictionary returned by the server.
+
+        Returns
+        -------
+
+        dict or None:
+            The state_dict of the global model, or None if the difference could
+            not be applied.
+        """
+        if GLOBAL_MODEL_BASE_VERSION not in model_dict:
+            return deserialize_state_dict(model_dict[GLOBAL_MODEL])[0]
+
+        if self.global_params is None or \
+                model_dict[GLOBAL_MODEL_BASE_VERSION] != self.worker_version_of_global_model:
+            logger.error(f"Received difference from global model version {model_dict[GLOBAL_MODEL_BASE_VERSION]} "
+                         f"but worker has version {self.worker_version_of_global_model}.")
+            return None
+
+        delta, _ = deserialize_state_dict(model_dict[GLOBAL_MODEL])
+        state_dict = self.param_layout.unflatten(self.global_params)
+        for key, val in delta.items():
+            state_dict[key].add_(val)
+        if any(val.is_floating_point() and val.dtype != self.global_params.dtype for val in delta.values()):
+            self.lossy_deltas_since_resync += 1
+        return state_dict
 
     def train_and_test_model(self):
         """
@@ -90,12 +275,24 @@ class FedAvgWorker(object):
 
     def send_model_update(self):
         """
-        Sends the current model to the server.
+        Sends the current model, or the sparse update if enabled, to the
+        server, along with the version of the global model it was trained
+        from and the size of the training set, for the server to check before
+        decompressing the model.
         """
+        sparse_update = self.sparse_update_fraction is not None and self.global_params is not None
+        quantized_delta = self.update_dtype == torch.int8 and self.global_params is not None
+        if sparse_update:
+            model_update = self.serialize_sparse_update()
+        else:
+            model_update = self.serialize_model()
+            self.residual_params = None
         self.worker.send_model_update(
-            msgpack.packb((self.fed_model.get_per_session_train_size(),
-                          self.serialize_model()))
-        )
+            model_update,
+            {UPDATE_MODEL_VERSION_KEY: self.worker_version_of_global_model,
+             UPDATE_SIZE_KEY: self.fed_model.get_per_session_train_size(),
+             SPARSE_UPDATE_KEY: sparse_update,
+             QUANTIZED_DELTA_KEY: quantized_delta and not sparse_update})
         logger.info(
             f"Sent model update from worker {self.worker_id[0:WID_LEN]} to the server.")
 
@@ -133,9 +330,19 @@ class FedAvgWorker(object):
             logger.error("Invalid model received from the server.")
             return
 
+        state_dict = self.load_global_model(model_dict)
+        if state_dict is None:
+            # ask for the whole model next time.
+            self.global_params = None
+            return
+
         self.worker_version_of_global_model = model_dict[GLOBAL_MODEL_VERSION]
-        new_model = torch.load(io.BytesIO(model_dict[GLOBAL_MODEL]))
-        self.fed_model.load_model_from_state_dict(new_model.state_dict())
+        if (self.accept_global_model_delta or self.sparse_update_fraction is not None or
+                self.update_dtype == torch.int8) and \
+                GLOBAL_MODEL_BASE_VERSION not in model_dict:
+            self.global_params = self.param_layout.flatten(state_dict, out=self.global_params)
+            self.lossy_deltas_since_resync = 0
+        self.fed_model.load_model_from_state_dict(state_dict)
         self.train_and_test_model()
         self.send_model_update()
 
@@ -0,0 +1,146 @@
+"""
+Contains a flat, contiguous representation of the parameters of a torch
+model, so that operations over all the parameters of a model (aggregation,
+differences, serialization) are done in one go rather than key by key.
+"""
+
+from collections import OrderedDict
+
+import torch
+
+
+class ParamLayout(object):
+    """
+    Describes where each tensor of a state_dict lives in a flat, contiguous
+    one dimensional parameter vector: the name, shape, type and offset of
+    each tensor. The layout is computed once from a reference state_dict and
+    can then be used to flatten any state_dict with the same keys and shapes
+    into a parameter vector, and to get state_dict views back out of it.
+
+    Parameters
+    ----------
+
+    state_dict: dict
+        The reference state_dict.
+    """
+    def __init__(self, state_dict):
+        self.keys = []
+        self.shapes = []
+        self.dtypes = []
+        self.offsets = []
+        self.numels = []
+        self.numel = 0
+        for key, val in state_dict.items():
+            self.keys.append(key)
+            self.shapes.append(tuple(val.shape))
+            self.dtypes.append(val.dtype)
+            self.offsets.append(self.numel)
+            self.numels.append(val.numel())
+            self.numel += val.numel()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def zeros(self, dtype=torch.float32):
+        """
+        Returns a zeroed parameter vector for this layout.
+
+        Parameters
+        ----------
+
+        dtype: torch.dtype (default torch.float32)
+            The type of the parameter vector.
+
+        Returns
+        -------
+
+        torch.Tensor:
+            The one dimensional parameter vector.
+        """
+        return torch.zeros(self.numel, dtype=dtype)
+
+    def flatten(self, state_dict, out=None, dtype=torch.float32):
+        """
+        Copies the tensors of the state_dict into a parameter vector.
+
+        Parameters
+        ----------
+
+        state_dict: dict
+            The state_dict to flatten - it must have the keys and shapes
+            of this layout.
+
+        out: torch.Tensor (default None)
+            The parameter vector to copy into, so that it can be reused.
+            A new one is allocated if None.
+
+        dtype: torch.dtype (default torch.float32)
+            The type of the parameter vector, if a new one is allocated.
+
+        Returns
+        -------
+
+        torch.Tensor:
+            The one dimensional parameter vector.
+        """
+        if out is None:
+            out = torch.empty(self.numel, dtype=dtype)
+        for key, offset, numel, shape in zip(self.keys, self.offsets, self.numels, self.shapes):
+            val = state_dict[key]
+            if tuple(val.shape) != shape:
+                raise ValueError(f"Tensor {key} has shape {tuple(val.shape)} - expected {shape}.")
+            out[offset:offset + numel].view(shape).copy_(val)
+        return out
+
+    def unflatten(self, params):
+        """
+        Returns the state_dict corresponding to the parameter vector. The
+        tensors of the state_dict are views into the parameter vector, and
+        are therefore of the type of the parameter vector rather than the
+        original type of the tensors.
+
+        Parameters
+        ----------
+
+        params: torch.Tensor
+            The one dimensional parameter vector.
+
+        Returns
+        -------
+
+        OrderedDict:
+            The state_dict of views into params.
+        """
+        if params.numel() != self.numel:
+            raise ValueError(f"Parameter vector has {params.numel()} elements - expected {self.numel}.")
+        return OrderedDict(
+            (key, params[offset:offset + numel].view(shape))
+            for key, offset, numel, shape in zip(self.keys, self.offsets, self.numels, self.shapes))
+
+
+def top_k_sparsify(params, k):
+    """
+    Takes the k elements of largest magnitude out of the parameter vector,
+    leaving zeros in their place, so that the rest can be kept as the
+    residual for the next time.
+
+    Parameters
+    ----------
+
+    params: torch.Tensor
+        The one dimensional parameter vector - it is modified in place.
+
+    k: int
+        The number of elements to take out. At most all the elements are
+        taken.
+
+    Returns
+    -------
+
+    torch.Tensor, torch.Tensor:
+        The indices of the elements taken out, and their values.
+    """
+    _, indices = torch.topk(params.abs(), min(k, params.numel()), sorted=False)
+    values = params[indices]
+    params[indices] = 0.0
+    return indices, values
@@ -0,0 +1,141 @@
+"""
+Contains the quantization of the float tensors of a state_dict used to
+reduce the size of the models sent between the workers and the server:
+stochastic per-tensor int8 quantization for the worker updates, and
+casting to a smaller float type for the global model.
+"""
+
+from collections import OrderedDict
+
+import torch
+
+
+def quantize_int8(tensor, stochastic=True):
+    """
+    Quantizes the float tensor to int8 with a per-tensor affine mapping,
+    such that tensor ~= (quantized - zero_point) * scale. The range of the
+    mapping always includes 0, so that zeros are represented exactly.
+
+    Parameters
+    ----------
+
+    tensor: torch.Tensor
+        The float tensor to quantize.
+
+    stochastic: bool (default True)
+        Whether to round stochastically, so that the quantized tensor is
+        unbiased, or to the nearest value.
+
+    Returns
+    -------
+
+    torch.Tensor, float, int:
+        The int8 tensor, the scale and the zero point.
+    """
+    tensor = tensor.detach().float()
+    min_val = min(tensor.min().item(), 0.0) if tensor.numel() > 0 else 0.0
+    max_val = max(tensor.max().item(), 0.0) if tensor.numel() > 0 else 0.0
+    scale = (max_val - min_val) / 255.0
+    if scale == 0.0:
+        scale = 1.0
+    zero_point = int(min(127, max(-128, round(-128 - min_val / scale))))
+
+    scaled = tensor / scale + zero_point
+    if stochastic:
+        scaled = scaled.add_(torch.rand_like(scaled)).floor_()
+    else:
+        scaled = scaled.round_()
+    return scaled.clamp_(-128, 127).to(torch.int8), scale, zero_point
+
+
+def dequantize_int8_(tensor, scale, zero_point):
+    """
+    Dequantizes in place a float tensor into which an int8 tensor quantized
+    with quantize_int8() has been copied, so that it can be dequantized
+    into an existing buffer without allocating a float copy.
+
+    Parameters
+    ----------
+
+    tensor: torch.Tensor
+        The float tensor holding the quantized values.
+
+    scale: float
+        The scale of the quantization.
+
+    zero_point: int
+        The zero point of the quantization.
+
+    Returns
+    -------
+
+    torch.Tensor:
+        The tensor, dequantized.
+    """
+    return tensor.sub_(zero_point).mul_(scale)
+
+
+def quantize_state_dict(state_dict, stochastic=True, base_state_dict=None):
+    """
+    Quantizes the float tensors of the state_dict to int8 - see
+    quantize_int8() - or, if base_state_dict is given, their differences
+    from the tensors of base_state_dict. The differences span a much
+    smaller range than the weights, so they keep more resolution. The
+    other tensors are left as they are.
+
+    Parameters
+    ----------
+
+    state_dict: dict
+        The state_dict to quantize.
+
+    stochastic: bool (default True)
+        Whether to round stochastically.
+
+    base_state_dict: dict (default None)
+        If given, the state_dict to quantize the differences from, with the
+        same keys and shapes.
+
+    Returns
+    -------
+
+    OrderedDict, dict:
+        The quantized state_dict, and the [scale, zero point] of each
+        quantized tensor, by key.
+    """
+    quantized = OrderedDict()
+    quantization = {}
+    for key, val in state_dict.items():
+        if val.is_floating_point():
+            if base_state_dict is not None:
+                val = val - base_state_dict[key]
+            quantized[key], scale, zero_point = quantize_int8(val, stochastic)
+            quantization[key] = [scale, zero_point]
+        else:
+            quantized[key] = val
+    return quantized, quantization
+
+
+def cast_state_dict(state_dict, dtype):
+    """
+    Casts the float tensors of the state_dict to the given type. The other
+    tensors are left as they are.
+
+    Parameters
+    ----------
+
+    state_dict: dict
+        The state_dict to cast.
+
+    dtype: torch.dtype
+        The float type to cast to, e.g. torch.float16.
+
+    Returns
+    -------
+
+    OrderedDict:
+        The cast state_dict.
+    """
+    return OrderedDict(
+        (key, val.to(dtype) if val.is_floating_point() else val)
+        for key, val in state_dict.items())
@@ -0,0 +1,134 @@
+"""
+Contains a compact binary container format for the tensors of a torch
+state_dict, used instead of pickling the model when sending it between
+the workers and the server.
+
+The format is:
+
+    MAGIC (4 bytes) | header length (4 bytes, little endian) | header | data
+
+where the header is a msgpack dictionary giving the name, type, shape and
+offset (from the start of the data) of each tensor, plus any application
+metadata, and the data is the raw bytes of each tensor, each aligned to
+ALIGNMENT bytes. Deserializing creates tensors that are views into the
+given buffer - be it bytes, a bytearray, a memoryview or a memory map - so
+no copy is made until they are loaded into a model.
+"""
+
+import struct
+import warnings
+from collections import OrderedDict
+
+import msgpack
+import numpy as np
+import torch
+
+MAGIC = b'DCFT'
+ALIGNMENT = 64
+
+_PREFIX = struct.Struct('<4sI')
+
+TENSORS_KEY = 'tensors'
+METADATA_KEY = 'metadata'
+
+_DTYPES = {
+    'float16': (torch.float16, np.float16),
+    'float32': (torch.float32, np.float32),
+    'float64': (torch.float64, np.float64),
+    'uint8': (torch.uint8, np.uint8),
+    'int8': (torch.int8, np.int8),
+    'int16': (torch.int16, np.int16),
+    'int32': (torch.int32, np.int32),
+    'int64': (torch.int64, np.int64),
+    'bool': (torch.bool, np.bool_),
+}
+_DTYPE_NAMES = {torch_dtype: name for name, (torch_dtype, _) in _DTYPES.items()}
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def serialize_state_dict(state_dict, metadata=None):
+    """
+    Serializes the tensors of the state_dict, and optionally some metadata,
+    into the tensor container format.
+
+    Parameters
+    ----------
+
+    state_dict: dict
+        The dictionary of tensors to serialize.
+
+    metadata: dict (default None)
+        Application metadata to store in the header. It must be serializable
+        with msgpack.
+
+    Returns
+    -------
+
+    bytearray:
+        The serialized state_dict.
+    """
+    tensors = []
+    entries = []
+    data_size = 0
+    for key, val in state_dict.items():
+        if val.dtype not in _DTYPE_NAMES:
+            raise ValueError(f"Tensor {key} has unsupported type {val.dtype}.")
+        data_size = _aligned(data_size)
+        entries.append([key, _DTYPE_NAMES[val.dtype], list(val.shape), data_size])
+        val = val.detach().cpu().contiguous().numpy()
+        tensors.append((data_size, val))
+        data_size += val.nbytes
+
+    header = msgpack.packb({TENSORS_KEY: entries, METADATA_KEY: metadata})
+    data_start = _aligned(_PREFIX.size + len(header))
+
+    buffer = bytearray(data_start + data_size)
+    _PREFIX.pack_into(buffer, 0, MAGIC, len(header))
+    buffer[_PREFIX.size:_PREFIX.size + len(header)] = header
+    view = memoryview(buffer)
+    for offset, val in tensors:
+        view[data_start + offset:data_start + offset + val.nbytes] = val.reshape(-1).view(np.uint8)
+    return buffer
+
+
+def deserialize_state_dict(buffer):
+    """
+    Deserializes a state_dict serialized with serialize_state_dict() without
+    copying the tensor data. The tensors share their memory with the buffer,
+    so they must be treated as read-only if the buffer is, and must not be
+    used after the buffer is released (e.g. a memory map is closed).
+
+    Parameters
+    ----------
+
+    buffer: bytes-like object
+        The serialized state_dict.
+
+    Returns
+    -------
+
+    OrderedDict, dict:
+        The state_dict and the metadata stored with it.
+    """
+    view = memoryview(buffer)
+    if len(view) < _PREFIX.size:
+        raise ValueError("Buffer too short to be a tensor container.")
+    magic, header_size = _PREFIX.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError("Buffer is not a tensor container.")
+    header = msgpack.unpackb(view[_PREFIX.size:_PREFIX.size + header_size])
+    data_start = _aligned(_PREFIX.size + header_size)
+
+    state_dict = OrderedDict()
+    with warnings.catch_warnings():
+        # tensors on read-only buffers (e.g. bytes) are expected.
+        warnings.simplefilter('ignore', UserWarning)
+        for key, dtype_name, shape, offset in header[TENSORS_KEY]:
+            np_dtype = _DTYPES[dtype_name][1]
+            count = int(np.prod(shape, dtype=np.int64))
+            val = np.frombuffer(view, dtype=np_dtype, count=count, offset=data_start + offset)
+            state_dict[key] = torch.from_numpy(val.reshape(shape))
+    return state_dict, header[METADATA_KEY]
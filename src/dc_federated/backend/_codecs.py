@@ -0,0 +1,394 @@
+"""
+The registry of the compression codecs used for the worker updates and the
+global models exchanged between the DCFServer and the DCFWorker.
+
+The codecs available are 'none', 'zlib' and 'lzma', plus 'zstd' and 'lz4'
+when the zstandard and lz4 packages are installed. Each of them is also
+available with a byte-shuffle pre-filter, as e.g. 'zlib+shuffle', which
+groups together the bytes of the same significance of consecutive 4 byte
+words before compressing. For float32 tensors this puts the exponent bytes
+next to each other, which compresses much better than the raw floats.
+"""
+import io
+import lzma
+import zlib
+
+import numpy as np
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=logging.INFO)
+
+DEFAULT_CODEC = 'zlib'
+SHUFFLE_SUFFIX = '+shuffle'
+
+
+class Codec(object):
+    """
+    Interface for a compression codec.
+
+    Parameters
+    ----------
+
+    name: str
+        The name of the codec, used to select it.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def compress(self, data):
+        """
+        Compresses the data.
+
+        Parameters
+        ----------
+
+        data: bytes-like object
+            The data to compress.
+
+        Returns
+        -------
+
+        bytes:
+            The compressed data.
+        """
+        raise NotImplementedError()
+
+    def reader(self, src):
+        """
+        Returns a file-like object from which the data decompressed from src
+        can be read a bounded number of bytes at a time.
+
+        Parameters
+        ----------
+
+        src: file-like object
+            The file to read the compressed data from.
+
+        Returns
+        -------
+
+        file-like object:
+            The reader, with a read(size) method that returns b'' at the end
+            of the compressed data.
+        """
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        """
+        Decompresses the data.
+
+        Parameters
+        ----------
+
+        data: bytes-like object
+            The data to decompress.
+
+        Returns
+        -------
+
+        bytes:
+            The decompressed data.
+        """
+        return self.reader(io.BytesIO(data)).read()
+
+
+class NoCodec(Codec):
+    """
+    Leaves the data uncompressed, for fast networks where compressing costs
+    more time than it saves.
+    """
+    def __init__(self):
+        super().__init__('none')
+
+    def compress(self, data):
+        return bytes(data)
+
+    def reader(self, src):
+        return src
+
+
+class ZlibReader(object):
+    """
+    File-like object that decompresses a zlib stream from src, never
+    decompressing more than the requested number of bytes at a time.
+
+    Parameters
+    ----------
+
+    src: file-like object
+        The file to read the compressed data from.
+
+    chunk_size: int (default 1MB)
+        The number of compressed bytes read from src at a time.
+    """
+    def __init__(self, src, chunk_size=2 ** 20):
+        self.src = src
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj()
+        self.pending = b''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(self.chunk_size), b''))
+        while not self.decompressor.eof:
+            if len(self.pending) == 0:
+                self.pending = self.src.read(self.chunk_size)
+                if len(self.pending) == 0:
+                    raise zlib.error("Incomplete or truncated compressed data.")
+            data = self.decompressor.decompress(self.pending, size)
+            self.pending = self.decompressor.unconsumed_tail
+            if len(data) > 0:
+                return data
+        return b''
+
+
+class ZlibCodec(Codec):
+    """
+    zlib at the given compression level.
+
+    Parameters
+    ----------
+
+    level: int (default -1)
+        The compression level - the zlib default if -1.
+    """
+    def __init__(self, level=-1):
+        super().__init__('zlib')
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def reader(self, src):
+        return ZlibReader(src)
+
+
+class LZMACodec(Codec):
+    """
+    lzma (xz), which compresses better but more slowly than zlib.
+
+    Parameters
+    ----------
+
+    preset: int (default 1)
+        The compression preset, from 0 (fastest) to 9 (smallest).
+    """
+    def __init__(self, preset=1):
+        super().__init__('lzma')
+        self.preset = preset
+
+    def compress(self, data):
+        return lzma.compress(data, preset=self.preset)
+
+    def reader(self, src):
+        return lzma.LZMAFile(src, 'rb')
+
+
+class ZstdCodec(Codec):
+    """
+    Zstandard, which compresses about as well as zlib but much faster.
+    Requires the zstandard package.
+
+    Parameters
+    ----------
+
+    level: int (default 3)
+        The compression level.
+    """
+    def __init__(self, level=3):
+        super().__init__('zstd')
+        import zstandard
+        self.zstandard = zstandard
+        self.level = level
+
+    def compress(self, data):
+        return self.zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def reader(self, src):
+        return self.zstandard.ZstdDecompressor().stream_reader(src, read_across_frames=True)
+
+
+class LZ4Codec(Codec):
+    """
+    LZ4 frames, the fastest of the codecs with the least compression.
+    Requires the lz4 package.
+    """
+    def __init__(self):
+        super().__init__('lz4')
+        import lz4.frame
+        self.lz4_frame = lz4.frame
+
+    def compress(self, data):
+        return self.lz4_frame.compress(data)
+
+    def reader(self, src):
+        return self.lz4_frame.LZ4FrameFile(src, 'rb')
+
+
+def shuffle(data, typesize, block_size, inverse=False):
+    """
+    Byte-shuffles the data in independent blocks: each block is seen as a
+    sequence of words of typesize bytes, and rearranged so that the first
+    bytes of all the words come first, then the second bytes and so on.
+    Any trailing bytes that do not make a whole word are left in place.
+
+    Parameters
+    ----------
+
+    data: bytes-like object
+        The data to shuffle.
+
+    typesize: int
+        The size of the words in bytes.
+
+    block_size: int
+        The size of the blocks - a multiple of typesize.
+
+    inverse: bool (default False)
+        Whether to undo the shuffle instead.
+
+    Returns
+    -------
+
+    bytes:
+        The shuffled data.
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    out = np.empty_like(data)
+    for start in range(0, len(data), block_size):
+        block = data[start:start + block_size]
+        num_words = len(block) // typesize
+        words_end = num_words * typesize
+        if inverse:
+            out[start:start + words_end] = block[:words_end].reshape(typesize, num_words).T.reshape(-1)
+        else:
+            out[start:start + words_end] = block[:words_end].reshape(num_words, typesize).T.reshape(-1)
+        out[start + words_end:start + len(block)] = block[words_end:]
+    return out.tobytes()
+
+
+class UnshuffleReader(object):
+    """
+    File-like object that undoes the shuffle of the data read from src, a
+    block at a time.
+
+    Parameters
+    ----------
+
+    src: file-like object
+        The reader of the shuffled data.
+
+    typesize: int
+        The size of the shuffled words in bytes.
+
+    block_size: int
+        The size of the shuffled blocks.
+    """
+    def __init__(self, src, typesize, block_size):
+        self.src = src
+        self.typesize = typesize
+        self.block_size = block_size
+        self.pending = memoryview(b'')
+
+    def read_block(self):
+        chunks = []
+        size = 0
+        while size < self.block_size:
+            data = self.src.read(self.block_size - size)
+            if len(data) == 0:
+                break
+            chunks.append(data)
+            size += len(data)
+        return shuffle(b''.join(chunks), self.typesize, self.block_size, inverse=True)
+
+    def read(self, size=-1):
+        if len(self.pending) == 0:
+            self.pending = memoryview(self.read_block())
+        if size is None or size < 0:
+            data = [bytes(self.pending)]
+            data.extend(iter(self.read_block, b''))
+            self.pending = memoryview(b'')
+            return b''.join(data)
+        data, self.pending = bytes(self.pending[:size]), self.pending[size:]
+        return data
+
+
+class ShuffleCodec(Codec):
+    """
+    Byte-shuffles the data before compressing it with another codec - see
+    shuffle().
+
+    Parameters
+    ----------
+
+    codec: Codec
+        The codec to compress the shuffled data with.
+
+    typesize: int (default 4)
+        The size of the words to shuffle, e.g. 4 for float32 tensors.
+
+    block_size: int (default 1MB)
+        The size of the blocks shuffled independently, so that the data can
+        be decompressed and unshuffled as a stream.
+    """
+    def __init__(self, codec, typesize=4, block_size=2 ** 20):
+        super().__init__(codec.name + SHUFFLE_SUFFIX)
+        self.codec = codec
+        self.typesize = typesize
+        self.block_size = block_size
+
+    def compress(self, data):
+        return self.codec.compress(shuffle(data, self.typesize, self.block_size))
+
+    def reader(self, src):
+        return UnshuffleReader(self.codec.reader(src), self.typesize, self.block_size)
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """
+    Adds the codec, and the codec with the byte-shuffle pre-filter, to the
+    registry of codecs.
+
+    Parameters
+    ----------
+
+    codec: Codec
+        The codec to add.
+    """
+    CODECS[codec.name] = codec
+    CODECS[codec.name + SHUFFLE_SUFFIX] = ShuffleCodec(codec)
+
+
+def get_codec(name):
+    """
+    Returns the registered codec with the given name.
+
+    Parameters
+    ----------
+
+    name: str
+        The name of the codec.
+
+    Returns
+    -------
+
+    Codec:
+        The codec.
+    """
+    if name not in CODECS:
+        error_str = f"Unknown codec {name} - expected one of {list(CODECS.keys())}."
+        logger.error(error_str)
+        raise ValueError(error_str)
+    return CODECS[name]
+
+
+for _codec_class in [NoCodec, ZlibCodec, LZMACodec, ZstdCodec, LZ4Codec]:
+    try:
+        register_codec(_codec_class())
+    except ImportError:
+        logger.info(f"{_codec_class.__name__} is not available - the package it requires is not installed.")
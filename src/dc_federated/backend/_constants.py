@@ -5,16 +5,28 @@ Some constants to be used by classes in dc_federated.
 REGISTER_WORKER_ROUTE = 'register_worker'
 RETURN_GLOBAL_MODEL_ROUTE = 'return_global_model'
 NOTIFY_ME_IF_GM_VERSION_UPDATED_ROUTE = 'notify_me_if_gm_version_updated'
+NOTIFY_AND_RETURN_GLOBAL_MODEL_ROUTE = 'notify_and_return_global_model'
 QUERY_GLOBAL_MODEL_STATUS_ROUTE = 'query_global_model_status'
 RECEIVE_WORKER_UPDATE_ROUTE = 'receive_worker_update'
+RECEIVE_WORKER_UPDATE_STREAM_ROUTE = 'receive_worker_update_stream'
 WORKERS_ROUTE = 'workers'
 CHALLENGE_PHRASE_ROUTE = 'challenge_phrase'
+SESSION_TOKEN_ROUTE = 'session_token'
+
+FORWARD_ROUTE = 'forward'
+UNREGISTER_WORKER_ROUTE = 'unregister_worker'
+CHECK_UPDATE_METADATA_ROUTE = 'check_update_metadata'
+IS_WORKER_SELECTED_ROUTE = 'is_worker_selected'
 
 WORKER_ID_KEY = 'worker_id'
 WORKER_MODEL_UPDATE_KEY = 'worker_model_update'
+UPDATE_METADATA_KEY = 'update_metadata'
+UPDATE_CODEC_KEY = 'update_codec'
 LAST_WORKER_MODEL_VERSION = 'last_worker_model_version'
 GLOBAL_MODEL_VERSION = 'global_model_version'
 GLOBAL_MODEL = 'global_model'
+GLOBAL_MODEL_BASE_VERSION = 'global_model_base_version'
+GLOBAL_MODEL_FORMAT = 'global_model_format'
 GLOBAL_MODEL_UPDATED_STRING = 'Global model has been updated'
 
 WORKER_AUTHENTICATION_PHRASE = b'Please authenticate me'
@@ -22,9 +34,18 @@ NO_AUTHENTICATION = 'No Authentication'
 AUTHENTICATED = 'Authenticated'
 INVALID_WORKER = "Invalid Worker"
 UNREGISTERED_WORKER = 'Unregistered Worker'
+UPDATE_REJECTED = 'Update Rejected'
 
 PUBLIC_KEY_STR = 'public_key_str'
 SIGNED_PHRASE = 'signed_phrase'
+REQUEST_TIMESTAMP = 'request_timestamp'
+REQUEST_NONCE = 'request_nonce'
+SESSION_TOKEN = 'session_token'
+SESSION_TOKEN_EXPIRY = 'session_token_expiry'
+UPDATE_AUTH_KEYS = [SIGNED_PHRASE, REQUEST_TIMESTAMP, REQUEST_NONCE, SESSION_TOKEN]
+UPDATE_HEADER_PREFIX = 'X-DCF-'
+CODEC_KEY = 'codec'
+FORWARD_TOKEN_KEY = 'forward_token'
 
 REGISTRATION_STATUS_KEY = 'registered'
 
@@ -35,3 +56,5 @@ ERROR_MESSAGE_KEY = 'error'
 SUCCESS_MESSAGE_KEY = 'success'
 
 WID_LEN = 8
+SESSION_TOKEN_RENEWAL_MARGIN = 30
+SHARED_STATE_POLL_INTERVAL = 0.1
@@ -0,0 +1,103 @@
+"""
+The cache of the serialized global models for the DCFServer class.
+"""
+from collections import OrderedDict
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=logging.INFO)
+
+
+class GlobalModelCache(object):
+    """
+    Holds the final wire bytes (i.e. serialized and compressed) of the
+    global model, keyed by the global model version, so that the global
+    model is serialized only once per version no matter how many workers
+    ask for it. Each version may have several variants (for instance
+    different encodings of the same model), all of which are evicted as soon
+    as a different version is added. Within the current version, the least
+    recently used variants are evicted to keep within the memory budget.
+
+    Parameters
+    ----------
+
+    max_size_bytes: int
+        The memory budget in bytes for the cached models. Entries larger than
+        this are never cached.
+    """
+    def __init__(self, max_size_bytes):
+        self.max_size_bytes = max_size_bytes
+        self.latest_version = None
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+
+    def get(self, version, variant=None):
+        """
+        Returns the cached bytes for the given version and variant.
+
+        Parameters
+        ----------
+
+        version: object
+            The global model version.
+
+        variant: hashable (default None)
+            The variant of the model for the version.
+
+        Returns
+        -------
+
+        bytes or None:
+            The cached bytes, or None if they are not in the cache.
+        """
+        key = (version, variant)
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, version, data, variant=None):
+        """
+        Adds the bytes for the given version and variant to the cache,
+        evicting the entries for all the other versions and then the least
+        recently used variants of this version as needed.
+
+        Parameters
+        ----------
+
+        version: object
+            The global model version.
+
+        data: bytes
+            The serialized model to cache.
+
+        variant: hashable (default None)
+            The variant of the model for the version.
+        """
+        if version != self.latest_version:
+            self.clear()
+            self.latest_version = version
+
+        key = (version, variant)
+        if key in self.entries:
+            self.size_bytes -= len(self.entries.pop(key))
+
+        if len(data) > self.max_size_bytes:
+            logger.warning(f"Global model of {len(data)} bytes is larger than the cache size of "
+                           f"{self.max_size_bytes} bytes - it will not be cached.")
+            return
+
+        while self.size_bytes + len(data) > self.max_size_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size_bytes -= len(evicted)
+
+        self.entries[key] = data
+        self.size_bytes += len(data)
+
+    def clear(self):
+        """
+        Removes everything from the cache.
+        """
+        self.entries.clear()
+        self.size_bytes = 0
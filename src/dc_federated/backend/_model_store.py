@@ -0,0 +1,297 @@
+"""
+The on-disk store of the serialized global models for the DCFServer class.
+"""
+import os
+import time
+import uuid
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+import msgpack
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=logging.INFO)
+
+
+class GlobalModelStore(object):
+    """
+    Keeps the final wire bytes (i.e. serialized and compressed) of the
+    published global model versions on disk, so that they can be sent to
+    the workers straight from the file - with sendfile where the server
+    supports it - and be read back for older versions. Each file is named
+    by the SHA-256 of its bytes, so identical models are stored once, and
+    an index maps each version and variant (see GlobalModelCache) to its
+    file. The versions are namespaced by session: a server run starts a
+    new one, since the versions of the algorithm, e.g. FedAvg, start over
+    when it is restarted and would otherwise match the models of the
+    previous run. The versions beyond the max_versions most recent ones,
+    of any session, and those older than max_age seconds, are removed
+    along with the files no other version uses. The index is re-read when
+    another process has changed it, so that the HTTP worker processes of a
+    multi-process server can serve the models stored by the primary
+    process.
+
+    Parameters
+    ----------
+
+    path: str
+        The directory of the store, created if needed.
+
+    max_versions: int (default 10)
+        The number of most recent versions to keep.
+
+    max_age: float (default None)
+        If given, the number of seconds after which a version is removed.
+        The latest version of the session is never removed.
+
+    session: str (default None)
+        The session to read and write the versions of, e.g. to open the
+        store of a running server from another process. A new session is
+        started if None.
+    """
+    def __init__(self, path, max_versions=10, max_age=None, session=None):
+        self.path = path
+        self.objects_path = os.path.join(path, 'objects')
+        self.index_path = os.path.join(path, 'index.msgpack')
+        self.max_versions = max_versions
+        self.max_age = max_age
+        self.session = uuid.uuid4().hex if session is None else session
+        os.makedirs(self.objects_path, exist_ok=True)
+
+        # the latest version of each session, the digest of each (session,
+        # version, variant) and the time each (session, version) was first
+        # stored, in the order they were stored, by packed key.
+        self.latest_versions = {}
+        self.entries = {}
+        self.versions = OrderedDict()
+        self.index_mtime = None
+        self.refresh()
+
+    @property
+    def latest_version(self):
+        """
+        The version last stored in the session, or None.
+        """
+        return self.latest_versions.get(self.session)
+
+    def version_key(self, version):
+        return msgpack.packb([self.session, version])
+
+    def entry_key(self, version, variant):
+        return msgpack.packb([self.session, version, variant])
+
+    def refresh(self):
+        """
+        Reads the index from disk if it was changed since it was last read.
+        """
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.index_mtime:
+            return
+        with open(self.index_path, 'rb') as f:
+            index = msgpack.unpackb(f.read())
+        self.latest_versions = dict(index['latest_versions'])
+        self.versions = OrderedDict((msgpack.packb([session, version]), created)
+                                    for session, version, created in index['versions'])
+        self.entries = {msgpack.packb([session, version, variant]): digest
+                        for session, version, variant, digest in index['entries']}
+        self.index_mtime = mtime
+
+    def save_index(self):
+        """
+        Writes the index to disk, replacing the previous one atomically.
+        """
+        index = {
+            'latest_versions': list(self.latest_versions.items()),
+            'versions': [msgpack.unpackb(version) + [created] for version, created in self.versions.items()],
+            'entries': [msgpack.unpackb(key) + [digest] for key, digest in self.entries.items()]
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(msgpack.packb(index))
+        os.replace(tmp_path, self.index_path)
+        self.index_mtime = os.stat(self.index_path).st_mtime_ns
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_path, digest)
+
+    def write_object(self, data):
+        """
+        Writes the bytes to the file named by their digest, unless it already
+        exists. This does not change the index, so it can be run in a thread.
+
+        Parameters
+        ----------
+
+        data: bytes
+            The serialized model.
+
+        Returns
+        -------
+
+        str:
+            The hex SHA-256 digest of the bytes.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            fd, tmp_path = tempfile.mkstemp(dir=self.objects_path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def add(self, version, digest, variant=None):
+        """
+        Records the object with the given digest, written by write_object(),
+        as the bytes of the given version and variant, which becomes the
+        latest version of the session, and removes the versions beyond max_versions or
+        older than max_age.
+
+        Parameters
+        ----------
+
+        version: object
+            The global model version - any msgpack serializable value.
+
+        digest: str
+            The digest returned by write_object().
+
+        variant: object (default None)
+            The variant of the model for the version.
+        """
+        self.refresh()
+        packed_version = self.version_key(version)
+        if packed_version not in self.versions:
+            self.versions[packed_version] = time.time()
+        self.latest_versions[self.session] = version
+        self.entries[self.entry_key(version, variant)] = digest
+        self.collect_garbage()
+        self.save_index()
+
+    def put(self, version, data, variant=None):
+        """
+        Stores the bytes for the given version and variant.
+
+        Parameters
+        ----------
+
+        version: object
+            The global model version.
+
+        data: bytes
+            The serialized model.
+
+        variant: object (default None)
+            The variant of the model for the version.
+        """
+        self.add(version, self.write_object(data), variant)
+
+    def collect_garbage(self):
+        """
+        Removes the versions beyond the max_versions most recent ones and
+        those older than max_age, other than the latest version of the
+        session, and then the files that are no longer used.
+        """
+        latest_version = self.version_key(self.latest_version)
+        now = time.time()
+        removed_versions = set()
+        for n, (version, created) in enumerate(self.versions.items()):
+            if version == latest_version:
+                continue
+            if len(self.versions) - n > self.max_versions or \
+                    (self.max_age is not None and now - created > self.max_age):
+                removed_versions.add(version)
+        if not removed_versions:
+            return
+
+        for version in removed_versions:
+            del self.versions[version]
+        remaining_sessions = {msgpack.unpackb(version)[0] for version in self.versions}
+        self.latest_versions = {session: version for session, version in self.latest_versions.items()
+                                if session in remaining_sessions}
+        removed_digests = set()
+        for key in list(self.entries):
+            if msgpack.packb(msgpack.unpackb(key)[:2]) in removed_versions:
+                removed_digests.add(self.entries.pop(key))
+        for digest in removed_digests - set(self.entries.values()):
+            try:
+                os.remove(self.object_path(digest))
+            except FileNotFoundError:
+                pass
+        logger.info(f"Removed {len(removed_versions)} global model versions from the model store.")
+
+    def get_versions(self):
+        """
+        Returns the stored versions of the session, from the oldest to the
+        latest.
+
+        Returns
+        -------
+
+        list:
+            The versions.
+        """
+        self.refresh()
+        versions = [msgpack.unpackb(version) for version in self.versions]
+        return [version for session, version in versions if session == self.session]
+
+    def open(self, version, variant=None):
+        """
+        Opens the file holding the bytes for the given version and variant.
+
+        Parameters
+        ----------
+
+        version: object
+            The global model version.
+
+        variant: object (default None)
+            The variant of the model for the version.
+
+        Returns
+        -------
+
+        file or None:
+            The file opened for reading in binary mode, which the caller must
+            close, or None if the version and variant are not stored.
+        """
+        self.refresh()
+        digest = self.entries.get(self.entry_key(version, variant))
+        if digest is None:
+            return None
+        try:
+            return open(self.object_path(digest), 'rb')
+        except FileNotFoundError:
+            # removed by another process since the index was read
+            return None
+
+    def get(self, version, variant=None):
+        """
+        Returns the bytes for the given version and variant.
+
+        Parameters
+        ----------
+
+        version: object
+            The global model version.
+
+        variant: object (default None)
+            The variant of the model for the version.
+
+        Returns
+        -------
+
+        bytes or None:
+            The bytes, or None if the version and variant are not stored.
+        """
+        model_file = self.open(version, variant)
+        if model_file is None:
+            return None
+        with model_file:
+            return model_file.read()
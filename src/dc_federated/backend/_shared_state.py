@@ -0,0 +1,327 @@
+"""
+The state shared between the processes of a multi-process DCFServer.
+"""
+import os
+import sqlite3
+from collections.abc import MutableMapping
+
+import msgpack
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=logging.INFO)
+
+
+class SharedServerState(object):
+    """
+    Holds the state that the HTTP worker processes of a multi-process
+    DCFServer must agree on, in an SQLite database in write-ahead-log mode
+    on the local disk: the allowed workers with their registration and
+    challenge state, the nonces of the recent signed requests, the version
+    of the global model published by the primary process and the bytes
+    of the global model it serialized for that version. Each process opens
+    its own connection to the database, and each operation is a single
+    transaction, so that e.g. a challenge phrase or a nonce can only be
+    used once across all the processes.
+
+    Parameters
+    ----------
+
+    path: str
+        The location of the database.
+
+    busy_timeout: int (default 10000)
+        The number of milliseconds to wait for a lock held by another
+        process before failing.
+
+    clear: bool (default True)
+        Whether to discard any state from a previous session, or to open
+        the state of a running server.
+    """
+    def __init__(self, path, busy_timeout=10000, clear=True):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.pid = None
+        self.inherited_conns = []
+        if not clear:
+            return
+        with self.conn:
+            self.conn.execute("DROP TABLE IF EXISTS workers")
+            self.conn.execute("DROP TABLE IF EXISTS nonces")
+            self.conn.execute("DROP TABLE IF EXISTS settings")
+            self.conn.execute("DROP TABLE IF EXISTS models")
+            self.conn.execute("CREATE TABLE workers (worker_id TEXT PRIMARY KEY, registered INTEGER, "
+                              "challenge_phrase TEXT, last_seen REAL)")
+            self.conn.execute("CREATE TABLE nonces (worker_id TEXT, nonce TEXT, received REAL, "
+                              "PRIMARY KEY (worker_id, nonce))")
+            self.conn.execute("CREATE INDEX nonces_received ON nonces (received)")
+            self.conn.execute("CREATE TABLE settings (key TEXT PRIMARY KEY, value BLOB)")
+            self.conn.execute("CREATE TABLE models (variant BLOB PRIMARY KEY, version BLOB, data BLOB)")
+
+    @property
+    def conn(self):
+        """
+        The connection to the database for the current process.
+
+        Returns
+        -------
+
+        sqlite3.Connection:
+            The connection, opened when first used in the process.
+        """
+        if self.pid != os.getpid():
+            if self.pid is not None:
+                # the connection of the parent process is kept, but never
+                # used or closed, so that its state is left untouched.
+                self.inherited_conns.append(self._conn)
+            self._conn = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000,
+                                         check_same_thread=False)
+            self._conn.execute(f"PRAGMA busy_timeout={self.busy_timeout}")
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self.pid = os.getpid()
+        return self._conn
+
+    def claim_nonce(self, worker_id, nonce, now, window):
+        """
+        Records the nonce of a signed request from the worker, unless it was
+        already recorded, forgetting the nonces received more than window
+        seconds ago.
+
+        Parameters
+        ----------
+
+        worker_id: str
+            The id of the worker.
+
+        nonce: str
+            The nonce of the request.
+
+        now: float
+            The time the request was received.
+
+        window: float
+            The number of seconds for which the nonces are remembered.
+
+        Returns
+        -------
+
+        bool:
+            True if the nonce was recorded, False if it was already used.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM nonces WHERE received < ?", (now - window,))
+            cursor = self.conn.execute("INSERT OR IGNORE INTO nonces (worker_id, nonce, received) "
+                                       "VALUES (?, ?, ?)", (worker_id, nonce, now))
+        return cursor.rowcount > 0
+
+    def release_nonce(self, worker_id, nonce):
+        """
+        Forgets the nonce, so that a request that failed authentication does
+        not use it up.
+
+        Parameters
+        ----------
+
+        worker_id: str
+            The id of the worker.
+
+        nonce: str
+            The nonce of the request.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM nonces WHERE worker_id = ? AND nonce = ?", (worker_id, nonce))
+
+    def get_global_model_version(self):
+        """
+        Returns the version of the global model last published by the
+        primary process.
+
+        Returns
+        -------
+
+        object:
+            The version, or None if no version was published yet.
+        """
+        row = self.conn.execute("SELECT value FROM settings WHERE key = 'global_model_version'").fetchone()
+        return None if row is None else msgpack.unpackb(row[0])
+
+    def set_global_model_version(self, version):
+        """
+        Publishes the version of the global model, forgetting the bytes of
+        the models of the other versions.
+
+        Parameters
+        ----------
+
+        version: object
+            The version of the global model - any msgpack serializable value.
+        """
+        packed_version = msgpack.packb(version)
+        with self.conn:
+            self.conn.execute("DELETE FROM models WHERE version != ?", (packed_version,))
+            self.conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('global_model_version', ?)",
+                              (packed_version,))
+
+    def get_global_model_bytes(self, version, variant=None):
+        """
+        Returns the bytes of the global model of the given version and
+        variant - see GlobalModelCache - if the primary process stored them.
+
+        Parameters
+        ----------
+
+        version: object
+            The version of the global model.
+
+        variant: object (default None)
+            The variant of the model - any msgpack serializable value.
+
+        Returns
+        -------
+
+        bytes or None:
+            The bytes, or None if they are not stored.
+        """
+        row = self.conn.execute("SELECT data FROM models WHERE variant = ? AND version = ?",
+                                (msgpack.packb(variant), msgpack.packb(version))).fetchone()
+        return None if row is None else row[0]
+
+    def put_global_model_bytes(self, version, data, variant=None):
+        """
+        Stores the bytes of the global model of the given version and variant.
+
+        Parameters
+        ----------
+
+        version: object
+            The version of the global model.
+
+        data: bytes
+            The serialized model.
+
+        variant: object (default None)
+            The variant of the model.
+        """
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO models (variant, version, data) VALUES (?, ?, ?)",
+                              (msgpack.packb(variant), msgpack.packb(version), data))
+
+
+class SharedWorkerRecord(object):
+    """
+    A WorkerRecord whose state is read from and written to the
+    SharedServerState, so that it is the same in all the processes.
+
+    Parameters
+    ----------
+
+    shared_state: SharedServerState
+        The shared state.
+
+    worker_id: str
+        The id of the worker.
+    """
+    def __init__(self, shared_state, worker_id):
+        self.shared_state = shared_state
+        self.worker_id = worker_id
+
+    def get_field(self, field):
+        row = self.shared_state.conn.execute(f"SELECT {field} FROM workers WHERE worker_id = ?",
+                                             (self.worker_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_field(self, field, value):
+        with self.shared_state.conn as conn:
+            conn.execute(f"UPDATE workers SET {field} = ? WHERE worker_id = ?", (value, self.worker_id))
+
+    @property
+    def registered(self):
+        return bool(self.get_field('registered'))
+
+    @registered.setter
+    def registered(self, registered):
+        self.set_field('registered', int(registered))
+
+    @property
+    def challenge_phrase(self):
+        return self.get_field('challenge_phrase')
+
+    @challenge_phrase.setter
+    def challenge_phrase(self, challenge_phrase):
+        self.set_field('challenge_phrase', challenge_phrase)
+
+    @property
+    def last_seen(self):
+        return self.get_field('last_seen')
+
+    @last_seen.setter
+    def last_seen(self, last_seen):
+        self.set_field('last_seen', last_seen)
+
+    def pop_challenge_phrase(self):
+        """
+        Returns the challenge phrase and clears it in one transaction, so
+        that it can only be used once across all the processes.
+
+        Returns
+        -------
+
+        str or None:
+            The challenge phrase.
+        """
+        conn = self.shared_state.conn
+        with conn:
+            # an immediate transaction takes the write lock before reading
+            conn.execute("BEGIN IMMEDIATE")
+            challenge_phrase = self.challenge_phrase
+            conn.execute("UPDATE workers SET challenge_phrase = NULL WHERE worker_id = ?", (self.worker_id,))
+        return challenge_phrase
+
+
+class SharedWorkerRecords(MutableMapping):
+    """
+    The mapping from the worker ids to the SharedWorkerRecord of each of the
+    allowed workers, stored in the SharedServerState, used by the
+    WorkerManager in place of a dict.
+
+    Parameters
+    ----------
+
+    shared_state: SharedServerState
+        The shared state.
+    """
+    def __init__(self, shared_state):
+        self.shared_state = shared_state
+
+    def __getitem__(self, worker_id):
+        if worker_id not in self:
+            raise KeyError(worker_id)
+        return SharedWorkerRecord(self.shared_state, worker_id)
+
+    def __setitem__(self, worker_id, record):
+        with self.shared_state.conn as conn:
+            conn.execute("INSERT OR REPLACE INTO workers (worker_id, registered, challenge_phrase, last_seen) "
+                         "VALUES (?, ?, ?, ?)",
+                         (worker_id, int(record.registered), record.challenge_phrase, record.last_seen))
+
+    def __delitem__(self, worker_id):
+        with self.shared_state.conn as conn:
+            cursor = conn.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+        if cursor.rowcount == 0:
+            raise KeyError(worker_id)
+
+    def __contains__(self, worker_id):
+        return self.shared_state.conn.execute(
+            "SELECT 1 FROM workers WHERE worker_id = ?", (worker_id,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter([row[0] for row in self.shared_state.conn.execute("SELECT worker_id FROM workers")])
+
+    def __len__(self):
+        return self.shared_state.conn.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+
+    def items(self):
+        return [(worker_id, SharedWorkerRecord(self.shared_state, worker_id))
+                for worker_id, in self.shared_state.conn.execute("SELECT worker_id FROM workers")]
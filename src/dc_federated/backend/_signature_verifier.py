@@ -0,0 +1,137 @@
+"""
+The verifier of the workers' signatures for the WorkerManager class, which
+coalesces the verifications into fewer thread pool dispatches.
+"""
+import gevent
+from gevent.event import AsyncResult
+from nacl.encoding import HexEncoder
+
+from dc_federated.backend.backend_utils import run_in_pool
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=logging.INFO)
+
+
+def verify_signatures(signatures):
+    """
+    Verifies a batch of signatures, each exactly once. libsodium has no
+    batch verification primitive, so the CPU cost per signature is the same
+    as verifying it on its own - the batch only saves the cost of
+    dispatching each check to the thread pool separately.
+
+    Parameters
+    ----------
+
+    signatures: list of (nacl.signing.VerifyKey, str)
+        The verify key and the hex encoded signed message of each signature.
+
+    Returns
+    -------
+
+    list:
+        For each signature, either the message if the signature is valid,
+        or the exception raised when verifying it.
+    """
+    results = []
+    for verify_key, signed_message in signatures:
+        try:
+            results.append(verify_key.verify(signed_message.encode(), encoder=HexEncoder))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class BatchSignatureVerifier(object):
+    """
+    Coalesces the signatures to verify into fewer calls to the pool, so that
+    bursts of worker requests, e.g. when many workers send their updates at
+    the same time, are not verified one pool dispatch at a time. No delay
+    is added to wait for a batch to fill: the signatures are verified as
+    soon as the hub gets to it, together with those that arrived meanwhile,
+    and those arriving while a batch is being verified form the next one.
+    A request on its own is therefore verified as soon as without batching.
+    Each caller waits only for its own result. This must be used from the
+    greenlets of a single gevent hub.
+
+    Parameters
+    ----------
+
+    cpu_pool: gevent.threadpool.ThreadPool (default None)
+        The pool in which the batches are verified. They are verified
+        directly if None.
+
+    max_batch_size: int (default 64)
+        The maximum number of signatures verified in one call to the pool.
+    """
+    def __init__(self, cpu_pool=None, max_batch_size=64):
+        self.cpu_pool = cpu_pool
+        self.max_batch_size = max_batch_size
+        self.pending = []
+        self.flush_greenlet = None
+
+    def verify(self, verify_key, signed_message):
+        """
+        Verifies the signed message, blocking the calling greenlet until the
+        batch it is in has been verified.
+
+        Parameters
+        ----------
+
+        verify_key: nacl.signing.VerifyKey
+            The key to verify the message with.
+
+        signed_message: str
+            The hex encoded signed message.
+
+        Returns
+        -------
+
+        bytes:
+            The message. Raises nacl.exceptions.BadSignatureError if the
+            signature is invalid.
+        """
+        result = AsyncResult()
+        self.pending.append((verify_key, signed_message, result))
+        if self.flush_greenlet is None:
+            self.flush_greenlet = gevent.spawn(self.flush)
+        return result.get()
+
+    def flush(self):
+        """
+        Greenlet function that verifies the pending signatures, in batches
+        of at most max_batch_size, until there are none left.
+        """
+        try:
+            while len(self.pending) > 0:
+                batch = self.pending[:self.max_batch_size]
+                del self.pending[:self.max_batch_size]
+                self.verify_batch(batch)
+        finally:
+            self.flush_greenlet = None
+
+    def verify_batch(self, batch):
+        """
+        Verifies a batch of pending signatures and passes each result to the
+        greenlet waiting for it.
+
+        Parameters
+        ----------
+
+        batch: list of (nacl.signing.VerifyKey, str, gevent.event.AsyncResult)
+            The verify key, the hex encoded signed message and the result of
+            each signature.
+        """
+        try:
+            results = run_in_pool(self.cpu_pool, verify_signatures,
+                                  [(verify_key, signed_message) for verify_key, signed_message, _ in batch])
+        except Exception as e:
+            logger.error(f"Exception when verifying a batch of {len(batch)} signatures: {str(e)}")
+            results = [e] * len(batch)
+
+        for (_, _, result), val in zip(batch, results):
+            if isinstance(val, Exception):
+                result.set_exception(val)
+            else:
+                result.set(val)
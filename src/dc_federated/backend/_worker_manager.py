@@ -1,30 +1,72 @@
 """
 The worker manager for the DCFServer class.
 """
-import os
 import hashlib
+import hmac
+import secrets
 import time
-import json
+from collections import OrderedDict
 
 from dc_federated.backend._constants import INVALID_WORKER, WORKER_ID_KEY, \
-    REGISTRATION_STATUS_KEY, PUBLIC_KEY_STR, WID_LEN
-from dc_federated.backend.backend_utils import message_seriously_wrong
+    REGISTRATION_STATUS_KEY, WID_LEN
+from dc_federated.backend.backend_utils import message_seriously_wrong, signed_request_message, run_in_pool
+from dc_federated.backend._worker_store import create_worker_store
+from dc_federated.backend._signature_verifier import BatchSignatureVerifier
+from dc_federated.backend._shared_state import SharedWorkerRecords
 from nacl.encoding import HexEncoder
 from nacl.exceptions import BadSignatureError
 from nacl.signing import VerifyKey
 
-from tinydb import TinyDB, Query
-
 import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(level=logging.INFO)
 
 
+class WorkerRecord(object):
+    """
+    The state of an allowed worker.
+
+    Parameters
+    ----------
+
+    registered: bool (default False)
+        Whether the worker is registered.
+
+    challenge_phrase: str (default None)
+        The last challenge phrase sent to the worker, if it has not been
+        verified yet.
+
+    last_seen: float (default None)
+        The time of the last successful authentication of the worker.
+    """
+    __slots__ = ('registered', 'challenge_phrase', 'last_seen')
+
+    def __init__(self, registered=False, challenge_phrase=None, last_seen=None):
+        self.registered = registered
+        self.challenge_phrase = challenge_phrase
+        self.last_seen = last_seen
+
+    def pop_challenge_phrase(self):
+        """
+        Returns the challenge phrase and clears it, so that it can only be
+        used once.
+
+        Returns
+        -------
+
+        str or None:
+            The challenge phrase.
+        """
+        challenge_phrase, self.challenge_phrase = self.challenge_phrase, None
+        return challenge_phrase
+
+
 class WorkerManager(object):
     """
-    Manages workers. It maintains a list of allowed workers and registered workers
-    and provides an interface for adding, removing, registering and authenticating them.
+    Manages workers. It maintains a dictionary of the allowed workers, with the
+    registration and authentication state of each, and provides an interface for
+    adding, removing, registering and authenticating them.
 
     Parameters
     ----------
@@ -47,17 +89,60 @@ class WorkerManager(object):
 
     path_to_keys_db: str
         Path to the database of workers' public keys.
+
+    keys_db_backend: str or WorkerStore (default 'tinydb')
+        The backend for the database of workers' public keys - one of
+        'tinydb' or 'sqlite', or a WorkerStore instance.
+
+    signed_request_window: int (default 300)
+        The number of seconds either side of the server time within which
+        the timestamp of a signed request must fall - see authenticate_request().
+
+    session_token_lifetime: int (default None)
+        The number of seconds for which a session token is valid - see
+        issue_session_token(). Session tokens are disabled if None.
+
+    cpu_pool: gevent.threadpool.ThreadPool (default None)
+        The pool in which signatures are verified, so that the gevent hub
+        is not blocked meanwhile. Signatures are verified directly if None.
+
+    batch_signature_verification: bool (default False)
+        Whether the signatures that arrive together are verified in one call
+        to the cpu_pool - see BatchSignatureVerifier - rather than one call
+        each.
+
+    shared_state: SharedServerState (default None)
+        If given, the worker records and the nonces of the signed requests
+        are kept in this shared state instead of in memory, so that several
+        processes can serve the same workers - see DCFServer num_processes.
     """
     def __init__(self,
                  server_mode_safe,
                  key_list_file,
                  load_last_session_workers=True,
-                 path_to_keys_db='.keys_db.json'):
+                 path_to_keys_db='.keys_db.json',
+                 keys_db_backend='tinydb',
+                 signed_request_window=300,
+                 session_token_lifetime=None,
+                 cpu_pool=None,
+                 batch_signature_verification=False,
+                 shared_state=None):
         self.public_keys = {}
-        self.allowed_workers = []
-        self.registered_workers = {}
+        self.shared_state = shared_state
+        self.workers = {} if shared_state is None else SharedWorkerRecords(shared_state)
         self.public_keys_db = None
-        self.challenge_phrases = {}
+        self.signed_request_window = signed_request_window
+        # the (worker id, nonce) of the recent signed requests, with the
+        # time they were received, in the order they were received.
+        self.request_nonces = OrderedDict()
+        self.session_token_lifetime = session_token_lifetime
+        self.cpu_pool = cpu_pool
+        self.signature_verifier = None
+        if batch_signature_verification:
+            self.signature_verifier = BatchSignatureVerifier(cpu_pool)
+        # the key for the MACs of the session tokens - tokens do not survive
+        # a restart of the server.
+        self.session_token_key = secrets.token_bytes(32)
 
         if not server_mode_safe:
             if key_list_file is not None:
@@ -76,21 +161,31 @@ class WorkerManager(object):
         self.do_public_key_auth = True
         self.public_keys_db = None
 
-        keys_to_load = []
+        db_keys = []
         if load_last_session_workers:
-            keys_to_load = self.init_db(path_to_keys_db)
+            db_keys = self.init_db(path_to_keys_db, keys_db_backend)
 
+        keys_to_load = list(db_keys)
         if key_list_file is not None:
             with open(key_list_file, 'r') as f:
                 keys = f.read().splitlines()
                 keys_to_load.extend(keys)
 
+        # the keys are written to the database in one batch at the end
+        added_keys = []
         for key in set(keys_to_load):
-            _, success = self.add_worker(key)
-            if not success:
+            _, success = self.add_worker(key, persist=False)
+            if success:
+                added_keys.append(key)
+            else:
                 logger.warning(f"Invalid public key {key} - worker not added.")
 
-    def init_db(self, path_to_keys_db):
+        if self.public_keys_db is not None:
+            for key in set(db_keys) - set(added_keys):
+                self.public_keys_db.remove_key(key)
+            self.public_keys_db.add_keys(added_keys)
+
+    def init_db(self, path_to_keys_db, keys_db_backend='tinydb'):
         """
         Initialize the database of public_keys from the existing database,
         if any, and return the list of keys.
@@ -101,32 +196,17 @@ class WorkerManager(object):
         path_to_keys_db: str
             The location of the database of workers.
 
+        keys_db_backend: str or WorkerStore (default 'tinydb')
+            The backend for the database - see WorkerStore.
+
         Returns
         -------
 
         list:
             The list of keys found
         """
-        if not os.path.exists(path_to_keys_db):
-            logger.warning(f"Unable to locate workers database at {path_to_keys_db} - "
-                           f"creating new database.")
-        else:
-            logger.info("Creating a backup keys database...")
-            with open(path_to_keys_db, 'r') as f:
-                data = json.load(f)
-            with open(path_to_keys_db + '.bak', 'w') as f:
-                json.dump(data, f)
-
-            logger.info(f"Backup written to {path_to_keys_db + '.bak'}.")
-
-        self.public_keys_db = TinyDB(path_to_keys_db)
-        docs = self.public_keys_db.all()
-        keys_to_load = [doc[PUBLIC_KEY_STR] for doc in docs]
-
-        # purge db because all the keys will be added later.
-        self.public_keys_db.remove(doc_ids=[doc.doc_id for doc in docs])
-
-        return keys_to_load
+        self.public_keys_db = create_worker_store(keys_db_backend, path_to_keys_db)
+        return self.public_keys_db.get_keys()
 
     def authenticate_and_add_worker(self, public_key_str, signed_phrase):
         """
@@ -152,7 +232,7 @@ class WorkerManager(object):
         else:
             return INVALID_WORKER, False
 
-    def add_worker(self, public_key_str):
+    def add_worker(self, public_key_str, persist=True):
         """
         Adds the worker with the given public key to the list of allowed workers.
         Adds the public key of the worker to the set of public keys if necessary.
@@ -163,6 +243,9 @@ class WorkerManager(object):
         public_key_str: str
             The public key
 
+        persist: bool (default True)
+            Whether to add the public key to the database of workers.
+
         Returns
         -------
 
@@ -173,9 +256,9 @@ class WorkerManager(object):
             if not self.add_public_key(public_key_str):
                 logger.warning(f"Invalid public key (short) {public_key_str[0:WID_LEN]} - worker not added")
                 return INVALID_WORKER, False
-        return self._add_worker(public_key_str)
+        return self._add_worker(public_key_str, persist)
 
-    def _add_worker(self, public_key_str):
+    def _add_worker(self, public_key_str, persist=True):
         """
         Internal function for adding worker to the list of allowed workers.
         Assumes the public key was added prior to calling this function.
@@ -186,6 +269,9 @@ class WorkerManager(object):
         public_key_str: str
             The public key
 
+        persist: bool (default True)
+            Whether to add the public key to the database of workers.
+
         Returns
         -------
 
@@ -197,11 +283,10 @@ class WorkerManager(object):
             err = message_seriously_wrong("trying to add worker without first adding its public key")
             logger.error(err)
             return err, False
-        if worker_id not in self.allowed_workers:
-            self.allowed_workers.append(worker_id)
-            self.registered_workers[worker_id] = False
-            if self.public_keys_db is not None:
-                    self.public_keys_db.insert({PUBLIC_KEY_STR: public_key_str})
+        if worker_id not in self.workers:
+            self.workers[worker_id] = WorkerRecord()
+            if self.public_keys_db is not None and persist:
+                self.public_keys_db.add_key(public_key_str)
             logger.info(
                 f"Successfully added worker with public key (short) {public_key_str[0:WID_LEN]}")
             return worker_id, True
@@ -229,9 +314,9 @@ class WorkerManager(object):
         str:
             The worker id if operation was successful and INVALID_WORKER otherwise.
         """
-        if worker_id in self.allowed_workers:
-            old_status = self.registered_workers[worker_id]
-            self.registered_workers[worker_id] = should_register
+        if worker_id in self.workers:
+            old_status = self.workers[worker_id].registered
+            self.workers[worker_id].registered = should_register
             logger.info(f"Set registration status of worker {worker_id[0:WID_LEN]} from {old_status} to {should_register}.")
             return worker_id
         else:
@@ -255,15 +340,11 @@ class WorkerManager(object):
         str:
             The worker id if operation was successful and INVALID_WORKER otherwise.
         """
-        if worker_id in self.allowed_workers:
-            self.allowed_workers.remove(worker_id)
+        if worker_id in self.workers:
+            del self.workers[worker_id]
             self.delete_public_key(worker_id)
-            if self.public_keys_db is not None:
-                doc_ids = [doc.doc_id
-                           for doc in self.public_keys_db.search(Query()[PUBLIC_KEY_STR] == worker_id)]
-                if len(doc_ids) == 0:
-                    logger.error(f"Worker {worker_id[0:WID_LEN]} not found in workers_db!!!")
-                self.public_keys_db.remove(doc_ids=doc_ids)
+            if self.public_keys_db is not None and not self.public_keys_db.remove_key(worker_id):
+                logger.error(f"Worker {worker_id[0:WID_LEN]} not found in workers_db!!!")
 
             logger.info(f"Worker {worker_id[0:WID_LEN]} was removed - this worker will "
                         f"no longer be allowed to register or participate in federated learning. ")
@@ -386,11 +467,11 @@ class WorkerManager(object):
         str:
             The challenge phrase.
         """
-        if worker_id not in self.allowed_workers:
+        if worker_id not in self.workers:
             return INVALID_WORKER
-        self.challenge_phrases[worker_id] = \
+        self.workers[worker_id].challenge_phrase = \
             hashlib.sha224(str(time.time()).encode('utf-8')).hexdigest()
-        return self.challenge_phrases[worker_id]
+        return self.workers[worker_id].challenge_phrase
 
     def verify_challenge(self, worker_id, signed_challenge):
         """
@@ -414,18 +495,211 @@ class WorkerManager(object):
         """
         if not self.do_public_key_auth:
             return True
-        if worker_id not in self.challenge_phrases:
-            logger.error(f"Worker id {worker_id[0:WID_LEN]} not found in challenge phrases")
+        record = self.workers.get(worker_id)
+        if record is None:
+            logger.error(f"Worker id {worker_id[0:WID_LEN]} not found in allowed workers")
             return False
-        if self.challenge_phrases[worker_id] is None:
+
+        # the phrase is used up before verifying, as other requests may be
+        # served while the signature is verified.
+        challenge_phrase = record.pop_challenge_phrase()
+        if challenge_phrase is None:
             logger.error(f"Challenge phrase for worker id {worker_id[0:WID_LEN]} is None")
             return False
+        return self.authenticate_worker(worker_id, signed_challenge, challenge_phrase.encode())
+
+    def authenticate_request(self, worker_id, route, signed_request, timestamp, nonce, body_digest):
+        """
+        Authenticates a single request from a worker, signed by the worker
+        along with the route, a timestamp, a nonce and the digest of the body
+        of the request, without the need for a challenge phrase. Requests
+        with a timestamp outside signed_request_window of the server time, or
+        with a nonce already used by the worker within the window, are
+        rejected so that requests cannot be replayed.
+
+        Parameters
+        ----------
+
+        worker_id: str
+            The id of the worker.
+
+        route: str
+            The route the request was sent to.
+
+        signed_request: str
+            The hex string of the message signed by the worker - see
+            backend_utils.signed_request_message().
+
+        timestamp: int
+            The time, in seconds since the epoch, at which the request was made.
+
+        nonce: str
+            A random string unique to the request.
+
+        body_digest: bytes
+            The digest of the body of the request.
+
+        Returns
+        -------
+
+        bool:
+            Whether the authentication succeeded or not.
+        """
+        if not self.do_public_key_auth:
+            return True
+
+        now = time.time()
+        try:
+            timestamp = int(timestamp)
+        except (TypeError, ValueError):
+            logger.error(f"Invalid timestamp in request from worker {worker_id[0:WID_LEN]}.")
+            return False
+        if abs(now - timestamp) > self.signed_request_window:
+            logger.error(f"Timestamp of request from worker {worker_id[0:WID_LEN]} is outside the "
+                         f"{self.signed_request_window}s window of the server time.")
+            return False
+
+        # the nonce is claimed before verifying, as other requests may be
+        # served while the signature is verified, and released on failure.
+        # A request can only be replayed while its timestamp is in the window,
+        # i.e. for up to twice the window after it was received.
+        if not self.claim_nonce(worker_id, nonce, now, 2 * self.signed_request_window):
+            logger.error(f"Replayed request from worker {worker_id[0:WID_LEN]} rejected.")
+            return False
+
+        message = signed_request_message(route, worker_id, timestamp, nonce, body_digest)
+        if not self.authenticate_worker(worker_id, signed_request, message):
+            if self.shared_state is None:
+                self.request_nonces.pop((worker_id, nonce), None)
+            else:
+                self.shared_state.release_nonce(worker_id, nonce)
+            return False
+        return True
+
+    def claim_nonce(self, worker_id, nonce, now, window):
+        """
+        Records the nonce of a signed request from the worker, unless it was
+        already used, forgetting the nonces received more than window
+        seconds ago.
+
+        Parameters
+        ----------
+
+        worker_id: str
+            The id of the worker.
+
+        nonce: str
+            The nonce of the request.
+
+        now: float
+            The time the request was received.
+
+        window: float
+            The number of seconds for which the nonces are remembered.
+
+        Returns
+        -------
+
+        bool:
+            True if the nonce was recorded, False if it was already used.
+        """
+        if self.shared_state is not None:
+            return self.shared_state.claim_nonce(worker_id, nonce, now, window)
+        while len(self.request_nonces) > 0 and \
+                next(iter(self.request_nonces.values())) < now - window:
+            self.request_nonces.popitem(last=False)
+        if (worker_id, nonce) in self.request_nonces:
+            return False
+        self.request_nonces[(worker_id, nonce)] = now
+        return True
+
+    def session_token_mac(self, worker_id, expiry):
+        """
+        Returns the MAC of the session token of the worker with the given
+        expiry time.
+
+        Parameters
+        ----------
+
+        worker_id: str
+            The id of the worker.
+
+        expiry: int
+            The time, in seconds since the epoch, at which the token expires.
+
+        Returns
+        -------
+
+        str:
+            The hex string of the MAC.
+        """
+        return hmac.new(self.session_token_key, f"{worker_id}|{expiry}".encode(), hashlib.sha256).hexdigest()
+
+    def issue_session_token(self, worker_id):
+        """
+        Issues a session token for the worker, which must have already been
+        authenticated with its public key. Until the token expires, requests
+        from the worker can be authenticated with verify_session_token(),
+        which only computes a keyed hash, instead of verifying a signature.
+        The token is of the form "<expiry>.<MAC of the worker id and expiry>".
+
+        Parameters
+        ----------
 
-        success = self.authenticate_worker(
-            worker_id, signed_challenge, self.challenge_phrases[worker_id].encode())
-        self.challenge_phrases[worker_id] = None
+        worker_id: str
+            The id of the worker.
+
+        Returns
+        -------
 
-        return success
+        str, int:
+            The token and its expiry time, in seconds since the epoch, or
+            INVALID_WORKER and None if session tokens are disabled or the
+            worker is not allowed.
+        """
+        if self.session_token_lifetime is None or worker_id not in self.workers:
+            return INVALID_WORKER, None
+        expiry = int(time.time()) + self.session_token_lifetime
+        return f"{expiry}.{self.session_token_mac(worker_id, expiry)}", expiry
+
+    def verify_session_token(self, worker_id, session_token):
+        """
+        Verifies that the session token was issued to the worker by this
+        server and has not expired.
+
+        Parameters
+        ----------
+
+        worker_id: str
+            The id of the worker.
+
+        session_token: str
+            The token returned by issue_session_token().
+
+        Returns
+        -------
+
+        bool:
+            Whether the verification succeeded or not.
+        """
+        if not self.do_public_key_auth:
+            return True
+        if self.session_token_lifetime is None or worker_id not in self.workers:
+            return False
+        try:
+            expiry, mac = session_token.split('.')
+            expiry = int(expiry)
+        except (AttributeError, ValueError):
+            logger.error(f"Malformed session token from worker {worker_id[0:WID_LEN]}.")
+            return False
+        if expiry < time.time():
+            logger.warning(f"Expired session token from worker {worker_id[0:WID_LEN]}.")
+            return False
+        if not hmac.compare_digest(mac, self.session_token_mac(worker_id, expiry)):
+            logger.error(f"Invalid session token from worker {worker_id[0:WID_LEN]}.")
+            return False
+        self.set_last_seen(worker_id)
+        return True
 
     def authenticate_worker(self, public_key_str, signed_message, message_to_check=None):
         """
@@ -454,16 +728,21 @@ class WorkerManager(object):
             logger.warning("Accepting worker as valid without authentication.")
             return True
         try:
-            if public_key_str not in self.public_keys:
+            verify_key = self.get_verify_key(public_key_str)
+            if verify_key is None:
                 logger.error(f"Unknown public key (short) {public_key_str[0:WID_LEN]}.")
                 return False
-            v = self.public_keys[public_key_str].verify(
-                signed_message.encode(), encoder=HexEncoder)
+            if self.signature_verifier is not None:
+                v = self.signature_verifier.verify(verify_key, signed_message)
+            else:
+                v = run_in_pool(self.cpu_pool, verify_key.verify,
+                                signed_message.encode(), encoder=HexEncoder)
             if message_to_check is not None:
                 if v != message_to_check:
                     logger.error(f"Message {message_to_check} does not match decrypted message {v}")
                     return False
                 else:
+                    self.set_last_seen(public_key_str)
                     return True
 
         except BadSignatureError:
@@ -476,8 +755,64 @@ class WorkerManager(object):
         else:
             logger.info(
                 f"Successfully authenticated worker with public key (short) {public_key_str[0:WID_LEN]}.")
+            self.set_last_seen(public_key_str)
             return True
 
+    def get_verify_key(self, public_key_str):
+        """
+        Returns the key to verify the signatures of the worker with. With a
+        shared_state, the workers may have been added or removed by another
+        process, so the key is only returned for an allowed worker, and is
+        loaded the first time it is needed.
+
+        Parameters
+        ----------
+
+        public_key_str: str
+            UFT-8 encoded version of the public key
+
+        Returns
+        -------
+
+        nacl.signing.VerifyKey or None:
+            The key, or None if the worker is unknown.
+        """
+        if self.shared_state is not None:
+            if public_key_str not in self.workers:
+                return None
+            if public_key_str not in self.public_keys:
+                self.public_keys[public_key_str] = VerifyKey(public_key_str.encode(), encoder=HexEncoder)
+        return self.public_keys.get(public_key_str)
+
+    def set_last_seen(self, worker_id):
+        """
+        Records the current time as the last time the worker was seen, if
+        it is an allowed worker.
+
+        Parameters
+        ----------
+
+        worker_id: str
+            The id of the worker.
+        """
+        record = self.workers.get(worker_id)
+        if record is not None:
+            record.last_seen = time.time()
+
+    @property
+    def allowed_workers(self):
+        """
+        The ids of the allowed workers, as a view that supports constant time
+        membership tests.
+
+        Returns
+        -------
+
+        dict_keys:
+            The worker ids.
+        """
+        return self.workers.keys()
+
     def get_worker_list(self):
         """
         Returns the list of workers and their registration status.
@@ -489,8 +824,8 @@ class WorkerManager(object):
             Each dictionary has keys WORKER_ID_KEY, REGISTRATION_STATUS_KEY giving the
             values.
         """
-        return [{WORKER_ID_KEY: worker_id, REGISTRATION_STATUS_KEY: value}
-                for worker_id, value in self.registered_workers.items()]
+        return [{WORKER_ID_KEY: worker_id, REGISTRATION_STATUS_KEY: record.registered}
+                for worker_id, record in self.workers.items()]
 
     def is_worker_allowed(self, worker_id):
         """
@@ -503,7 +838,7 @@ class WorkerManager(object):
         bool:
             True if worker is allowed False otherwise.
         """
-        return worker_id in self.allowed_workers
+        return worker_id in self.workers
 
     def is_worker_registered(self, worker_id):
         """
@@ -515,4 +850,5 @@ class WorkerManager(object):
         bool:
             True if worker is allowed False otherwise.
         """
-        return worker_id in self.registered_workers and self.registered_workers[worker_id]
+        record = self.workers.get(worker_id)
+        return record is not None and record.registered
@@ -0,0 +1,241 @@
+"""
+The persistent stores of the public keys of the workers for the WorkerManager
+class.
+"""
+import os
+import json
+import sqlite3
+
+from tinydb import TinyDB, Query
+
+from dc_federated.backend._constants import PUBLIC_KEY_STR
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=logging.INFO)
+
+
+class WorkerStore(object):
+    """
+    Interface for the persistent store of the public keys of the allowed
+    workers, so that they can be loaded in the next session. Subclasses
+    should make adding and removing a key cheap regardless of the number of
+    keys in the store.
+    """
+    def get_keys(self):
+        """
+        Returns the public keys in the store.
+
+        Returns
+        -------
+
+        list of str:
+            The public keys.
+        """
+        raise NotImplementedError()
+
+    def add_keys(self, public_key_strs):
+        """
+        Adds the public keys, ignoring those already in the store, in a
+        single batch.
+
+        Parameters
+        ----------
+
+        public_key_strs: list of str
+            The public keys to add.
+        """
+        raise NotImplementedError()
+
+    def remove_key(self, public_key_str):
+        """
+        Removes the public key from the store.
+
+        Parameters
+        ----------
+
+        public_key_str: str
+            The public key to remove.
+
+        Returns
+        -------
+
+        bool:
+            Whether the key was in the store.
+        """
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+    def add_key(self, public_key_str):
+        """
+        Adds the public key to the store if it is not already there.
+
+        Parameters
+        ----------
+
+        public_key_str: str
+            The public key to add.
+        """
+        self.add_keys([public_key_str])
+
+    def close(self):
+        """
+        Releases any resources held by the store.
+        """
+        pass
+
+
+class TinyDBWorkerStore(WorkerStore):
+    """
+    Stores the public keys in a TinyDB json file. A backup of the existing
+    file is written on startup. TinyDB rewrites the whole file on every
+    change, so this is only suitable for small numbers of workers.
+
+    Parameters
+    ----------
+
+    path_to_keys_db: str
+        The location of the database.
+    """
+    def __init__(self, path_to_keys_db):
+        if not os.path.exists(path_to_keys_db):
+            logger.warning(f"Unable to locate workers database at {path_to_keys_db} - "
+                           f"creating new database.")
+        else:
+            logger.info("Creating a backup keys database...")
+            with open(path_to_keys_db, 'r') as f:
+                data = json.load(f)
+            with open(path_to_keys_db + '.bak', 'w') as f:
+                json.dump(data, f)
+
+            logger.info(f"Backup written to {path_to_keys_db + '.bak'}.")
+
+        self.db = TinyDB(path_to_keys_db)
+        self.keys = set(doc[PUBLIC_KEY_STR] for doc in self.db.all())
+
+    def get_keys(self):
+        return list(self.keys)
+
+    def add_keys(self, public_key_strs):
+        new_keys = [key for key in dict.fromkeys(public_key_strs) if key not in self.keys]
+        if len(new_keys) > 0:
+            self.db.insert_multiple({PUBLIC_KEY_STR: key} for key in new_keys)
+            self.keys.update(new_keys)
+
+    def remove_key(self, public_key_str):
+        if public_key_str not in self.keys:
+            return False
+        self.db.remove(Query()[PUBLIC_KEY_STR] == public_key_str)
+        self.keys.remove(public_key_str)
+        return True
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        self.db.close()
+
+
+class SQLiteWorkerStore(WorkerStore):
+    """
+    Stores the public keys in an SQLite database in write-ahead-log mode,
+    indexed by the public key, so that keys are added and removed without
+    rewriting the database and batches of keys are added in one transaction.
+    The database may be shared by several processes: each process opens its
+    own connection, as SQLite connections must not be used across a fork.
+
+    Parameters
+    ----------
+
+    path_to_keys_db: str
+        The location of the database.
+    """
+    def __init__(self, path_to_keys_db):
+        if not os.path.exists(path_to_keys_db):
+            logger.warning(f"Unable to locate workers database at {path_to_keys_db} - "
+                           f"creating new database.")
+        self.path_to_keys_db = path_to_keys_db
+        self.pid = None
+        self.inherited_conns = []
+        with self.conn:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS workers ({PUBLIC_KEY_STR} TEXT PRIMARY KEY)")
+
+    @property
+    def conn(self):
+        """
+        The connection to the database for the current process.
+
+        Returns
+        -------
+
+        sqlite3.Connection:
+            The connection, opened when first used in the process.
+        """
+        if self.pid != os.getpid():
+            if self.pid is not None:
+                # the connection of the parent process is kept, but never
+                # used or closed, so that its state is left untouched.
+                self.inherited_conns.append(self._conn)
+            self._conn = sqlite3.connect(self.path_to_keys_db, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self.pid = os.getpid()
+        return self._conn
+
+    def get_keys(self):
+        return [row[0] for row in self.conn.execute(f"SELECT {PUBLIC_KEY_STR} FROM workers")]
+
+    def add_keys(self, public_key_strs):
+        with self.conn:
+            self.conn.executemany(f"INSERT OR IGNORE INTO workers ({PUBLIC_KEY_STR}) VALUES (?)",
+                                  ((key,) for key in public_key_strs))
+
+    def remove_key(self, public_key_str):
+        with self.conn:
+            cursor = self.conn.execute(f"DELETE FROM workers WHERE {PUBLIC_KEY_STR} = ?", (public_key_str,))
+        return cursor.rowcount > 0
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+WORKER_STORES = {
+    'tinydb': TinyDBWorkerStore,
+    'sqlite': SQLiteWorkerStore
+}
+
+
+def create_worker_store(keys_db_backend, path_to_keys_db):
+    """
+    Creates the worker store for the given backend.
+
+    Parameters
+    ----------
+
+    keys_db_backend: str or WorkerStore
+        Either one of the keys of WORKER_STORES or a WorkerStore instance,
+        which is returned as is.
+
+    path_to_keys_db: str
+        The location of the database.
+
+    Returns
+    -------
+
+    WorkerStore:
+        The worker store.
+    """
+    if isinstance(keys_db_backend, WorkerStore):
+        return keys_db_backend
+    if keys_db_backend not in WORKER_STORES:
+        error_str = f"Unknown workers database backend {keys_db_backend} - " \
+                    f"expected one of {list(WORKER_STORES.keys())}."
+        logger.error(error_str)
+        raise ValueError(error_str)
+    return WORKER_STORES[keys_db_backend](path_to_keys_db)
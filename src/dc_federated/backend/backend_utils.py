@@ -1,7 +1,13 @@
 """
 Some common utility functions.
 """
-from dc_federated.backend._constants import GLOBAL_MODEL, GLOBAL_MODEL_VERSION
+import json
+import struct
+import hashlib
+
+from dc_federated.backend._constants import GLOBAL_MODEL, GLOBAL_MODEL_VERSION, SIGNED_PHRASE, \
+    UPDATE_HEADER_PREFIX
+from dc_federated.backend._codecs import DEFAULT_CODEC, get_codec
 
 
 def create_model_dict(model_serialized, model_version):
@@ -53,6 +59,197 @@ def is_valid_model_dict(data):
         GLOBAL_MODEL_VERSION in data)
 
 
+def json_body_digest(data):
+    """
+    Returns the digest of a json request body, used to sign the request.
+    The signature itself, if present, is left out.
+
+    Parameters
+    ----------
+
+    data: dict
+        The json request body.
+
+    Returns
+    -------
+
+    bytes:
+        The sha256 digest of the canonical json serialization of the body.
+    """
+    data = {key: val for key, val in data.items() if key != SIGNED_PHRASE}
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, separators=(',', ':')).encode()).digest()
+
+
+def signed_request_message(route, worker_id, timestamp, nonce, body_digest):
+    """
+    Returns the message that a worker signs to authenticate a single request
+    without a challenge phrase.
+
+    Parameters
+    ----------
+
+    route: str
+        The route the request is sent to.
+
+    worker_id: str
+        The id of the worker.
+
+    timestamp: int
+        The time, in seconds since the epoch, at which the request was made.
+
+    nonce: str
+        A random string unique to the request.
+
+    body_digest: bytes
+        The digest of the body of the request.
+
+    Returns
+    -------
+
+    bytes:
+        The message to sign.
+    """
+    return f"{route}|{worker_id}|{timestamp}|{nonce}|{body_digest.hex()}".encode()
+
+
+def run_in_pool(pool, func, *args, **kwargs):
+    """
+    Runs the function in the pool, blocking only the calling greenlet until
+    it returns, or directly if there is no pool. This is used for CPU bound
+    work that releases the GIL - e.g. zlib, hashlib and libsodium calls on
+    large inputs - so that the gevent hub keeps serving other requests
+    meanwhile.
+
+    Parameters
+    ----------
+
+    pool: gevent.threadpool.ThreadPool
+        The pool to run the function in, or None.
+
+    func: callable
+        The function to run.
+
+    *args, **kwargs:
+        The arguments to call the function with.
+
+    Returns
+    -------
+
+    object:
+        The return value of the function. Any exception raised by the
+        function is re-raised.
+    """
+    if pool is None:
+        return func(*args, **kwargs)
+    return pool.apply(func, args, kwargs)
+
+
+def update_header(key):
+    """
+    Returns the name of the http header carrying the given field of a raw
+    worker update request.
+
+    Parameters
+    ----------
+
+    key: str
+        The field, e.g. SIGNED_PHRASE.
+
+    Returns
+    -------
+
+    str:
+        The header name.
+    """
+    return UPDATE_HEADER_PREFIX + key.replace('_', '-')
+
+
+def compressed_update_digest(update_file, metadata, chunk_size=2 ** 20):
+    """
+    Returns the digest that a worker signs to authenticate a model update:
+    the sha256 digest of the length of the serialized update metadata, the
+    metadata and the compressed update, so that the server can authenticate
+    the update before decompressing it.
+
+    Parameters
+    ----------
+
+    update_file: file-like object
+        The file to read the compressed update from, from its current position.
+
+    metadata: bytes
+        The serialized update metadata.
+
+    chunk_size: int (default 1MB)
+        The maximum number of bytes read at a time.
+
+    Returns
+    -------
+
+    bytes:
+        The digest.
+    """
+    digest = hashlib.sha256(struct.pack('<Q', len(metadata)))
+    digest.update(metadata)
+    for data in iter(lambda: update_file.read(chunk_size), b''):
+        digest.update(data)
+    return digest.digest()
+
+
+def decompress_stream(src, dst, max_size, chunk_size=2 ** 20, compute_digest=True, codec=DEFAULT_CODEC):
+    """
+    Decompresses the data read from src into dst, a chunk at a time,
+    while computing the sha256 digest of the decompressed data, so that
+    neither the compressed nor the decompressed data need to be held in
+    memory at once.
+
+    Parameters
+    ----------
+
+    src: file-like object
+        The file to read the compressed data from.
+
+    dst: file-like object
+        The file to write the decompressed data to.
+
+    max_size: int
+        The maximum size of the decompressed data, in bytes. A ValueError is
+        raised as soon as it is exceeded, without decompressing the rest of
+        the stream. There is no maximum if None.
+
+    chunk_size: int (default 1MB)
+        The maximum number of bytes decompressed at a time.
+
+    compute_digest: bool (default True)
+        Whether to compute the digest of the decompressed data.
+
+    codec: str (default 'zlib')
+        The name of the codec the data was compressed with - see
+        dc_federated.backend._codecs.
+
+    Returns
+    -------
+
+    bytes:
+        The sha256 digest of the decompressed data, or None if
+        compute_digest is False.
+    """
+    # the reader limits the output per read, so that a small chunk that
+    # decompresses to a lot of data is not inflated in one go.
+    reader = get_codec(codec).reader(src)
+    digest = hashlib.sha256() if compute_digest else None
+    size = 0
+    for data in iter(lambda: reader.read(chunk_size), b''):
+        size += len(data)
+        if max_size is not None and size > max_size:
+            raise ValueError(f"Decompressed data exceeds the maximum size of {max_size} bytes.")
+        if digest is not None:
+            digest.update(data)
+        dst.write(data)
+    return digest.digest() if digest is not None else None
+
+
 def message_seriously_wrong(msg):
     return f"Something went seriously wrong - {msg}. Contact the application engineer immeidiately."
 
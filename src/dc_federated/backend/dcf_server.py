@@ -6,21 +6,34 @@ machine learning logic.
 import gevent
 from gevent import monkey; monkey.patch_all()
 from gevent import Greenlet, queue, pool
+from gevent.event import Event
+from gevent.threadpool import ThreadPool
+from gevent.pywsgi import WSGIServer
 
 import os
+import hmac
 import json
 import os.path
-import zlib
+import signal
+import socket
+import secrets
+import tempfile
 import msgpack
-import hashlib
+import requests
+from tempfile import SpooledTemporaryFile
 
-from bottle import Bottle, run, request, response, auth_basic, ServerAdapter
+from bottle import Bottle, run, request, response, auth_basic, abort, ServerAdapter
 
 from dc_federated.backend._constants import *
 from dc_federated.backend.backend_utils import *
 from dc_federated.utils import get_host_ip
 from dc_federated.backend.backend_utils import is_valid_model_dict
 from dc_federated.backend._worker_manager import WorkerManager
+from dc_federated.backend._worker_store import TinyDBWorkerStore
+from dc_federated.backend._shared_state import SharedServerState
+from dc_federated.backend._model_cache import GlobalModelCache
+from dc_federated.backend._model_store import GlobalModelStore
+from dc_federated.backend._codecs import CODECS, DEFAULT_CODEC, get_codec
 
 import logging
 
@@ -84,6 +97,25 @@ class DCFServer(object):
     path_to_keys_db: str
         Path to the database of workers' public keys that has been added.
 
+    keys_db_backend: str or WorkerStore (default 'tinydb')
+        The backend for the database of workers' public keys: 'tinydb' for
+        a json file, or 'sqlite' for an indexed SQLite database, which is
+        recommended for large numbers of workers.
+
+    signed_request_window: int (default 300)
+        The number of seconds either side of the server time within which
+        the timestamp of a signed worker request must fall. Signed requests
+        are authenticated without a challenge phrase, and their nonces are
+        remembered for long enough to reject replays.
+
+    session_token_lifetime: int (default None)
+        If given, workers may exchange a signed request to the session_token
+        route for a session token valid for this number of seconds. Requests
+        carrying the token are authenticated with a keyed hash rather than a
+        signature verification. The token is a bearer token, so this should
+        only be used with ssl_enabled, or on a trusted network. Session
+        tokens are disabled if None.
+
     server_host_ip: str (default None)
         The ip-address of the host of the server. If None, then it
         uses the ip-address of the current machine.
@@ -105,7 +137,109 @@ class DCFServer(object):
 
     model_check_interval: int
         The interval of time between the server checking for an updated
-        model for the long polling.
+        model for the long polling. This is only a fallback for algorithms
+        that do not call global_model_version_changed() when they publish
+        a new global model.
+
+    model_cache_size: int (default 256MB)
+        The memory budget in bytes for caching the serialized global model.
+        The global model is serialized once per version and the cached
+        bytes are returned to all the workers.
+
+    return_global_model_delta_callback: object -> dict (default None)
+        Optional. Given the version of the global model that a worker
+        already has, this function is expected to return a dictionary with
+        GLOBAL_MODEL: containing the serialization of the difference between
+        the current global model and that version.
+        GLOBAL_MODEL_VERSION: the current global model version.
+        GLOBAL_MODEL_BASE_VERSION: the version the difference is taken against.
+        It should return None if it cannot compute the difference, in which
+        case the whole global model is returned to the worker.
+
+    cpu_pool_size: int (default 4)
+        The number of threads used for the CPU bound steps of serving the
+        workers - decompressing and hashing the model updates, verifying
+        the signatures and compressing the global model - so that the
+        gevent hub keeps serving the long-polls meanwhile. If 0, these
+        steps run directly on the hub.
+
+    batch_signature_verification: bool (default False)
+        Whether the signatures of the worker requests that arrive while
+        others are being verified are verified together in a single call to
+        the thread pool, which reduces the dispatch overhead per request
+        when many workers send requests at once. No latency is added to wait
+        for a batch, and each signature is still verified once, so the
+        cryptographic cost per request is unchanged.
+
+    max_update_size: int (default 1GB)
+        The maximum size in bytes of a decompressed worker update. Larger
+        updates are rejected as soon as the limit is reached while they are
+        being decompressed. There is no maximum if None.
+
+    update_spool_size: int (default 16MB)
+        Worker updates are decompressed in chunks into a temporary file,
+        which is kept in memory up to this size and moved to disk beyond it.
+
+    stream_worker_updates: bool (default False)
+        If True, receive_worker_update_callback is passed the temporary file
+        holding the decompressed update, positioned at the start, instead of
+        the bytes of the update. The callback is then responsible for
+        closing the file.
+
+    check_update_metadata_callback: (str, dict) -> bool (default None)
+        Optional. This function is expected to take the id of a worker and
+        the metadata sent with its update - see DCFWorker.send_model_update()
+        - and return whether the update should be accepted. It is called
+        after the worker is authenticated but before the update is
+        decompressed, so that e.g. stale updates are rejected cheaply.
+
+    convert_global_model_callback: (dict, str) -> dict (default None)
+        Optional. This function is expected to take a model dictionary, as
+        returned by return_global_model_callback or
+        return_global_model_delta_callback, and the GLOBAL_MODEL_FORMAT
+        requested by a worker (e.g. 'float16'), and return the dictionary
+        with the model converted to that format, or None if the format is
+        not supported, in which case the model is returned unconverted.
+        The converted models are cached per format.
+
+    num_processes: int (default 1)
+        The number of gunicorn worker processes serving the workers. If
+        more than 1, the process calling start_server() becomes the
+        primary process, which runs the callbacks of the algorithm, while
+        the requests of the workers are served by num_processes forked
+        processes which share the worker registry, the authentication state
+        and the global models through a SharedServerState, and forward the
+        updates and the registrations to the primary process over a local
+        connection. This requires the 'sqlite' keys_db_backend, if the
+        workers are persisted, and is not used with a server_adapter.
+
+    shared_state_path: str (default None)
+        The location of the database of the SharedServerState when
+        num_processes is more than 1. A file in a new temporary directory
+        is used if None. It should be on a local disk.
+
+    is_worker_selected_callback: str -> bool (default None)
+        Optional. This function is expected to take the id of a worker and
+        return whether the worker should be sent the current global model,
+        e.g. whether it was sampled for the current round of training. The
+        long-polls of the workers that are not selected keep waiting when
+        the global model version changes. All the workers are selected if
+        None.
+
+    model_store_path: str (default None)
+        If given, the directory of a GlobalModelStore where the serialized
+        global models are also written, so that the requests for the global
+        model are answered from the file, with sendfile where the server
+        supports it. Each server run stores its models in a new session of
+        the store, so that a restarted server never serves the models of
+        the previous run. The models are only kept in memory if None.
+
+    model_store_max_versions: int (default 10)
+        The number of most recent global model versions kept in the store.
+
+    model_store_max_age: float (default None)
+        If given, the number of seconds after which a global model version,
+        other than the latest one, is removed from the store.
     """
     def __init__(
         self,
@@ -118,12 +252,30 @@ class DCFServer(object):
         key_list_file,
         load_last_session_workers=True,
         path_to_keys_db='.keys_db.json',
+        keys_db_backend='tinydb',
+        signed_request_window=300,
+        session_token_lifetime=None,
         server_host_ip=None,
         server_port=8080,
         ssl_enabled=False,
         ssl_keyfile=None,
         ssl_certfile=None,
         model_check_interval=10,
+        model_cache_size=256 * 2 ** 20,
+        return_global_model_delta_callback=None,
+        cpu_pool_size=4,
+        batch_signature_verification=False,
+        max_update_size=2 ** 30,
+        update_spool_size=16 * 2 ** 20,
+        stream_worker_updates=False,
+        check_update_metadata_callback=None,
+        convert_global_model_callback=None,
+        num_processes=1,
+        shared_state_path=None,
+        is_worker_selected_callback=None,
+        model_store_path=None,
+        model_store_max_versions=10,
+        model_store_max_age=None,
         debug=False
     ):
         self.server_host_ip = get_host_ip() if server_host_ip is None else server_host_ip
@@ -132,17 +284,54 @@ class DCFServer(object):
         self.register_worker_callback = register_worker_callback
         self.unregister_worker_callback = unregister_worker_callback
         self.return_global_model_callback = return_global_model_callback
+        self.return_global_model_delta_callback = return_global_model_delta_callback
         self.is_global_model_most_recent = is_global_model_most_recent
         self.receive_worker_update_callback = receive_worker_update_callback
-
+        self.max_update_size = max_update_size
+        self.update_spool_size = update_spool_size
+        self.stream_worker_updates = stream_worker_updates
+        self.check_update_metadata_callback = check_update_metadata_callback
+        self.convert_global_model_callback = convert_global_model_callback
+        self.is_worker_selected_callback = is_worker_selected_callback
+
+        self.num_processes = num_processes
+        self.shared_state = None
+        if num_processes > 1:
+            if shared_state_path is None:
+                shared_state_path = os.path.join(tempfile.mkdtemp(prefix='dcf_'), 'shared_state.db')
+            self.shared_state = SharedServerState(shared_state_path)
+        self.primary_address = None
+        self.forward_token = secrets.token_hex(32)
+        self.primary_server = None
+        self.http_process_pid = None
+        self.primary_pid = None
+        self.forward_to_primary = False
+
+        self.cpu_pool_size = cpu_pool_size
+        self.cpu_pool = ThreadPool(cpu_pool_size) if cpu_pool_size > 0 else None
         self.worker_manager = WorkerManager(server_mode_safe,
                                             key_list_file,
                                             load_last_session_workers,
-                                            path_to_keys_db)
+                                            path_to_keys_db,
+                                            keys_db_backend,
+                                            signed_request_window,
+                                            session_token_lifetime,
+                                            self.cpu_pool,
+                                            batch_signature_verification,
+                                            self.shared_state)
+        if num_processes > 1 and isinstance(self.worker_manager.public_keys_db, TinyDBWorkerStore):
+            error_str = "A server with more than one process requires the 'sqlite' keys_db_backend."
+            logger.error(error_str)
+            raise ValueError(error_str)
 
         self.gevent_pool = pool.Pool(None)
         self.model_version_req_dict = {}
         self.model_check_interval = model_check_interval
+        self.gm_version_changed_event = Event()
+        self.global_model_cache = GlobalModelCache(model_cache_size)
+        self.global_model_store = None if model_store_path is None else \
+            GlobalModelStore(model_store_path, model_store_max_versions, model_store_max_age)
+        self.global_model_encodings = {(DEFAULT_CODEC, None)}
         self.debug = debug
 
         self.ssl_enabled = ssl_enabled
@@ -402,10 +591,48 @@ class DCFServer(object):
             REGISTRATION_STATUS_KEY: worker_data[REGISTRATION_STATUS_KEY]
         })
 
+    def verify_worker_update(self, worker_id, update_auth, update_digest):
+        """
+        Verifies the authentication of an update from a worker: by its
+        SESSION_TOKEN if it has one, as a signed request if it has a
+        REQUEST_NONCE, or as a plain signature of the update digest otherwise.
+
+        Parameters
+        ----------
+
+        worker_id: str
+            The id of the worker.
+
+        update_auth: dict
+            The authentication fields of the request, with some of the keys
+            UPDATE_AUTH_KEYS.
+
+        update_digest: bytes
+            The digest of the update signed by the worker.
+
+        Returns
+        -------
+
+        bool:
+            Whether the verification succeeded or not.
+        """
+        if SESSION_TOKEN in update_auth:
+            return self.worker_manager.verify_session_token(worker_id, update_auth[SESSION_TOKEN])
+        if REQUEST_NONCE in update_auth:
+            return self.worker_manager.authenticate_request(
+                worker_id,
+                RECEIVE_WORKER_UPDATE_ROUTE,
+                update_auth[SIGNED_PHRASE],
+                update_auth.get(REQUEST_TIMESTAMP),
+                update_auth[REQUEST_NONCE],
+                update_digest
+            )
+        return self.worker_manager.authenticate_worker(worker_id, update_auth[SIGNED_PHRASE], update_digest)
+
     def receive_worker_update(self, worker_id):
         """
-        This receives the update from a worker and calls the corresponding callback function.
-        Expects that the worker_id and model-update were sent using the DCFWorker.send_model_update()
+        This receives the update from a worker, sent as a multipart form, and
+        calls the corresponding callback function - see ingest_worker_update().
 
         Returns
         -------
@@ -416,19 +643,98 @@ class DCFServer(object):
         """
         try:
             worker_data = request.files
-            if SIGNED_PHRASE not in worker_data:
-                error_message = f"{SIGNED_PHRASE} not found in worker update payload."
+            update_auth = {key: worker_data[key].file.read().decode('utf-8')
+                           for key in UPDATE_AUTH_KEYS if key in worker_data}
+            update_metadata = worker_data[UPDATE_METADATA_KEY].file.read() \
+                if UPDATE_METADATA_KEY in worker_data else None
+            return self.ingest_worker_update(
+                worker_id, worker_data[WORKER_MODEL_UPDATE_KEY].file, update_metadata, update_auth)
+
+        except Exception as e:
+            logger.warning(e)
+            return str(e)
+
+    def receive_worker_update_stream(self, worker_id):
+        """
+        This receives the update from a worker, sent as the raw
+        application/octet-stream body of the request with the authentication
+        fields and the update metadata in headers (see update_header()), and
+        calls the corresponding callback function - see ingest_worker_update().
+        This avoids parsing, and copying, the update as a multipart form.
+
+        Returns
+        -------
+
+        str:
+            If the update was successful then "Worker update received"
+            Otherwise any exception that was raised.
+        """
+        try:
+            update_auth = {key: request.get_header(update_header(key))
+                           for key in UPDATE_AUTH_KEYS if request.get_header(update_header(key)) is not None}
+            update_metadata = request.get_header(update_header(UPDATE_METADATA_KEY))
+            if update_metadata is None:
+                error_message = f"{update_header(UPDATE_METADATA_KEY)} header not found in worker update request."
                 logger.error(error_message)
                 return json.dumps({ERROR_MESSAGE_KEY: error_message})
+            return self.ingest_worker_update(
+                worker_id, request.body, bytes.fromhex(update_metadata), update_auth)
 
-            model_update = zlib.decompress(worker_data[WORKER_MODEL_UPDATE_KEY].file.read())
+        except Exception as e:
+            logger.warning(e)
+            return str(e)
 
-            verify_worker = self.worker_manager.authenticate_worker(
-                worker_id,
-                worker_data[SIGNED_PHRASE].file.read().decode('utf-8'),
-                hashlib.sha256(model_update).digest()
-            )
-            if not verify_worker:
+    def ingest_worker_update(self, worker_id, update_file, update_metadata, update_auth):
+        """
+        Authenticates and decompresses the update from a worker and calls the
+        receive_worker_update_callback with it.
+
+        Updates sent with metadata are signed over the metadata and the
+        compressed update, so they are authenticated, and their metadata
+        checked with check_update_metadata_callback, before they are
+        decompressed. Updates without metadata are signed over the
+        decompressed update.
+
+        Parameters
+        ----------
+
+        worker_id: str
+            The id of the worker.
+
+        update_file: file-like object
+            The file holding the compressed update.
+
+        update_metadata: bytes
+            The serialized update metadata, or None.
+
+        update_auth: dict
+            The authentication fields of the request - see verify_worker_update().
+
+        Returns
+        -------
+
+        str:
+            The return value of the receive_worker_update_callback, or an
+            error message.
+        """
+        if SIGNED_PHRASE not in update_auth and SESSION_TOKEN not in update_auth:
+            error_message = f"Neither {SIGNED_PHRASE} nor {SESSION_TOKEN} found in worker update payload."
+            logger.error(error_message)
+            return json.dumps({ERROR_MESSAGE_KEY: error_message})
+
+        # the update is decompressed in chunks into a spooled file, so
+        # that the memory used per upload is bounded.
+        model_update_file = SpooledTemporaryFile(max_size=self.update_spool_size)
+        try:
+            if update_metadata is not None:
+                update_digest = run_in_pool(
+                    self.cpu_pool, compressed_update_digest, update_file, update_metadata)
+                update_file.seek(0)
+            else:
+                update_digest = run_in_pool(
+                    self.cpu_pool, decompress_stream, update_file, model_update_file, self.max_update_size)
+
+            if not self.verify_worker_update(worker_id, update_auth, update_digest):
                 logger.error(f"Unable to verify worker with id {worker_id[0:WID_LEN]}")
                 return INVALID_WORKER
 
@@ -440,14 +746,62 @@ class DCFServer(object):
                 logger.warning(f"Unregistered worker {worker_id[0:WID_LEN]} tried to send an update.")
                 return UNREGISTERED_WORKER
 
+            if update_metadata is not None:
+                update_metadata = msgpack.unpackb(update_metadata)
+                if not isinstance(update_metadata, dict) or \
+                        update_metadata.get(WORKER_ID_KEY) != worker_id:
+                    logger.error(f"Update metadata from worker {worker_id[0:WID_LEN]} "
+                                 f"does not match the worker id.")
+                    return INVALID_WORKER
+                if self.check_update_metadata_callback is not None and \
+                        not self.check_update_metadata_callback(worker_id, update_metadata):
+                    logger.warning(f"Update from worker {worker_id[0:WID_LEN]} rejected "
+                                   f"on its metadata.")
+                    return UPDATE_REJECTED
+                update_codec = update_metadata.get(UPDATE_CODEC_KEY, DEFAULT_CODEC)
+                if update_codec not in CODECS:
+                    error_message = f"Update from worker {worker_id[0:WID_LEN]} compressed with " \
+                                    f"unavailable codec {update_codec}."
+                    logger.error(error_message)
+                    return json.dumps({ERROR_MESSAGE_KEY: error_message})
+                run_in_pool(self.cpu_pool, decompress_stream, update_file, model_update_file,
+                            self.max_update_size, compute_digest=False, codec=update_codec)
+
             logger.info(f'Received model update from worker {worker_id[0:WID_LEN]}.')
+            model_update_file.seek(0)
+            if self.stream_worker_updates:
+                model_update, model_update_file = model_update_file, None
+            else:
+                model_update = model_update_file.read()
             return self.receive_worker_update_callback(worker_id, model_update)
+        finally:
+            if model_update_file is not None:
+                model_update_file.close()
 
+    def global_model_version_changed(self):
+        """
+        Wakes up all the pending long-polls so that they check the global
+        model version immediately, instead of waiting for the next
+        model_check_interval. This should be called by the algorithm once,
+        each time it publishes a new version of the global model.
+        """
+        # serialize the new model, with each codec and format the workers
+        # have asked for, before waking up the long-polls, so that they all
+        # get the cached version.
+        try:
+            for codec, model_format in list(self.global_model_encodings):
+                self.get_global_model_bytes(codec=codec, model_format=model_format)
         except Exception as e:
-            logger.warning(e)
-            return str(e)
+            logger.warning(f"Unable to serialize the new global model: {str(e.__class__)} {str(e)}")
+
+        version_event, self.gm_version_changed_event = \
+            self.gm_version_changed_event, Event()
+        version_event.set()
+        logger.info("Global model version change broadcast to pending long-polls.")
 
-    def check_model_version_updated(self, worker_id, body, last_worker_model_version):
+    def check_model_version_updated(self, worker_id, body, last_worker_model_version,
+                                    return_model=False, base_version=None, codec=DEFAULT_CODEC,
+                                    model_format=None):
         """
         Greenlet function run to check with the implementation of the
         algorithm server-side logic to see if the global model is ready.
@@ -461,24 +815,51 @@ class DCFServer(object):
 
         last_worker_model_version: object
             The version of the last model that the worker was using.
-        """
-        while self.is_global_model_most_recent(last_worker_model_version):
-            gevent.sleep(self.model_check_interval)
 
-        model_update = self.return_global_model_callback()
-        if not is_valid_model_dict(model_update):
-            logger.error(f"Expected dictionary with {GLOBAL_MODEL} and {GLOBAL_MODEL_VERSION} keys - "
-                         "return_global_model_callback() implementation is incorrect")
-        body.put(GLOBAL_MODEL_UPDATED_STRING)
-        body.put(StopIteration)
-        logger.info(f"Notified global model version changed to {worker_id[0:WID_LEN]}.")
+        return_model: bool (default False)
+            Whether to return the global model itself, instead of just the
+            GLOBAL_MODEL_UPDATED_STRING notification.
+
+        base_version: object (default None)
+            When returning the model, the version of the global model held by
+            the worker to return the difference against, if any.
 
-        # clean up the list of model requests for this worker
-        if len(self.model_version_req_dict[worker_id]) > 0:
-            self.model_version_req_dict[worker_id].pop()
-        if len(self.model_version_req_dict[worker_id]) > 0:
-            message_seriously_wrong(f"in 'check_model_ready', "
-                                    f"more than one entry in the 'mode_req_dict' for {worker_id[0:WID_LEN]}")
+        codec: str (default 'zlib')
+            When returning the model, the codec to compress it with.
+
+        model_format: str (default None)
+            When returning the model, the format to convert it to, if any.
+        """
+        try:
+            while True:
+                # take the event before checking the version so that a broadcast
+                # between the check and the wait is not missed.
+                version_event = self.gm_version_changed_event
+                if not self.is_global_model_most_recent(last_worker_model_version) and \
+                        (self.is_worker_selected_callback is None or self.is_worker_selected_callback(worker_id)):
+                    break
+                version_event.wait(self.model_check_interval)
+
+            if return_model:
+                body.put(self.get_global_model_bytes(base_version, codec, model_format))
+                logger.info(f"Returned changed global model to {worker_id[0:WID_LEN]}.")
+            else:
+                body.put(GLOBAL_MODEL_UPDATED_STRING)
+                logger.info(f"Notified global model version changed to {worker_id[0:WID_LEN]}.")
+        except Exception as e:
+            logger.error(f"Unable to answer the long-poll of {worker_id[0:WID_LEN]}: "
+                         f"{str(e.__class__)} {str(e)}")
+            body.put(str(e))
+        finally:
+            # always end the response, even if the greenlet is killed, and
+            # clean up the list of model requests for this worker
+            body.put(StopIteration)
+            requests = self.model_version_req_dict.get(worker_id, [])
+            if (gevent.getcurrent(), body) in requests:
+                requests.remove((gevent.getcurrent(), body))
+            if len(requests) > 0:
+                message_seriously_wrong(f"in 'check_model_ready', "
+                                        f"more than one entry in the 'mode_req_dict' for {worker_id[0:WID_LEN]}")
 
     def notify_me_if_gm_version_updated(self):
         """
@@ -486,12 +867,88 @@ class DCFServer(object):
         global model is more recent than the model version indicated by
         the worker.
         """
+        return self.long_poll_global_model_version(return_model=False)
+
+    def notify_and_return_global_model(self):
+        """
+        Returns the global model to a worker, using long polling, once the
+        current global model is more recent than the model version indicated
+        by the worker. This combines notify_me_if_gm_version_updated and
+        return_global_model in a single request.
+        """
+        return self.long_poll_global_model_version(return_model=True)
+
+    def verify_worker_request(self, route, query_request, allow_session_token=True):
+        """
+        Verifies the json request from a worker: by its SESSION_TOKEN if it
+        has one (see WorkerManager.verify_session_token()), as a signed request
+        if it has a REQUEST_NONCE (see WorkerManager.authenticate_request()),
+        or as the signature of the last challenge phrase sent to the worker
+        otherwise.
+
+        Parameters
+        ----------
+
+        route: str
+            The route the request was sent to.
+
+        query_request: dict
+            The json request, with at least the WORKER_ID_KEY key.
+
+        allow_session_token: bool (default True)
+            Whether the request may be authenticated by a session token.
+
+        Returns
+        -------
+
+        bool:
+            Whether the verification succeeded or not.
+        """
+        worker_id = query_request[WORKER_ID_KEY]
+        if SESSION_TOKEN in query_request:
+            return allow_session_token and \
+                self.worker_manager.verify_session_token(worker_id, query_request[SESSION_TOKEN])
+        if not isinstance(query_request.get(SIGNED_PHRASE), str):
+            logger.error(f"Neither {SIGNED_PHRASE} nor {SESSION_TOKEN} found in request "
+                         f"from {worker_id[0:WID_LEN]}.")
+            return False
+        if REQUEST_NONCE in query_request:
+            return self.worker_manager.authenticate_request(
+                worker_id,
+                route,
+                query_request[SIGNED_PHRASE],
+                query_request.get(REQUEST_TIMESTAMP),
+                query_request[REQUEST_NONCE],
+                json_body_digest(query_request)
+            )
+        return self.worker_manager.verify_challenge(worker_id, query_request[SIGNED_PHRASE])
+
+    def long_poll_global_model_version(self, return_model):
+        """
+        Validates the worker's long-poll request and spawns a
+        check_model_version_updated greenlet to respond to it once the
+        global model version has changed.
+
+        Parameters
+        ----------
+
+        return_model: bool
+            Whether the response should contain the global model itself or
+            just the GLOBAL_MODEL_UPDATED_STRING notification.
+
+        Returns
+        -------
+
+        gevent.queue.Queue or str:
+            The Queue object that returns the response in a long polling or
+            a string indicating an error has occured.
+        """
         try:
             query_request = request.json
             valid_failed = DCFServer.validate_input(
                 query_request,
-                [WORKER_ID_KEY, LAST_WORKER_MODEL_VERSION, SIGNED_PHRASE],
-                [str, object, str]
+                [WORKER_ID_KEY, LAST_WORKER_MODEL_VERSION],
+                [str, object]
             )
             if ERROR_MESSAGE_KEY in valid_failed:
                 logger.error(valid_failed[ERROR_MESSAGE_KEY])
@@ -502,7 +959,9 @@ class DCFServer(object):
                 logger.warning(f"Unknown worker {worker_id[0:WID_LEN]} tried to get the global model.")
                 return INVALID_WORKER
 
-            if not self.worker_manager.verify_challenge(worker_id, query_request[SIGNED_PHRASE]):
+            route = NOTIFY_AND_RETURN_GLOBAL_MODEL_ROUTE if return_model \
+                else NOTIFY_ME_IF_GM_VERSION_UPDATED_ROUTE
+            if not self.verify_worker_request(route, query_request):
                 logger.error(f"Failed to verify worker with id {worker_id[0:WID_LEN]}")
                 return INVALID_WORKER
 
@@ -524,8 +983,12 @@ class DCFServer(object):
                 if len(self.model_version_req_dict[worker_id]) > 0:
                     message_seriously_wrong(f"in 'return_global_model', "
                                             f"more than one entry in the 'mode_req_dict' for {worker_id[0:WID_LEN]}")
+            codec = self.select_model_codec() if return_model else DEFAULT_CODEC
             body = gevent.queue.Queue()
-            g = Greenlet(self.check_model_version_updated, worker_id, body, query_request[LAST_WORKER_MODEL_VERSION])
+            g = Greenlet(self.check_model_version_updated, worker_id, body,
+                         query_request[LAST_WORKER_MODEL_VERSION], return_model,
+                         query_request.get(GLOBAL_MODEL_BASE_VERSION), codec,
+                         self.requested_model_format(query_request, codec))
             self.gevent_pool.add(g)
             if worker_id not in self.model_version_req_dict:
                 self.model_version_req_dict[worker_id] = []
@@ -538,8 +1001,243 @@ class DCFServer(object):
             logger.warning(str(e.__class__) + str(e))
             return str(e)
 
-        # If the same worker made a long poll request previously,
-        # terminate that request
+    def select_model_codec(self):
+        """
+        Returns the codec to compress the global model with for the current
+        request: the one named in its codec header if the server has it, or
+        the default zlib codec otherwise. The response's codec header is set
+        to the name of the codec selected, so that the worker knows how to
+        decompress the model.
+
+        Returns
+        -------
+
+        str:
+            The name of the codec.
+        """
+        codec = request.get_header(update_header(CODEC_KEY), DEFAULT_CODEC)
+        if codec not in CODECS:
+            logger.warning(f"Codec {codec} requested by worker is not available - using {DEFAULT_CODEC}.")
+            codec = DEFAULT_CODEC
+        response.set_header(update_header(CODEC_KEY), codec)
+        return codec
+
+    def requested_model_format(self, query_request, codec):
+        """
+        Returns the GLOBAL_MODEL_FORMAT requested by the worker, if the
+        server has a convert_global_model_callback. The format is only
+        recorded, so that the next global models are serialized in it as
+        soon as they are published, once get_global_model_bytes() has
+        converted a model to it.
+
+        Parameters
+        ----------
+
+        query_request: dict
+            The json request from the worker.
+
+        codec: str
+            The name of the codec selected for the request.
+
+        Returns
+        -------
+
+        str or None:
+            The format of the model, or None for the model as it is.
+        """
+        model_format = query_request.get(GLOBAL_MODEL_FORMAT)
+        if self.convert_global_model_callback is None or not isinstance(model_format, str):
+            model_format = None
+        return model_format
+
+    def get_global_model_bytes(self, base_version=None, codec=DEFAULT_CODEC, model_format=None):
+        """
+        Returns the compressed serialization of the current global model.
+        The return_global_model_callback() is only called when the current
+        version is not already in the cache, where it is kept compressed
+        with each codec it was requested with.
+
+        Parameters
+        ----------
+
+        base_version: object (default None)
+            If given, and a return_global_model_delta_callback was supplied,
+            the difference between the current global model and this version
+            is returned instead of the whole model, when available.
+
+        codec: str (default 'zlib')
+            The name of the codec to compress the model with - see
+            dc_federated.backend._codecs.
+
+        model_format: str (default None)
+            If given, and a convert_global_model_callback was supplied, the
+            format to convert the model to.
+
+        Returns
+        -------
+
+        bytes:
+            The compressed msgpack serialization of the model dictionary.
+        """
+        variant = self.global_model_variant(base_version, codec, model_format)
+        if self.return_global_model_delta_callback is None:
+            base_version = None
+        if self.convert_global_model_callback is None:
+            model_format = None
+
+        cache = self.global_model_cache
+        if cache.latest_version is not None and \
+                self.is_global_model_most_recent(cache.latest_version):
+            data = cache.get(cache.latest_version, variant)
+            if data is not None:
+                return data
+
+        store = self.global_model_store
+        if store is not None and store.latest_version is not None and \
+                self.is_global_model_most_recent(store.latest_version):
+            data = store.get(store.latest_version, variant)
+            if data is not None:
+                cache.put(store.latest_version, data, variant)
+                return data
+
+        if self.forward_to_primary:
+            return self.fetch_global_model_bytes(base_version, codec, model_format, variant)
+
+        if base_version is None:
+            model_dict = self.return_global_model_callback()
+        else:
+            model_dict = self.return_global_model_delta_callback(base_version)
+            if model_dict is None:
+                return self.get_global_model_bytes(codec=codec, model_format=model_format)
+
+        if model_format is not None:
+            converted_model_dict = self.convert_global_model_callback(model_dict, model_format)
+            if converted_model_dict is None:
+                logger.warning(f"Global model format {model_format} requested by worker is not supported - "
+                               f"sending the model as it is.")
+                return self.get_global_model_bytes(base_version, codec)
+            model_dict = converted_model_dict
+
+        data = run_in_pool(self.cpu_pool, get_codec(codec).compress, msgpack.packb(model_dict))
+        if is_valid_model_dict(model_dict):
+            # the encodings are only recorded here, once the codec and format
+            # are known to work, so that workers cannot grow the set.
+            self.global_model_encodings.add((codec, model_format))
+            cache.put(model_dict[GLOBAL_MODEL_VERSION], data, variant)
+            if self.shared_state is not None:
+                self.shared_state.put_global_model_bytes(model_dict[GLOBAL_MODEL_VERSION], data, variant)
+            if store is not None:
+                store.add(model_dict[GLOBAL_MODEL_VERSION], run_in_pool(self.cpu_pool, store.write_object, data),
+                          variant)
+        else:
+            logger.error(f"Expected dictionary with {GLOBAL_MODEL} and {GLOBAL_MODEL_VERSION} keys - "
+                         "return_global_model_callback() implementation is incorrect")
+        return data
+
+    def global_model_variant(self, base_version=None, codec=DEFAULT_CODEC, model_format=None):
+        """
+        Returns the variant of the global model under which it is cached and
+        stored for the given request.
+
+        Parameters
+        ----------
+
+        base_version: object (default None)
+            The version to return the difference against, or None.
+
+        codec: str (default 'zlib')
+            The name of the codec to compress the model with.
+
+        model_format: str (default None)
+            The format to convert the model to, or None.
+
+        Returns
+        -------
+
+        tuple or None:
+            The variant, None for the whole model compressed with the
+            default codec.
+        """
+        if self.return_global_model_delta_callback is None:
+            base_version = None
+        if self.convert_global_model_callback is None:
+            model_format = None
+        if base_version is None and codec == DEFAULT_CODEC and model_format is None:
+            return None
+        return codec, base_version, model_format
+
+    def open_global_model_file(self, base_version=None, codec=DEFAULT_CODEC, model_format=None):
+        """
+        Returns the file in the GlobalModelStore holding the current global
+        model, for it to be sent without reading it into memory, serializing
+        it first if needed - see get_global_model_bytes().
+
+        Parameters
+        ----------
+
+        base_version: object (default None)
+            The version to return the difference against, or None.
+
+        codec: str (default 'zlib')
+            The name of the codec to compress the model with.
+
+        model_format: str (default None)
+            The format to convert the model to, or None.
+
+        Returns
+        -------
+
+        file or bytes:
+            The open file, or the bytes of the model if there is no store or
+            the model is not in it, e.g. if the difference was not available.
+        """
+        data = self.get_global_model_bytes(base_version, codec, model_format)
+        store = self.global_model_store
+        if store is None or store.latest_version is None or \
+                not self.is_global_model_most_recent(store.latest_version):
+            return data
+        model_file = store.open(store.latest_version, self.global_model_variant(base_version, codec, model_format))
+        if model_file is None:
+            return data
+        response.content_length = os.fstat(model_file.fileno()).st_size
+        return model_file
+
+    def fetch_global_model_bytes(self, base_version, codec, model_format, variant):
+        """
+        Returns the compressed serialization of the current global model in
+        an HTTP worker process of a multi-process server: from the
+        SharedServerState if the primary process has stored it there, in
+        which case it is also cached in this process, or from the primary
+        process otherwise.
+
+        Parameters
+        ----------
+
+        base_version: object
+            The version to return the difference against, or None.
+
+        codec: str
+            The name of the codec to compress the model with.
+
+        model_format: str
+            The format to convert the model to, or None.
+
+        variant: object
+            The variant of the model in the GlobalModelCache.
+
+        Returns
+        -------
+
+        bytes:
+            The compressed msgpack serialization of the model dictionary.
+        """
+        version = self.shared_state.get_global_model_version()
+        data = self.shared_state.get_global_model_bytes(version, variant)
+        if data is not None:
+            self.global_model_cache.put(version, data, variant)
+            return data
+        return self.call_primary(RETURN_GLOBAL_MODEL_ROUTE,
+                                    msgpack.packb([base_version, codec, model_format]))
 
     def return_global_model(self):
         """
@@ -558,8 +1256,7 @@ class DCFServer(object):
         try:
             query_request = request.json
 
-            valid_failed = DCFServer.validate_input(
-                query_request, [WORKER_ID_KEY, SIGNED_PHRASE], [str, str])
+            valid_failed = DCFServer.validate_input(query_request, [WORKER_ID_KEY], [str])
             if ERROR_MESSAGE_KEY in valid_failed:
                 logger.error(valid_failed[ERROR_MESSAGE_KEY])
                 return json.dumps({ERROR_MESSAGE_KEY: valid_failed[ERROR_MESSAGE_KEY]})
@@ -569,7 +1266,7 @@ class DCFServer(object):
                 logger.warning(f"Unknown worker {worker_id[0:WID_LEN]} tried to get the global model.")
                 return INVALID_WORKER
 
-            if not self.worker_manager.verify_challenge(worker_id, query_request[SIGNED_PHRASE]):
+            if not self.verify_worker_request(RETURN_GLOBAL_MODEL_ROUTE, query_request):
                 logger.error(f"Failed to verify worker with id {worker_id[0:WID_LEN]}")
                 return INVALID_WORKER
 
@@ -578,7 +1275,56 @@ class DCFServer(object):
                 return UNREGISTERED_WORKER
 
             logger.info(f"Returned global model to {worker_id[0:WID_LEN]}.")
-            return zlib.compress(msgpack.packb(self.return_global_model_callback()))
+            codec = self.select_model_codec()
+            return self.open_global_model_file(query_request.get(GLOBAL_MODEL_BASE_VERSION), codec,
+                                               self.requested_model_format(query_request, codec))
+
+        except Exception as e:
+            logger.warning(str(e.__class__) + str(e))
+            return str(e)
+
+    def return_session_token(self):
+        """
+        Returns a session token to a registered worker that authenticated the
+        request with its public key, either as a signed request or with a
+        challenge phrase - see WorkerManager.issue_session_token(). The
+        same route is used to renew the token before it expires.
+
+        Returns
+        -------
+
+        str:
+            JSON in string form containing the SESSION_TOKEN and its
+            SESSION_TOKEN_EXPIRY, or an error message if session tokens
+            are disabled, or INVALID_WORKER or UNREGISTERED_WORKER if the
+            worker could not be authenticated.
+        """
+        try:
+            query_request = request.json
+            valid_failed = DCFServer.validate_input(query_request, [WORKER_ID_KEY], [str])
+            if ERROR_MESSAGE_KEY in valid_failed:
+                logger.error(valid_failed[ERROR_MESSAGE_KEY])
+                return json.dumps(valid_failed)
+
+            if self.worker_manager.session_token_lifetime is None:
+                return json.dumps({ERROR_MESSAGE_KEY: "Session tokens are not enabled on this server."})
+
+            worker_id = query_request[WORKER_ID_KEY]
+            if not self.worker_manager.is_worker_allowed(worker_id):
+                logger.warning(f"Unknown worker {worker_id[0:WID_LEN]} tried to get a session token.")
+                return INVALID_WORKER
+
+            if not self.verify_worker_request(SESSION_TOKEN_ROUTE, query_request, allow_session_token=False):
+                logger.error(f"Failed to verify worker with id {worker_id[0:WID_LEN]}")
+                return INVALID_WORKER
+
+            if not self.worker_manager.is_worker_registered(worker_id):
+                logger.warning(f"Unregistered worker {worker_id[0:WID_LEN]} tried to get a session token.")
+                return UNREGISTERED_WORKER
+
+            session_token, expiry = self.worker_manager.issue_session_token(worker_id)
+            logger.info(f"Issued session token to {worker_id[0:WID_LEN]}.")
+            return json.dumps({SESSION_TOKEN: session_token, SESSION_TOKEN_EXPIRY: expiry})
 
         except Exception as e:
             logger.warning(str(e.__class__) + str(e))
@@ -609,12 +1355,18 @@ class DCFServer(object):
                           method='POST', callback=self.add_and_register_worker)
         application.route(f"/{CHALLENGE_PHRASE_ROUTE}/<worker_id>",
                           method='GET', callback=self.worker_manager.get_challenge_phrase)
+        application.route(f"/{SESSION_TOKEN_ROUTE}",
+                          method='POST', callback=self.return_session_token)
         application.route(f"/{RETURN_GLOBAL_MODEL_ROUTE}",
                           method='POST', callback=self.return_global_model)
         application.route(f"/{NOTIFY_ME_IF_GM_VERSION_UPDATED_ROUTE}",
                           method='POST', callback=self.notify_me_if_gm_version_updated)
+        application.route(f"/{NOTIFY_AND_RETURN_GLOBAL_MODEL_ROUTE}",
+                          method='POST', callback=self.notify_and_return_global_model)
         application.route(f"/{RECEIVE_WORKER_UPDATE_ROUTE}/<worker_id>",
                           method='POST', callback=self.receive_worker_update)
+        application.route(f"/{RECEIVE_WORKER_UPDATE_STREAM_ROUTE}/<worker_id>",
+                          method='POST', callback=self.receive_worker_update_stream)
 
         application.add_hook('after_request', self.enable_cors)
 
@@ -632,23 +1384,359 @@ class DCFServer(object):
             self.server_host_ip = server_adapter.host
             self.server_port = server_adapter.port
             run(application, server=server_adapter, debug=self.debug, quiet=True)
-        elif self.ssl_enabled:
-            run(application,
-                host=self.server_host_ip,
-                port=self.server_port,
-                server='gunicorn',
-                worker_class='gevent',
-                keyfile=self.ssl_keyfile,
-                certfile=self.ssl_certfile,
-                debug=self.debug,
-                timeout=60*60*24,
-                quiet=True)
+            return
+
+        run_options = dict(host=self.server_host_ip,
+                           port=self.server_port,
+                           server='gunicorn',
+                           worker_class='gevent',
+                           debug=self.debug,
+                           timeout=60*60*24,
+                           quiet=True)
+        if self.ssl_enabled:
+            run_options.update(keyfile=self.ssl_keyfile, certfile=self.ssl_certfile)
+        if self.num_processes > 1:
+            self.start_multi_process_server(application, run_options)
         else:
-            run(application,
-                host=self.server_host_ip,
-                port=self.server_port,
-                server='gunicorn',
-                worker_class='gevent',
-                debug=self.debug,
-                timeout=60*60*24,
-                quiet=True)
+            run(application, **run_options)
+
+    def start_multi_process_server(self, application, run_options):
+        """
+        Starts the server with num_processes gunicorn worker processes, in a
+        forked process, while this process serves the forwarding routes on a
+        local port for them - see create_forwarding_application() - and
+        publishes each new version of the global model to the
+        SharedServerState. This returns once stop_server() is called.
+
+        Parameters
+        ----------
+
+        application: bottle.Bottle
+            The application serving the workers.
+
+        run_options: dict
+            The arguments of bottle.run() for the gunicorn server.
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1024)
+        self.primary_address = f"http://127.0.0.1:{listener.getsockname()[1]}"
+        self.primary_pid = os.getpid()
+        self.publish_global_model()
+
+        fork_pool = ThreadPool(1)
+        pid = fork_pool.apply(self.fork_http_process, (application, run_options))
+        fork_pool.kill()
+
+        self.http_process_pid = pid
+        logger.info(f"Started {self.num_processes} server processes - forwarding to {self.primary_address}.")
+        publisher = gevent.spawn(self.publish_global_model_versions)
+        self.primary_server = WSGIServer(listener, self.create_forwarding_application(), log=None)
+        try:
+            self.primary_server.serve_forever()
+        finally:
+            publisher.kill()
+            self.stop_http_process(pid)
+            self.http_process_pid = None
+
+    def fork_http_process(self, application, run_options):
+        """
+        Forks the process running the gunicorn server. This is called in a
+        native thread, which is the only thread of the forked process, so
+        that the forked process starts with a new gevent hub, instead of
+        resuming the greenlets of this process.
+
+        Parameters
+        ----------
+
+        application: bottle.Bottle
+            The application serving the workers.
+
+        run_options: dict
+            The arguments of bottle.run() for the gunicorn server.
+
+        Returns
+        -------
+
+        int:
+            The pid of the forked process.
+        """
+        fork = monkey.get_original('os', 'fork')
+        pid = fork()
+        if pid != 0:
+            return pid
+
+        # the gunicorn arbiter and its workers exit from here, so the exit
+        # code they set is passed on.
+        exit_code = 1
+        try:
+            # the hub of this thread cannot watch the gunicorn workers, so
+            # they are forked and reaped without gevent.
+            os.fork = fork
+            signal.signal = monkey.get_original('signal', 'signal')
+            run(application, workers=self.num_processes,
+                post_worker_init=self.init_http_worker_process, **run_options)
+            exit_code = 0
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception as e:
+            logger.error(f"Server processes stopped: {str(e.__class__)} {str(e)}")
+        finally:
+            os._exit(exit_code)
+
+    @staticmethod
+    def stop_http_process(pid, timeout=30):
+        """
+        Stops the gunicorn server in the process with the given pid, killing
+        it if it has not stopped after timeout seconds.
+
+        Parameters
+        ----------
+
+        pid: int
+            The pid of the process.
+
+        timeout: float (default 30)
+            The number of seconds to wait for the process to stop.
+        """
+        def has_stopped():
+            # a SIGCHLD handler installed by gevent, e.g. for a subprocess
+            # started elsewhere, may already have reaped the process.
+            try:
+                return os.waitpid(pid, os.WNOHANG)[0] != 0
+            except ChildProcessError:
+                return True
+
+        try:
+            os.kill(pid, signal.SIGINT)
+            for _ in range(int(timeout / 0.1)):
+                if has_stopped():
+                    return
+                gevent.sleep(0.1)
+            logger.warning(f"Server process {pid} did not stop - killing it.")
+            os.kill(pid, signal.SIGKILL)
+            while not has_stopped():
+                gevent.sleep(0.1)
+        except ProcessLookupError:
+            pass
+
+    def stop_server(self):
+        """
+        Stops a server started with num_processes more than 1, terminating
+        its worker processes.
+        """
+        if self.primary_server is not None:
+            self.primary_server.stop()
+
+    def init_http_worker_process(self, worker):
+        """
+        Run by gunicorn in each HTTP worker process of a multi-process server
+        once it has started: the callbacks of the algorithm are replaced by
+        calls to the primary process, the global model version is read
+        from the SharedServerState, and the pending long-polls are woken up
+        each time it changes.
+
+        Parameters
+        ----------
+
+        worker: gunicorn.workers.base.Worker
+            The gunicorn worker.
+        """
+        self.forward_to_primary = True
+        self.primary_session = requests.Session()
+        # the objects bound to the hub of the primary process are replaced
+        self.cpu_pool = ThreadPool(self.cpu_pool_size) if self.cpu_pool_size > 0 else None
+        self.worker_manager.cpu_pool = self.cpu_pool
+        if self.worker_manager.signature_verifier is not None:
+            self.worker_manager.signature_verifier.cpu_pool = self.cpu_pool
+        self.gevent_pool = pool.Pool(None)
+        self.gm_version_changed_event = Event()
+
+        self.register_worker_callback = self.forward_register_worker
+        self.unregister_worker_callback = self.forward_unregister_worker
+        self.receive_worker_update_callback = self.forward_worker_update
+        self.stream_worker_updates = True
+        if self.check_update_metadata_callback is not None:
+            self.check_update_metadata_callback = self.forward_update_metadata
+        if self.is_worker_selected_callback is not None:
+            self.is_worker_selected_callback = self.forward_is_worker_selected
+        self.is_global_model_most_recent = self.is_published_global_model_version
+        gevent.spawn(self.watch_global_model_version)
+
+    def call_primary(self, route, data=b''):
+        """
+        Sends a request to an forwarding route from an HTTP worker process.
+
+        Parameters
+        ----------
+
+        route: str
+            The route, under FORWARD_ROUTE.
+
+        data: bytes or file-like object (default b'')
+            The body of the request.
+
+        Returns
+        -------
+
+        bytes:
+            The body of the response.
+        """
+        primary_response = self.primary_session.post(
+            f"{self.primary_address}/{FORWARD_ROUTE}/{route}", data=data,
+            headers={update_header(FORWARD_TOKEN_KEY): self.forward_token})
+        primary_response.raise_for_status()
+        return primary_response.content
+
+    def forward_register_worker(self, worker_id):
+        self.call_primary(f"{REGISTER_WORKER_ROUTE}/{worker_id}")
+
+    def forward_unregister_worker(self, worker_id):
+        self.call_primary(f"{UNREGISTER_WORKER_ROUTE}/{worker_id}")
+
+    def forward_update_metadata(self, worker_id, update_metadata):
+        return json.loads(self.call_primary(f"{CHECK_UPDATE_METADATA_ROUTE}/{worker_id}",
+                                               msgpack.packb(update_metadata)))
+
+    def forward_is_worker_selected(self, worker_id):
+        return json.loads(self.call_primary(f"{IS_WORKER_SELECTED_ROUTE}/{worker_id}"))
+
+    def forward_worker_update(self, worker_id, model_update_file):
+        try:
+            return self.call_primary(f"{RECEIVE_WORKER_UPDATE_ROUTE}/{worker_id}",
+                                        model_update_file).decode('utf-8')
+        finally:
+            model_update_file.close()
+
+    def is_published_global_model_version(self, version):
+        """
+        Returns whether the version is the version of the global model
+        published in the SharedServerState.
+
+        Parameters
+        ----------
+
+        version: object
+            The version of the global model.
+
+        Returns
+        -------
+
+        bool:
+            True if the version is the published version.
+        """
+        return version == self.shared_state.get_global_model_version()
+
+    def watch_global_model_version(self):
+        """
+        Greenlet function run in each HTTP worker process of a multi-process
+        server, which wakes up the pending long-polls when the version of
+        the global model in the SharedServerState changes, and stops the
+        gunicorn server if the primary process has exited without stopping
+        it, so that the HTTP processes are not left running as orphans.
+        """
+        version = self.shared_state.get_global_model_version()
+        while True:
+            gevent.sleep(SHARED_STATE_POLL_INTERVAL)
+            try:
+                os.kill(self.primary_pid, 0)
+            except ProcessLookupError:
+                logger.error("The primary process has exited - stopping the server processes.")
+                os.kill(os.getppid(), signal.SIGINT)
+                return
+            new_version = self.shared_state.get_global_model_version()
+            if new_version != version:
+                version = new_version
+                version_event, self.gm_version_changed_event = \
+                    self.gm_version_changed_event, Event()
+                version_event.set()
+
+    def publish_global_model(self):
+        """
+        Serializes the current global model in the primary process of a
+        multi-process server, which stores it in the SharedServerState, and
+        then publishes its version there.
+        """
+        try:
+            self.get_global_model_bytes()
+            self.shared_state.set_global_model_version(self.global_model_cache.latest_version)
+        except Exception as e:
+            logger.warning(f"Unable to publish the global model: {str(e.__class__)} {str(e)}")
+
+    def publish_global_model_versions(self):
+        """
+        Greenlet function run in the primary process of a multi-process
+        server, which publishes the global model each time its version
+        changes - see publish_global_model().
+        """
+        while True:
+            version_event = self.gm_version_changed_event
+            version = self.shared_state.get_global_model_version()
+            if version is None or not self.is_global_model_most_recent(version):
+                self.publish_global_model()
+            version_event.wait(self.model_check_interval)
+
+    def check_forward_token(self):
+        """
+        Aborts the request to an forwarding route unless it carries the
+        token shared with the HTTP worker processes.
+        """
+        token = request.get_header(update_header(FORWARD_TOKEN_KEY), '')
+        if not hmac.compare_digest(token, self.forward_token):
+            abort(403, "Invalid forwarding token.")
+
+    def serve_forwarded_register_worker(self, worker_id):
+        self.check_forward_token()
+        self.register_worker_callback(worker_id)
+        return ''
+
+    def serve_forwarded_unregister_worker(self, worker_id):
+        self.check_forward_token()
+        self.unregister_worker_callback(worker_id)
+        return ''
+
+    def serve_forwarded_update_metadata(self, worker_id):
+        self.check_forward_token()
+        return json.dumps(bool(self.check_update_metadata_callback(worker_id, msgpack.unpackb(request.body.read()))))
+
+    def serve_forwarded_is_worker_selected(self, worker_id):
+        self.check_forward_token()
+        return json.dumps(bool(self.is_worker_selected_callback(worker_id)))
+
+    def serve_forwarded_worker_update(self, worker_id):
+        self.check_forward_token()
+        model_update = request.body if self.stream_worker_updates else request.body.read()
+        return self.receive_worker_update_callback(worker_id, model_update)
+
+    def serve_forwarded_global_model(self):
+        self.check_forward_token()
+        base_version, codec, model_format = msgpack.unpackb(request.body.read())
+        return self.get_global_model_bytes(base_version, codec, model_format)
+
+    def create_forwarding_application(self):
+        """
+        Creates the application serving the forwarding routes, to which the
+        HTTP worker processes of a multi-process server forward the calls to
+        the callbacks of the algorithm.
+
+        Returns
+        -------
+
+        bottle.Bottle:
+            The application.
+        """
+        application = Bottle()
+        application.route(f"/{FORWARD_ROUTE}/{REGISTER_WORKER_ROUTE}/<worker_id>",
+                          method='POST', callback=self.serve_forwarded_register_worker)
+        application.route(f"/{FORWARD_ROUTE}/{UNREGISTER_WORKER_ROUTE}/<worker_id>",
+                          method='POST', callback=self.serve_forwarded_unregister_worker)
+        application.route(f"/{FORWARD_ROUTE}/{CHECK_UPDATE_METADATA_ROUTE}/<worker_id>",
+                          method='POST', callback=self.serve_forwarded_update_metadata)
+        application.route(f"/{FORWARD_ROUTE}/{IS_WORKER_SELECTED_ROUTE}/<worker_id>",
+                          method='POST', callback=self.serve_forwarded_is_worker_selected)
+        application.route(f"/{FORWARD_ROUTE}/{RECEIVE_WORKER_UPDATE_ROUTE}/<worker_id>",
+                          method='POST', callback=self.serve_forwarded_worker_update)
+        application.route(f"/{FORWARD_ROUTE}/{RETURN_GLOBAL_MODEL_ROUTE}",
+                          method='POST', callback=self.serve_forwarded_global_model)
+        return application
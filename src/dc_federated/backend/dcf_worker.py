@@ -7,17 +7,22 @@ import gevent
 from gevent import monkey; monkey.patch_all()
 from datetime import datetime
 
-import zlib
+import io
+import json
+import time
 import msgpack
-import hashlib
+import secrets
 from nacl.signing import SigningKey, VerifyKey
 from nacl.encoding import HexEncoder
 
 import requests
 from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from dc_federated.backend._constants import *
-from dc_federated.backend.backend_utils import is_valid_model_dict
+from dc_federated.backend.backend_utils import is_valid_model_dict, json_body_digest, \
+    signed_request_message, compressed_update_digest, update_header
+from dc_federated.backend._codecs import DEFAULT_CODEC, get_codec
 
 import logging
 
@@ -25,6 +30,9 @@ import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(level=logging.INFO)
 
+# urllib3 renamed method_whitelist to allowed_methods in version 1.26
+RETRY_METHODS_ARG = 'allowed_methods' if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS') else 'method_whitelist'
+
 
 class DCFWorker(object):
     """
@@ -54,6 +62,53 @@ class DCFWorker(object):
         Name of the private key to use to authenticate the worker to the server.
         No authentication is performed if a None is passed.  Name of the
         corresponding public key file is assumed to be key_file + '.pub'
+
+    long_poll_returns_model: bool (default False)
+        If True, the global model is returned by the long-poll request
+        itself, instead of requiring a separate request after the long-poll
+        notifies the worker that the global model has changed.
+
+    get_global_model_delta_base_version: () -> object (default None)
+        Optional. This function is expected to return the version of the
+        global model that the worker can apply a model difference to, or None
+        if it cannot. When it returns a version, the server may return the
+        difference between the current global model and that version, in
+        which case the dictionary passed to global_model_version_changed_callback
+        also has a GLOBAL_MODEL_BASE_VERSION entry.
+
+    signed_requests: bool (default True)
+        If True, each request is authenticated by signing the request itself
+        along with a timestamp and a nonce. Otherwise a challenge phrase is
+        requested from the server and signed before each request for the
+        global model.
+
+    session_tokens: bool (default False)
+        If True, the worker exchanges a signed request for a session token
+        after registering, and authenticates its requests with the token
+        until shortly before it expires, when it is renewed. This is cheaper
+        for the server to check than a signature, but the server must have
+        been started with a session_token_lifetime. If it was not, the
+        worker falls back to signing each request.
+
+    raw_update_uploads: bool (default True)
+        If True, model updates are sent as the raw application/octet-stream
+        body of the request, with the authentication fields and the update
+        metadata in headers. Otherwise they are sent as a multipart form.
+
+    update_codec: str (default 'zlib')
+        The name of the codec to compress the model updates with - see
+        dc_federated.backend._codecs. The server must have the codec
+        available, e.g. the zstandard package installed for 'zstd'.
+
+    model_codec: str (default 'zlib')
+        The name of the codec to ask the server to compress the global model
+        with. The server falls back to zlib if it does not have the codec.
+
+    global_model_format: str (default None)
+        Optional. The format to ask the server to convert the global model
+        to, e.g. 'float16' - see the convert_global_model_callback of the
+        DCFServer. The model is returned unconverted if the server does not
+        support the format.
     """
     def __init__(
             self,
@@ -62,7 +117,15 @@ class DCFWorker(object):
             server_port,
             global_model_version_changed_callback,
             get_worker_version_of_global_model,
-            private_key_file):
+            private_key_file,
+            long_poll_returns_model=False,
+            get_global_model_delta_base_version=None,
+            signed_requests=True,
+            session_tokens=False,
+            raw_update_uploads=True,
+            update_codec=DEFAULT_CODEC,
+            model_codec=DEFAULT_CODEC,
+            global_model_format=None):
         self.server_protocol = server_protocol
 
         self.server_host_ip = server_host_ip
@@ -70,12 +133,29 @@ class DCFWorker(object):
         self.global_model_version_changed_callback = global_model_version_changed_callback
         self.get_worker_version_global_model = get_worker_version_of_global_model
         self.private_key, self.public_key_str = DCFWorker.get_keys_from_file(private_key_file)
+        self.long_poll_returns_model = long_poll_returns_model
+        self.get_global_model_delta_base_version = get_global_model_delta_base_version
+        self.signed_requests = signed_requests
+        self.session_tokens = session_tokens
+        self.session_token = None
+        self.session_token_expiry = None
+        self.raw_update_uploads = raw_update_uploads
+        self.update_codec = get_codec(update_codec)
+        self.model_codec = get_codec(model_codec)
+        self.global_model_format = global_model_format
 
         self.server_loc = f"{self.server_protocol}://{self.server_host_ip}:{self.server_port}"
         self.worker_id = None
 
         self.session = requests.Session()
-        self.session.mount(f"{self.server_protocol}://", HTTPAdapter(max_retries=10))
+        if self.signed_requests and not self.session_tokens:
+            # a signed request can only be accepted once, so it is safe to
+            # retry any request that failed on the connection.
+            max_retries = Retry(total=10, connect=10, read=10, status=0, redirect=0,
+                                **{RETRY_METHODS_ARG: False})
+        else:
+            max_retries = 10
+        self.session.mount(f"{self.server_protocol}://", HTTPAdapter(max_retries=max_retries))
 
         if server_protocol == 'http' and server_host_ip != 'localhost':
             logger.warning("Security alert: https is not enabled!")
@@ -133,6 +213,134 @@ class DCFWorker(object):
         else:
             return self.private_key.sign(phrase_to_sign).hex()
 
+    def sign_request(self, route, data, body_digest=None):
+        """
+        Adds a timestamp, a nonce and the signature of the request to the
+        request data - see backend_utils.signed_request_message().
+
+        Parameters
+        ----------
+
+        route: str
+            The route the request is sent to.
+
+        data: dict
+            The data of the request, which is updated in place.
+
+        body_digest: bytes (default None)
+            The digest of the body of the request. If None, the data is the
+            json body of the request and its digest is used.
+
+        Returns
+        -------
+
+        dict:
+            The updated data.
+        """
+        data[REQUEST_TIMESTAMP] = int(time.time())
+        data[REQUEST_NONCE] = secrets.token_hex(16)
+        if body_digest is None:
+            body_digest = json_body_digest(data)
+        data[SIGNED_PHRASE] = self.get_signed_phrase(signed_request_message(
+            route, self.worker_id, data[REQUEST_TIMESTAMP], data[REQUEST_NONCE], body_digest))
+        return data
+
+    def sign_json_request(self, route, data, use_session_token=True):
+        """
+        Authenticates the json request data: with the session token, if
+        session_tokens is True and one is available, and otherwise either as
+        a signed request or by signing a new challenge phrase from the server,
+        depending on signed_requests.
+
+        Parameters
+        ----------
+
+        route: str
+            The route the request is sent to.
+
+        data: dict
+            The data of the request, which is updated in place.
+
+        use_session_token: bool (default True)
+            Whether the session token may be used.
+
+        Returns
+        -------
+
+        dict:
+            The updated data.
+        """
+        for key in [REQUEST_TIMESTAMP, REQUEST_NONCE, SIGNED_PHRASE, SESSION_TOKEN]:
+            data.pop(key, None)
+        if use_session_token and self.session_tokens:
+            session_token = self.get_session_token()
+            if session_token is not None:
+                data[SESSION_TOKEN] = session_token
+                return data
+        if self.signed_requests:
+            return self.sign_request(route, data)
+        response = self.session.get(f"{self.server_loc}/{CHALLENGE_PHRASE_ROUTE}/{self.worker_id}")
+        data[SIGNED_PHRASE] = self.get_signed_phrase(response.content)
+        return data
+
+    def get_session_token(self):
+        """
+        Returns the session token for the worker, requesting a new one from
+        the server if there is none or it is about to expire.
+
+        Returns
+        -------
+
+        str:
+            The session token, or None if the server did not issue one.
+        """
+        if self.session_token is not None and \
+                time.time() < self.session_token_expiry - SESSION_TOKEN_RENEWAL_MARGIN:
+            return self.session_token
+
+        self.session_token = None
+        data = self.sign_json_request(
+            SESSION_TOKEN_ROUTE, {WORKER_ID_KEY: self.worker_id}, use_session_token=False)
+        response = self.session.post(f"{self.server_loc}/{SESSION_TOKEN_ROUTE}", json=data).content
+        try:
+            response = json.loads(response)
+        except ValueError:
+            logger.error(f"Unable to get a session token - received response {response}")
+            return None
+        if ERROR_MESSAGE_KEY in response:
+            logger.warning(f"Unable to get a session token - {response[ERROR_MESSAGE_KEY]} "
+                           f"Falling back to signing each request.")
+            self.session_tokens = False
+            return None
+
+        self.session_token = response[SESSION_TOKEN]
+        self.session_token_expiry = response[SESSION_TOKEN_EXPIRY]
+        logger.info(f"Received session token for worker {self.worker_id[0:WID_LEN]}.")
+        return self.session_token
+
+    def check_session_token_response(self, response):
+        """
+        Drops the session token if the server rejected the request, e.g.
+        because the server was restarted, so that a new one is requested
+        for the next request.
+
+        Parameters
+        ----------
+
+        response: binary string
+            The response from the server.
+
+        Returns
+        -------
+
+        binary string:
+            The response.
+        """
+        if self.session_token is not None and response == INVALID_WORKER.encode():
+            logger.warning(f"Session token of worker {self.worker_id[0:WID_LEN]} was rejected.")
+            self.session_token = None
+        return response
+
     def get_public_key_str(self):
         """
         Returns the the string version of the public key for the private key of
@@ -192,57 +400,138 @@ class DCFWorker(object):
         """
         # First confirm that the global model version is newer
         # compared to the version that the worker has using long polling
-        response = self.session.get(f"{self.server_loc}/{CHALLENGE_PHRASE_ROUTE}/{self.worker_id}")
-        challenge_phrase = response.content
         data = {
             WORKER_ID_KEY: self.worker_id,
-            LAST_WORKER_MODEL_VERSION: self.get_worker_version_global_model(),
-            SIGNED_PHRASE: self.get_signed_phrase(challenge_phrase)
+            LAST_WORKER_MODEL_VERSION: self.get_worker_version_global_model()
         }
+        if self.get_global_model_delta_base_version is not None:
+            base_version = self.get_global_model_delta_base_version()
+            if base_version is not None:
+                data[GLOBAL_MODEL_BASE_VERSION] = base_version
+        if self.global_model_format is not None:
+            data[GLOBAL_MODEL_FORMAT] = self.global_model_format
+
+        codec_headers = {update_header(CODEC_KEY): self.model_codec.name}
+        if self.long_poll_returns_model:
+            response = self.session.post(
+                f"{self.server_loc}/{NOTIFY_AND_RETURN_GLOBAL_MODEL_ROUTE}",
+                json=self.sign_json_request(NOTIFY_AND_RETURN_GLOBAL_MODEL_ROUTE, data),
+                headers=codec_headers
+            )
+            return self.unpack_global_model(self.check_session_token_response(response.content),
+                                            response.headers.get(update_header(CODEC_KEY), DEFAULT_CODEC))
+
         response = self.session.post(
             f"{self.server_loc}/{NOTIFY_ME_IF_GM_VERSION_UPDATED_ROUTE}",
-            json=data
+            json=self.sign_json_request(NOTIFY_ME_IF_GM_VERSION_UPDATED_ROUTE, data)
         ).content
+        self.check_session_token_response(response)
         if response != GLOBAL_MODEL_UPDATED_STRING.encode():
             logger.error(f"Unable to retrieve confirmation global model has changed - received response {response}")
             logger.error("Global model not retrieved.")
             return response
 
         # Now get the model.
-        response = self.session.get(f"{self.server_loc}/{CHALLENGE_PHRASE_ROUTE}/{self.worker_id}")
-        challenge_phrase = response.content
-        data[SIGNED_PHRASE] = self.get_signed_phrase(challenge_phrase)
         del data[LAST_WORKER_MODEL_VERSION]
         response = self.session.post(f"{self.server_loc}/{RETURN_GLOBAL_MODEL_ROUTE}",
-                                     json=data).content
+                                     json=self.sign_json_request(RETURN_GLOBAL_MODEL_ROUTE, data),
+                                     headers=codec_headers)
+        return self.unpack_global_model(self.check_session_token_response(response.content),
+                                        response.headers.get(update_header(CODEC_KEY), DEFAULT_CODEC))
+
+    def unpack_global_model(self, response, codec=DEFAULT_CODEC):
+        """
+        Decompresses and deserializes the global model returned by the server.
+
+        Parameters
+        ----------
+
+        response: binary string
+            The response from the server.
+
+        codec: str (default 'zlib')
+            The name of the codec the server compressed the model with, as
+            given by the codec header of its response.
+
+        Returns
+        -------
+
+        dict or binary string:
+            The global model dictionary, or the response itself if it was an
+            error message from the server.
+        """
         try:
-            model = msgpack.unpackb(zlib.decompress(response))
+            model = msgpack.unpackb(get_codec(codec).decompress(response))
+            if not isinstance(model, dict):
+                raise ValueError("Response is not a model dictionary.")
             logger.info(f"Received global model for worker {self.worker_id[0:WID_LEN]}")
             return model
-        except zlib.error as e:
+        except Exception as e:
             fn = f'{self.worker_id[0:WID_LEN]}_server_error_{datetime.now().strftime("%Y_%m_%d-%H_%M_%S_%f")}'
-            with open(fn, 'w') as f:
+            with open(fn, 'wb') as f:
                 f.write(response)
             logger.error(f"Exception {str(e)} - written error message from server to : {fn}")
             return response
 
-    def send_model_update(self, model_update):
+    def send_model_update(self, model_update, update_metadata=None):
         """
         Sends the model update from the worker. Worker must register before sending
-        a model update.
+        a model update. The signature covers the compressed update and the
+        update metadata, so that the server can authenticate the update, and
+        check its metadata, before decompressing it.
 
         Parameters
         ----------
 
         model_update: binary string
             The model update to send to the server.
+
+        update_metadata: dict (default None)
+            Optional application metadata for the server to check the update
+            against before decompressing it, e.g. the version of the global
+            model the update was trained from - see the
+            check_update_metadata_callback of the DCFServer. It must be
+            serializable with msgpack. The WORKER_ID_KEY entry is set to the
+            id of this worker.
+
+        Returns
+        -------
+
+        binary string:
+            The response from the server.
         """
-        return self.session.post(
+        compressed_update = self.update_codec.compress(model_update)
+        update_metadata = dict(update_metadata) if update_metadata is not None else {}
+        update_metadata[WORKER_ID_KEY] = self.worker_id
+        update_metadata[UPDATE_CODEC_KEY] = self.update_codec.name
+        update_metadata = msgpack.packb(update_metadata)
+        body_digest = compressed_update_digest(io.BytesIO(compressed_update), update_metadata)
+
+        session_token = self.get_session_token() if self.session_tokens else None
+        if session_token is not None:
+            files = {SESSION_TOKEN: session_token}
+        elif self.signed_requests:
+            files = self.sign_request(RECEIVE_WORKER_UPDATE_ROUTE, {}, body_digest)
+            files[REQUEST_TIMESTAMP] = str(files[REQUEST_TIMESTAMP])
+        else:
+            files = {SIGNED_PHRASE: self.get_signed_phrase(body_digest)}
+
+        if self.raw_update_uploads:
+            headers = {update_header(key): val for key, val in files.items()}
+            headers[update_header(UPDATE_METADATA_KEY)] = update_metadata.hex()
+            headers['Content-Type'] = 'application/octet-stream'
+            return self.check_session_token_response(self.session.post(
+                f"{self.server_loc}/{RECEIVE_WORKER_UPDATE_STREAM_ROUTE}/{self.worker_id}",
+                data=compressed_update,
+                headers=headers
+            ).content)
+
+        files[UPDATE_METADATA_KEY] = update_metadata
+        files[WORKER_MODEL_UPDATE_KEY] = compressed_update
+        return self.check_session_token_response(self.session.post(
             f"{self.server_loc}/{RECEIVE_WORKER_UPDATE_ROUTE}/{self.worker_id}",
-            files={WORKER_MODEL_UPDATE_KEY: zlib.compress(model_update),
-                   SIGNED_PHRASE: self.get_signed_phrase(hashlib.sha256(model_update).digest())
-                   },
-        ).content
+            files=files
+        ).content)
 
     def run(self):
         """
@@ -48,3 +48,5 @@ class StoppableServer(ServerAdapter):
     def shutdown(self):
         logger.info("Shutting down server.")
         self.server.shutdown()
+        # release the port straight away for the next server.
+        self.server.server_close()
@@ -2,6 +2,7 @@
 Test worker authentication related functions.
 """
 
+import io
 import os
 import zlib
 import msgpack
@@ -15,6 +16,7 @@ from gevent import Greenlet, sleep
 
 from dc_federated.backend import DCFServer, DCFWorker, create_model_dict, is_valid_model_dict
 from dc_federated.backend._constants import *
+from dc_federated.backend.backend_utils import compressed_update_digest
 from dc_federated.backend.worker_key_pair_tool import gen_pair, verify_pair
 from dc_federated.utils import StoppableServer, get_host_ip
 
@@ -123,7 +125,8 @@ def test_worker_authentication():
         receive_worker_update_callback=test_rec_server_update_cb,
         server_mode_safe=True,
         key_list_file=worker_key_file,
-        load_last_session_workers=False
+        load_last_session_workers=False,
+        session_token_lifetime=600
     )
     stoppable_server = StoppableServer(host=get_host_ip(), port=8080)
 
@@ -141,7 +144,9 @@ def test_worker_authentication():
             server_port=dcf_server.server_port,
             global_model_version_changed_callback=test_glob_mod_chng_cb,
             get_worker_version_of_global_model=test_get_last_glob_model_ver,
-            private_key_file=worker_key_file_prefix + f"_{n}")
+            private_key_file=worker_key_file_prefix + f"_{n}",
+            session_tokens=n % 2 == 0,
+            raw_update_uploads=n % 3 != 0)
         for n in range(num_workers)]
 
     # test various worker actions
@@ -154,6 +159,24 @@ def test_worker_authentication():
         assert global_model_dict[GLOBAL_MODEL_VERSION] == global_model_version
         assert worker_updates[worker.worker_id] == b'model_update'
         assert worker.worker_id == key.encode(encoder=HexEncoder).decode('utf-8')
+        assert (worker.session_token is not None) == worker.session_tokens
+
+    # the signature covers the compressed update and its metadata
+    worker = workers[0]
+    compressed_update = zlib.compress(b'model update')
+    update_metadata = msgpack.packb({WORKER_ID_KEY: worker.worker_id})
+    files = {SIGNED_PHRASE: worker.get_signed_phrase(
+        compressed_update_digest(io.BytesIO(compressed_update), update_metadata))}
+    for tampered_update, tampered_metadata in [
+            (zlib.compress(b'tampered update'), update_metadata),
+            (compressed_update, msgpack.packb({WORKER_ID_KEY: worker.worker_id, 'extra': 1}))]:
+        response = requests.post(
+            f"http://{dcf_server.server_host_ip}:{dcf_server.server_port}/"
+            f"{RECEIVE_WORKER_UPDATE_ROUTE}/{worker.worker_id}",
+            files={**files, UPDATE_METADATA_KEY: tampered_metadata, WORKER_MODEL_UPDATE_KEY: tampered_update}
+        ).content
+        assert response.decode('utf-8') == INVALID_WORKER
+    assert worker_updates[worker.worker_id] == b'model_update'
 
     # try to authenticate a unregistered worker
     gen_pair('bad_worker')
@@ -6,14 +6,18 @@ import gevent
 from gevent import Greenlet, sleep
 from gevent import monkey; monkey.patch_all()
 
+import io
 import os
 import msgpack
 import zlib
+import hashlib
 import requests
 import json
 
 from dc_federated.backend import DCFServer, DCFWorker, create_model_dict, is_valid_model_dict
 from dc_federated.backend._constants import *
+from dc_federated.backend.backend_utils import decompress_stream, update_header
+from dc_federated.backend._codecs import get_codec
 from dc_federated.utils import StoppableServer, get_host_ip
 
 
@@ -92,7 +96,9 @@ def test_server_functionality():
         is_global_model_most_recent=is_global_model_most_recent,
         receive_worker_update_callback=test_rec_server_update_cb,
         server_mode_safe=False,
-        key_list_file=None
+        key_list_file=None,
+        max_update_size=2 ** 20,
+        check_update_metadata_callback=lambda worker_id, metadata: not metadata.get('reject', False)
     )
     server_gl = Greenlet.spawn(begin_server)
     sleep(2)
@@ -153,6 +159,17 @@ def test_server_functionality():
     assert model_return[GLOBAL_MODEL_VERSION] == global_model_version
     assert msgpack.unpackb(model_return[GLOBAL_MODEL]) == "Pickle dump of a string"
 
+    # the global model is compressed with the codec the worker asks for, if
+    # the server has it, or with zlib otherwise.
+    for codec, expected_codec in [('lzma+shuffle', 'lzma+shuffle'), ('none', 'none'), ('unknown', 'zlib')]:
+        model_response = requests.post(
+            f"http://{dcf_server.server_host_ip}:{dcf_server.server_port}/{RETURN_GLOBAL_MODEL_ROUTE}",
+            json={WORKER_ID_KEY: worker_ids[0],
+                  SIGNED_PHRASE: ""},
+            headers={update_header(CODEC_KEY): codec})
+        assert model_response.headers[update_header(CODEC_KEY)] == expected_codec
+        assert msgpack.unpackb(get_codec(expected_codec).decompress(model_response.content)) == model_return
+
     # test sending the model update
     response = requests.post(
         f"http://{dcf_server.server_host_ip}:{dcf_server.server_port}/{RECEIVE_WORKER_UPDATE_ROUTE}/{worker_ids[1]}",
@@ -173,6 +190,32 @@ def test_server_functionality():
     assert 3 not in worker_updates
     assert response.decode('UTF-8') == INVALID_WORKER
 
+    # updates that decompress beyond the maximum size are rejected
+    response = requests.post(
+        f"http://{dcf_server.server_host_ip}:{dcf_server.server_port}/{RECEIVE_WORKER_UPDATE_ROUTE}/{worker_ids[2]}",
+        files={WORKER_MODEL_UPDATE_KEY: zlib.compress(b'0' * (2 ** 20 + 1)),
+               SIGNED_PHRASE: ""}).content
+
+    assert worker_ids[2] not in worker_updates
+    assert response.decode('UTF-8') == f"Decompressed data exceeds the maximum size of {2 ** 20} bytes."
+
+    # updates are checked against their metadata before being decompressed
+    response = requests.post(
+        f"http://{dcf_server.server_host_ip}:{dcf_server.server_port}/{RECEIVE_WORKER_UPDATE_ROUTE}/{worker_ids[2]}",
+        files={WORKER_MODEL_UPDATE_KEY: b'not compressed',
+               UPDATE_METADATA_KEY: msgpack.packb({WORKER_ID_KEY: worker_ids[2], 'reject': True}),
+               SIGNED_PHRASE: ""}).content
+    assert worker_ids[2] not in worker_updates
+    assert response.decode('UTF-8') == UPDATE_REJECTED
+
+    response = requests.post(
+        f"http://{dcf_server.server_host_ip}:{dcf_server.server_port}/{RECEIVE_WORKER_UPDATE_ROUTE}/{worker_ids[2]}",
+        files={WORKER_MODEL_UPDATE_KEY: zlib.compress(msgpack.packb("Model update!!")),
+               UPDATE_METADATA_KEY: msgpack.packb({WORKER_ID_KEY: worker_ids[1]}),
+               SIGNED_PHRASE: ""}).content
+    assert worker_ids[2] not in worker_updates
+    assert response.decode('UTF-8') == INVALID_WORKER
+
     # *********** #
     # now test a DCFWorker on the same server.
     dcf_worker = DCFWorker(
@@ -200,4 +243,60 @@ def test_server_functionality():
     assert response.decode(
         "UTF-8") == f"Update received for worker {worker_ids[3][0:WID_LEN]}."
 
+    # large updates are streamed to a temporary file
+    large_update = os.urandom(2 ** 19)
+    response = dcf_worker.send_model_update(large_update)
+    assert worker_updates[worker_ids[3]] == large_update
+    assert response.decode(
+        "UTF-8") == f"Update received for worker {worker_ids[3][0:WID_LEN]}."
+
+    response = requests.post(
+        f"http://{dcf_server.server_host_ip}:{dcf_server.server_port}/"
+        f"{RECEIVE_WORKER_UPDATE_STREAM_ROUTE}/{worker_ids[3]}",
+        data=zlib.compress(b"Update without metadata"),
+        headers={'Content-Type': 'application/octet-stream'}).content
+    assert ERROR_MESSAGE_KEY in json.loads(response)
+    assert worker_updates[worker_ids[3]] == large_update
+
+    response = dcf_worker.send_model_update(
+        msgpack.packb("Rejected DCFWorker model update"), {'reject': True})
+    assert worker_updates[worker_ids[3]] == large_update
+    assert response.decode("UTF-8") == UPDATE_REJECTED
+
+    # other codecs are named in the update metadata
+    dcf_worker.update_codec = get_codec('lzma+shuffle')
+    dcf_worker.model_codec = get_codec('none')
+    response = dcf_worker.send_model_update(msgpack.packb("lzma model update"))
+    assert msgpack.unpackb(worker_updates[worker_ids[3]]) == "lzma model update"
+    assert response.decode(
+        "UTF-8") == f"Update received for worker {worker_ids[3][0:WID_LEN]}."
+    assert dcf_worker.get_global_model() == global_model_dict
+
     stoppable_server.shutdown()
+
+
+def test_decompress_stream():
+    data = os.urandom(2 ** 16) + b'0' * 2 ** 20
+    compressed = io.BytesIO(zlib.compress(data))
+    decompressed = io.BytesIO()
+    digest = decompress_stream(compressed, decompressed, len(data), chunk_size=2 ** 12)
+    assert decompressed.getvalue() == data
+    assert digest == hashlib.sha256(data).digest()
+
+    # the maximum size is enforced before the whole stream is decompressed
+    compressed.seek(0)
+    decompressed = io.BytesIO()
+    try:
+        decompress_stream(compressed, decompressed, 2 ** 17, chunk_size=2 ** 12)
+    except ValueError:
+        assert len(decompressed.getvalue()) <= 2 ** 17
+    else:
+        assert False
+
+    # truncated streams are errors
+    try:
+        decompress_stream(io.BytesIO(zlib.compress(data)[:-10]), io.BytesIO(), None)
+    except zlib.error:
+        assert True
+    else:
+        assert False
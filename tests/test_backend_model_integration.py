@@ -3,6 +3,7 @@ Test the integration of the backend+algorithm and applications using the
 example_dcf_model.
 """
 import os
+import signal
 import time
 import torch
 import logging
@@ -45,7 +46,10 @@ def test_example():
     # TODO: the sleeps above to let the server/workers
     # finish is a hack - try to do something smarter.
 
-    server_process.terminate()
+    # quick shutdown of gunicorn, so that the port is free for the next
+    # test without waiting for the open long-polls to time out.
+    os.kill(server_process.pid, signal.SIGINT)
+    server_process.join()
 
     # check that the global and local model parameters are equal
     logger.info("Checking tensors are equal")
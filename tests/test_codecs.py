@@ -0,0 +1,43 @@
+"""
+Tests for the compression codecs.
+"""
+import io
+import os
+
+import numpy as np
+
+from dc_federated.backend._codecs import CODECS, get_codec, shuffle
+
+
+def test_codecs():
+    data = np.random.randn(2 ** 18 + 3).astype(np.float32).tobytes() + b'tail'
+    for name, codec in CODECS.items():
+        assert codec.name == name
+        compressed = codec.compress(data)
+        assert codec.decompress(compressed) == data
+
+        # the reader never returns more than the bytes asked for
+        reader = codec.reader(io.BytesIO(compressed))
+        chunks = list(iter(lambda: reader.read(2 ** 12), b''))
+        assert all(len(chunk) <= 2 ** 12 for chunk in chunks)
+        assert b''.join(chunks) == data
+
+    assert get_codec('zlib+shuffle') is CODECS['zlib+shuffle']
+    try:
+        get_codec('unknown')
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+def test_shuffle():
+    data = os.urandom(2 ** 12 + 7)
+    shuffled = shuffle(data, 4, 2 ** 10)
+    assert shuffled != data
+    assert shuffle(shuffled, 4, 2 ** 10, inverse=True) == data
+    assert shuffle(b'\x00\x01\x02\x03\x10\x11\x12\x13', 4, 8) == b'\x00\x10\x01\x11\x02\x12\x03\x13'
+
+    # float tensors compress better once shuffled
+    params = np.random.randn(2 ** 16).astype(np.float32).tobytes()
+    assert len(get_codec('zlib+shuffle').compress(params)) < len(get_codec('zlib').compress(params))
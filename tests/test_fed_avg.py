@@ -7,14 +7,21 @@ enough that the amount of requried testing infrastructure is not justified.
 """
 
 import io
-import msgpack
+import math
+import gevent
 import torch
+from datetime import datetime
 
 from torch import nn
 import torch.nn.functional as F
 
-from dc_federated.algorithms.fed_avg import FedAvgServer, FedAvgModelTrainer
-from dc_federated.backend import GLOBAL_MODEL, GLOBAL_MODEL_VERSION
+from dc_federated.algorithms.fed_avg import FedAvgServer, FedAvgEdgeServer, FedAvgModelTrainer
+from dc_federated.algorithms.fed_avg._constants import UPDATE_SIZE_KEY, UPDATE_MODEL_VERSION_KEY, \
+    SPARSE_UPDATE_KEY, SPARSE_INDICES_KEY, SPARSE_VALUES_KEY, QUANTIZATION_KEY, QUANTIZED_DELTA_KEY, \
+    FLOAT16_FORMAT
+from dc_federated.algorithms.quantization import quantize_state_dict, quantize_int8
+from dc_federated.algorithms.tensor_container import serialize_state_dict, deserialize_state_dict
+from dc_federated.backend import GLOBAL_MODEL, GLOBAL_MODEL_VERSION, GLOBAL_MODEL_BASE_VERSION
 
 
 
@@ -96,6 +103,12 @@ def assert_models_equal(model_1, model_2):
         assert torch.all(torch.eq(param_1.data, param_2.data))
 
 
+def assert_models_close(model_1, model_2):
+    for param_1, param_2 in zip(model_1.parameters(),
+                                model_2.parameters()):
+        assert torch.allclose(param_1.data, param_2.data)
+
+
 def test_fed_avg_server():
 
     trainer = FedAvgTestTrainer()
@@ -103,28 +116,43 @@ def test_fed_avg_server():
 
     # test model is loaded properly
     model_dict = fed_avg_server.return_global_model()
-    model_ret = torch.load(io.BytesIO(model_dict[GLOBAL_MODEL]))
+    model_ret = FedAvgTestModel()
+    model_ret.load_state_dict(deserialize_state_dict(model_dict[GLOBAL_MODEL])[0])
     assert_models_equal(model_ret, trainer.model)
 
     # test that worker updates are received properly.
     dummy_worker_id_1 = "dummy_worker_id_1"
     worker_model_1 = FedAvgTestModel()
     fed_avg_server.worker_updates[dummy_worker_id_1] = None
-    model_update = io.BytesIO()
-    torch.save(worker_model_1, model_update)
     fed_avg_server.receive_worker_update(
-        dummy_worker_id_1, msgpack.packb((15, model_update.getvalue())))
-    assert_models_equal(worker_model_1, fed_avg_server.worker_updates[dummy_worker_id_1][2])
+        dummy_worker_id_1,
+        io.BytesIO(serialize_state_dict(worker_model_1.state_dict(), {UPDATE_SIZE_KEY: 15})))
+    fed_avg_server.update_queue.join()
+    assert fed_avg_server.worker_updates[dummy_worker_id_1][1] == 15
+    assert fed_avg_server.agg_update_size == 15
+    agg_state_dict = fed_avg_server.param_layout.unflatten(fed_avg_server.agg_params)
+    for key, val in worker_model_1.state_dict().items():
+        assert torch.allclose(agg_state_dict[key], 15 * val)
+
+    # a second update from the same worker before the global update is ignored
+    fed_avg_server.receive_worker_update(
+        dummy_worker_id_1,
+        io.BytesIO(serialize_state_dict(worker_model_1.state_dict(), {UPDATE_SIZE_KEY: 30})))
+    fed_avg_server.update_queue.join()
+    assert fed_avg_server.worker_updates[dummy_worker_id_1][1] == 15
+    assert fed_avg_server.agg_update_size == 15
 
     # check that the global updates happen as expected
     dummy_worker_id_2 = "dummy_worker_id_2"
     fed_avg_server.update_lim = 2
     worker_model_2 = FedAvgTestModel()
     fed_avg_server.worker_updates[dummy_worker_id_2] = None
-    model_update = io.BytesIO()
-    torch.save(worker_model_2, model_update)
     fed_avg_server.receive_worker_update(
-        dummy_worker_id_2, msgpack.packb((20, model_update.getvalue())))
+        dummy_worker_id_2,
+        io.BytesIO(serialize_state_dict(worker_model_2.state_dict(), {UPDATE_SIZE_KEY: 20})))
+    fed_avg_server.update_queue.join()
+    assert fed_avg_server.model_version == 1
+    assert fed_avg_server.agg_update_size == 0
 
     global_update_dict = {}
     sd_1 = worker_model_1.state_dict()
@@ -135,5 +163,332 @@ def test_fed_avg_server():
     test_global_model = FedAvgTestModel()
     test_global_model.load_state_dict(global_update_dict)
 
-    assert_models_equal(
+    # the running sum is accumulated in a different order - allow for rounding
+    assert_models_close(
         fed_avg_server.global_model_trainer.model, test_global_model)
+
+
+def test_fed_avg_server_update_metadata():
+    fed_avg_server = FedAvgServer(FedAvgTestTrainer(), key_list_file=None, max_update_staleness=1)
+    dummy_worker_id = "dummy_worker_id"
+    assert not fed_avg_server.check_update_metadata(
+        dummy_worker_id, {UPDATE_MODEL_VERSION_KEY: 0, UPDATE_SIZE_KEY: 10})
+
+    fed_avg_server.worker_updates[dummy_worker_id] = None
+    assert fed_avg_server.check_update_metadata(
+        dummy_worker_id, {UPDATE_MODEL_VERSION_KEY: 0, UPDATE_SIZE_KEY: 10})
+    assert not fed_avg_server.check_update_metadata(
+        dummy_worker_id, {UPDATE_MODEL_VERSION_KEY: 0, UPDATE_SIZE_KEY: 0})
+    assert not fed_avg_server.check_update_metadata(dummy_worker_id, {UPDATE_SIZE_KEY: 10})
+
+    fed_avg_server.model_version = 2
+    assert fed_avg_server.check_update_metadata(
+        dummy_worker_id, {UPDATE_MODEL_VERSION_KEY: 1, UPDATE_SIZE_KEY: 10})
+    assert not fed_avg_server.check_update_metadata(
+        dummy_worker_id, {UPDATE_MODEL_VERSION_KEY: 0, UPDATE_SIZE_KEY: 10})
+
+
+def test_fed_avg_server_model_delta():
+
+    trainer = FedAvgTestTrainer()
+    fed_avg_server = FedAvgServer(trainer, key_list_file=None, model_history_size=2)
+    base_state_dict = {key: val.clone() for key, val in trainer.model.state_dict().items()}
+
+    # publish a new global model version where only the bias has changed
+    new_state_dict = trainer.model.state_dict()
+    new_state_dict['lin.bias'] = new_state_dict['lin.bias'] + 1.0
+    trainer.load_model_from_state_dict(new_state_dict)
+    fed_avg_server.model_version += 1
+    fed_avg_server.record_global_model()
+
+    delta_dict = fed_avg_server.return_global_model_delta(0)
+    assert delta_dict[GLOBAL_MODEL_VERSION] == 1
+    assert delta_dict[GLOBAL_MODEL_BASE_VERSION] == 0
+    delta, _ = deserialize_state_dict(delta_dict[GLOBAL_MODEL])
+    assert list(delta.keys()) == ['lin.bias']
+
+    rebuilt_state_dict = {key: val + delta[key] if key in delta else val
+                          for key, val in base_state_dict.items()}
+    rebuilt_model = FedAvgTestModel()
+    rebuilt_model.load_state_dict(rebuilt_state_dict)
+    assert_models_equal(rebuilt_model, trainer.model)
+
+    # the base version is evicted from the history after enough new versions
+    fed_avg_server.model_version += 1
+    fed_avg_server.record_global_model()
+    assert fed_avg_server.return_global_model_delta(0) is None
+    assert fed_avg_server.return_global_model_delta(1) is not None
+
+    fed_avg_server.model_delta_dtype = torch.float16
+    delta, _ = deserialize_state_dict(fed_avg_server.return_global_model_delta(1)[GLOBAL_MODEL])
+    assert all(val.dtype == torch.float16 for val in delta.values())
+
+
+def test_fed_avg_server_sparse_update():
+    trainer = FedAvgTestTrainer()
+    fed_avg_server = FedAvgServer(trainer, key_list_file=None, update_lim=2, aggregate_in_background=False)
+    base_params = fed_avg_server.param_layout.flatten(trainer.model.state_dict())
+    for worker_id in ["dummy_worker_id_1", "dummy_worker_id_2"]:
+        fed_avg_server.worker_updates[worker_id] = None
+
+    def sparse_update(indices, values, base_version=0):
+        return io.BytesIO(serialize_state_dict(
+            {SPARSE_INDICES_KEY: torch.tensor(indices, dtype=torch.int32),
+             SPARSE_VALUES_KEY: torch.tensor(values)},
+            {UPDATE_SIZE_KEY: 10, UPDATE_MODEL_VERSION_KEY: base_version, SPARSE_UPDATE_KEY: True}))
+
+    # invalid updates leave the running sum untouched
+    for update in [sparse_update([0, 30], [1.0, 1.0]), sparse_update([0, 1], [1.0]),
+                   sparse_update([0], [1.0], base_version=5)]:
+        try:
+            fed_avg_server.receive_worker_update("dummy_worker_id_1", update)
+        except ValueError:
+            assert True
+        else:
+            assert False
+    assert fed_avg_server.agg_update_size == 0 and not torch.any(fed_avg_server.agg_params)
+
+    # a sparse update is aggregated as the global model plus its differences
+    fed_avg_server.receive_worker_update("dummy_worker_id_1", sparse_update([0, 21], [1.0, -2.0]))
+    fed_avg_server.receive_worker_update(
+        "dummy_worker_id_2",
+        io.BytesIO(serialize_state_dict(trainer.model.state_dict(), {UPDATE_SIZE_KEY: 10})))
+    assert fed_avg_server.model_version == 1
+
+    expected_params = base_params.clone()
+    expected_params[0] += 0.5
+    expected_params[21] -= 1.0
+    assert torch.allclose(fed_avg_server.model_history[1], expected_params)
+
+    # sparse updates are only accepted if their global model is in the history
+    assert fed_avg_server.check_update_metadata(
+        "dummy_worker_id_1", {UPDATE_MODEL_VERSION_KEY: 0, UPDATE_SIZE_KEY: 10, SPARSE_UPDATE_KEY: True})
+    assert not fed_avg_server.check_update_metadata(
+        "dummy_worker_id_1", {UPDATE_MODEL_VERSION_KEY: 5, UPDATE_SIZE_KEY: 10, SPARSE_UPDATE_KEY: True})
+
+
+def test_fed_avg_server_quantization():
+    trainer = FedAvgTestTrainer()
+    fed_avg_server = FedAvgServer(trainer, key_list_file=None, update_lim=2, aggregate_in_background=False)
+    base_params = fed_avg_server.param_layout.flatten(trainer.model.state_dict())
+    for worker_id in ["dummy_worker_id_1", "dummy_worker_id_2"]:
+        fed_avg_server.worker_updates[worker_id] = None
+
+    # int8 updates are dequantized into the running sum
+    worker_model = FedAvgTestModel()
+    state_dict, quantization = quantize_state_dict(worker_model.state_dict(), stochastic=False)
+    fed_avg_server.receive_worker_update("dummy_worker_id_1", io.BytesIO(serialize_state_dict(
+        state_dict, {UPDATE_SIZE_KEY: 10, QUANTIZATION_KEY: quantization})))
+    worker_params = fed_avg_server.param_layout.flatten(worker_model.state_dict())
+    assert torch.allclose(fed_avg_server.agg_params, 10 * worker_params, atol=10 * 0.01)
+
+    values, scale, zero_point = quantize_int8(torch.tensor([1.0, -2.0]), stochastic=False)
+    fed_avg_server.receive_worker_update("dummy_worker_id_2", io.BytesIO(serialize_state_dict(
+        {SPARSE_INDICES_KEY: torch.tensor([0, 21], dtype=torch.int32), SPARSE_VALUES_KEY: values},
+        {UPDATE_SIZE_KEY: 10, UPDATE_MODEL_VERSION_KEY: 0, SPARSE_UPDATE_KEY: True,
+         QUANTIZATION_KEY: {SPARSE_VALUES_KEY: [scale, zero_point]}})))
+    assert fed_avg_server.model_version == 1
+    expected_params = (worker_params + base_params) / 2
+    expected_params[0] += 0.5
+    expected_params[21] -= 1.0
+    assert torch.allclose(fed_avg_server.model_history[1], expected_params, atol=0.01)
+
+    # int8 differences from the global model are dequantized onto it, with
+    # the resolution of the range of the differences
+    worker_state_dict = {key: val + 0.001 * torch.randn_like(val)
+                         for key, val in trainer.model.state_dict().items()}
+    state_dict, quantization = quantize_state_dict(
+        worker_state_dict, stochastic=False, base_state_dict=trainer.model.state_dict())
+    fed_avg_server.receive_worker_update("dummy_worker_id_1", io.BytesIO(serialize_state_dict(
+        state_dict, {UPDATE_SIZE_KEY: 10, UPDATE_MODEL_VERSION_KEY: 1, QUANTIZED_DELTA_KEY: True,
+                     QUANTIZATION_KEY: quantization})))
+    worker_params = fed_avg_server.param_layout.flatten(worker_state_dict)
+    assert torch.allclose(fed_avg_server.agg_params, 10 * worker_params, atol=10 * 1e-4)
+    assert not fed_avg_server.check_update_metadata(
+        "dummy_worker_id_2", {UPDATE_MODEL_VERSION_KEY: 5, UPDATE_SIZE_KEY: 10, QUANTIZED_DELTA_KEY: True})
+
+    # the global model is sent in half precision to the workers that ask for it
+    model_dict = fed_avg_server.convert_global_model(fed_avg_server.return_global_model(), FLOAT16_FORMAT)
+    assert model_dict[GLOBAL_MODEL_VERSION] == 1
+    half_state_dict, _ = deserialize_state_dict(model_dict[GLOBAL_MODEL])
+    for key, val in trainer.model.state_dict().items():
+        assert half_state_dict[key].dtype == torch.float16
+        assert torch.allclose(half_state_dict[key].float(), val, atol=1e-3)
+    assert fed_avg_server.convert_global_model(fed_avg_server.return_global_model(), 'unknown') is None
+
+
+def test_fed_avg_server_async():
+    trainer = FedAvgTestTrainer()
+    fed_avg_server = FedAvgServer(trainer, key_list_file=None, async_buffer_size=2, aggregate_in_background=False)
+    base_params = fed_avg_server.param_layout.flatten(trainer.model.state_dict())
+    for worker_id in ["dummy_worker_id_1", "dummy_worker_id_2"]:
+        fed_avg_server.worker_updates[worker_id] = None
+
+    def dense_update(params, update_size, base_version):
+        return io.BytesIO(serialize_state_dict(
+            fed_avg_server.param_layout.unflatten(params),
+            {UPDATE_SIZE_KEY: update_size, UPDATE_MODEL_VERSION_KEY: base_version}))
+
+    # the updates must be trained from a global model in the history
+    assert not fed_avg_server.check_update_metadata("dummy_worker_id_1", {UPDATE_SIZE_KEY: 10})
+    assert fed_avg_server.check_update_metadata(
+        "dummy_worker_id_1", {UPDATE_SIZE_KEY: 10, UPDATE_MODEL_VERSION_KEY: 0})
+
+    # the differences from the base model are buffered until async_buffer_size updates
+    fed_avg_server.receive_worker_update("dummy_worker_id_1", dense_update(base_params + 1.0, 10, 0))
+    assert fed_avg_server.model_version == 0
+    fed_avg_server.receive_worker_update("dummy_worker_id_2", io.BytesIO(serialize_state_dict(
+        {SPARSE_INDICES_KEY: torch.tensor([0], dtype=torch.int32), SPARSE_VALUES_KEY: torch.tensor([2.0])},
+        {UPDATE_SIZE_KEY: 30, UPDATE_MODEL_VERSION_KEY: 0, SPARSE_UPDATE_KEY: True})))
+    assert fed_avg_server.model_version == 1
+    expected_params = base_params + 0.25
+    expected_params[0] += 1.5
+    assert torch.allclose(fed_avg_server.model_history[1], expected_params)
+
+    # stale updates are discounted, and published after async_publish_interval
+    fed_avg_server.receive_worker_update("dummy_worker_id_1", dense_update(base_params + 1.0, 10, 0))
+    assert fed_avg_server.model_version == 1
+    fed_avg_server.async_publish_interval = 0
+    fed_avg_server.update_global_model()
+    assert fed_avg_server.model_version == 2
+    assert torch.allclose(fed_avg_server.model_history[2], expected_params + 1 / math.sqrt(2))
+
+
+def test_fed_avg_server_async_publish_interval():
+    trainer = FedAvgTestTrainer()
+    fed_avg_server = FedAvgServer(trainer, key_list_file=None, async_buffer_size=10, async_publish_interval=0.2)
+    fed_avg_server.worker_updates["dummy_worker_id"] = None
+    fed_avg_server.receive_worker_update("dummy_worker_id", io.BytesIO(serialize_state_dict(
+        trainer.model.state_dict(), {UPDATE_SIZE_KEY: 10, UPDATE_MODEL_VERSION_KEY: 0})))
+    gevent.sleep(0.5)
+    assert fed_avg_server.model_version == 1
+    gevent.sleep(0.5)
+    assert fed_avg_server.model_version == 1
+    fed_avg_server.publish_greenlet.kill()
+
+
+def test_fed_avg_server_rounds():
+    trainer = FedAvgTestTrainer()
+    fed_avg_server = FedAvgServer(trainer, key_list_file=None, update_lim=2, round_sample_size=3,
+                                  round_deadline=1000, aggregate_in_background=False)
+    worker_ids = [f"dummy_worker_id_{n}" for n in range(4)]
+    for worker_id in worker_ids:
+        fed_avg_server.register_worker(worker_id)
+
+    def update(base_version):
+        return {UPDATE_SIZE_KEY: 10, UPDATE_MODEL_VERSION_KEY: base_version}
+
+    # the first round is filled with the workers as they register
+    assert [fed_avg_server.is_worker_selected(worker_id) for worker_id in worker_ids] == \
+        [True, True, True, False]
+    assert (datetime.now() - fed_avg_server.last_global_model_update_timestamp).total_seconds() < 60
+    assert not fed_avg_server.check_update_metadata(worker_ids[3], update(0))
+    assert fed_avg_server.check_update_metadata(worker_ids[0], update(0))
+
+    # the round closes at the first update_lim updates
+    for worker_id in worker_ids[:2]:
+        fed_avg_server.receive_worker_update(worker_id, io.BytesIO(serialize_state_dict(
+            trainer.model.state_dict(), update(0))))
+    assert fed_avg_server.model_version == 1
+    assert not fed_avg_server.check_update_metadata(worker_ids[2], update(0))
+
+    # the next round has a sample of the workers
+    sampled = [worker_id for worker_id in worker_ids if fed_avg_server.is_worker_selected(worker_id)]
+    not_sampled = [worker_id for worker_id in worker_ids if worker_id not in sampled]
+    assert len(sampled) == 3 and len(not_sampled) == 1
+
+    # only the updates of the sampled workers for the current round are accepted
+    assert not fed_avg_server.check_update_metadata(not_sampled[0], update(1))
+    assert not fed_avg_server.check_update_metadata(sampled[0], update(0))
+    assert fed_avg_server.check_update_metadata(sampled[0], update(1))
+
+    # the round closes at its deadline, with the same model if no update arrived
+    fed_avg_server.round_deadline = 0
+    fed_avg_server.update_global_model()
+    assert fed_avg_server.model_version == 2
+    assert torch.equal(fed_avg_server.model_history[1], fed_avg_server.model_history[2])
+    fed_avg_server.publish_greenlet.kill()
+
+
+def test_fed_avg_edge_server():
+    root_server = FedAvgServer(FedAvgTestTrainer(), key_list_file=None, update_lim=2,
+                               aggregate_in_background=False)
+    edge_servers = [FedAvgEdgeServer(FedAvgTestTrainer(), key_list_file=None, root_private_key_file=None,
+                                     update_lim=2, aggregate_in_background=False) for _ in range(2)]
+
+    # the edge servers are workers of the root server, sending their updates to it
+    for n, edge_server in enumerate(edge_servers):
+        edge_id = f"dummy_edge_id_{n}"
+        root_server.worker_updates[edge_id] = None
+
+        def send_model_update(model_update, update_metadata, edge_id=edge_id):
+            assert root_server.check_update_metadata(edge_id, update_metadata)
+            return root_server.receive_worker_update(edge_id, io.BytesIO(model_update))
+        edge_server.root_worker.send_model_update = send_model_update
+        edge_server.root_global_model_version_changed(root_server.return_global_model())
+        assert edge_server.model_version == 0
+        assert_models_equal(edge_server.global_model_trainer.model, root_server.global_model_trainer.model)
+
+    # each edge server uploads the weighted average of its workers' updates
+    worker_models = []
+    for n, edge_server in enumerate(edge_servers):
+        for m, update_size in enumerate([10, 30]):
+            worker_id = f"dummy_worker_id_{n}_{m}"
+            worker_models.append((FedAvgTestModel(), update_size))
+            edge_server.worker_updates[worker_id] = None
+            edge_server.receive_worker_update(worker_id, io.BytesIO(serialize_state_dict(
+                worker_models[-1][0].state_dict(), {UPDATE_SIZE_KEY: update_size})))
+        assert edge_server.agg_update_size == 0 and edge_server.model_version == 0
+
+    # the root server aggregates as if it had received the worker updates
+    assert root_server.model_version == 1
+    assert root_server.worker_updates["dummy_edge_id_0"][1] == 40
+    expected_model = FedAvgTestModel()
+    expected_model.load_state_dict({
+        key: sum(size * model.state_dict()[key] for model, size in worker_models) / 80
+        for key in expected_model.state_dict()})
+    assert_models_close(root_server.global_model_trainer.model, expected_model)
+
+    # the asynchronous mode and rounds are left to the root server
+    for kwargs in [{'async_buffer_size': 10}, {'round_sample_size': 10, 'round_deadline': 60}]:
+        try:
+            FedAvgEdgeServer(FedAvgTestTrainer(), key_list_file=None, root_private_key_file=None,
+                             aggregate_in_background=False, **kwargs)
+        except ValueError:
+            assert True
+        else:
+            assert False
+
+
+def test_fed_avg_edge_server_root_version_change():
+    root_server = FedAvgServer(FedAvgTestTrainer(), key_list_file=None, update_lim=10,
+                               aggregate_in_background=False)
+    edge_server = FedAvgEdgeServer(FedAvgTestTrainer(), key_list_file=None, root_private_key_file=None,
+                                   update_lim=2, aggregate_in_background=False)
+    uploads = []
+
+    def send_model_update(model_update, update_metadata):
+        uploads.append((update_metadata, deserialize_state_dict(model_update)[1]))
+        return "Update received"
+    edge_server.root_worker.send_model_update = send_model_update
+    edge_server.root_global_model_version_changed(root_server.return_global_model())
+
+    def send_worker_update(worker_id, base_version):
+        edge_server.worker_updates.setdefault(worker_id, None)
+        edge_server.receive_worker_update(worker_id, io.BytesIO(serialize_state_dict(
+            FedAvgTestModel().state_dict(), {UPDATE_SIZE_KEY: 10, UPDATE_MODEL_VERSION_KEY: base_version})))
+
+    # the updates trained from a root version are uploaded when the next one arrives
+    send_worker_update("dummy_worker_id_1", 0)
+    root_server.model_version = 1
+    edge_server.root_global_model_version_changed(root_server.return_global_model())
+    assert edge_server.model_version == 1
+    assert [metadata[UPDATE_MODEL_VERSION_KEY] for metadata, _ in uploads] == [0]
+    assert uploads[0][0][UPDATE_SIZE_KEY] == 10 and uploads[0][1][UPDATE_MODEL_VERSION_KEY] == 0
+    assert edge_server.agg_update_size == 0 and edge_server.agg_base_version is None
+
+    # an upload mixing root versions is labelled with the oldest one
+    send_worker_update("dummy_worker_id_2", 1)
+    send_worker_update("dummy_worker_id_3", 0)
+    assert [metadata[UPDATE_MODEL_VERSION_KEY] for metadata, _ in uploads] == [0, 0]
+    assert uploads[1][0][UPDATE_SIZE_KEY] == 20 and uploads[1][1][UPDATE_MODEL_VERSION_KEY] == 0
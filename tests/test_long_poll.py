@@ -8,6 +8,7 @@ from datetime import datetime
 
 from nacl.encoding import HexEncoder
 from gevent import Greenlet, sleep
+from gevent.queue import Queue
 
 from dc_federated.backend import DCFServer, DCFWorker, create_model_dict
 from dc_federated.backend._constants import *
@@ -31,7 +32,7 @@ class SimpleLPWorker(object):
     for the test we need to maintain the state gm_version on the different
     greenlets (whicha are pseduo-threads).
     """
-    def __init__(self, s_host, s_port, private_key_file):
+    def __init__(self, s_host, s_port, private_key_file, long_poll_returns_model=False):
         self.gm_version = "0"
         self.update = None
         self.worker = DCFWorker(
@@ -40,7 +41,8 @@ class SimpleLPWorker(object):
             server_port=s_port,
             global_model_version_changed_callback=self.global_model_changed_callback,
             get_worker_version_of_global_model=self.get_last_global_model_version,
-            private_key_file=private_key_file
+            private_key_file=private_key_file,
+            long_poll_returns_model=long_poll_returns_model
         )
 
     def global_model_changed_callback(self, model_dict):
@@ -170,3 +172,151 @@ def test_long_polling():
 
     for f in os.listdir(keys_folder):
         os.remove(os.path.join(keys_folder, f))
+
+
+def test_long_polling_version_changed_broadcast():
+    # the model check interval is long enough that only the broadcast
+    # from global_model_version_changed() can wake the long-polls in time.
+    num_workers = 20
+    server_model_check_interval = 1000
+    global_model_version = "1"
+    old_version_checks = 0
+
+    def test_ret_global_model_cb():
+        return create_model_dict(
+            msgpack.packb("Pickle dump of a string"),
+            global_model_version)
+
+    def is_global_model_most_recent(version):
+        nonlocal old_version_checks
+        if version == "1":
+            old_version_checks += 1
+        return version == global_model_version
+
+    dcf_server = DCFServer(
+        register_worker_callback=lambda worker_id: None,
+        unregister_worker_callback=lambda worker_id: None,
+        return_global_model_callback=test_ret_global_model_cb,
+        is_global_model_most_recent=is_global_model_most_recent,
+        receive_worker_update_callback=lambda worker_id, update: None,
+        server_mode_safe=False,
+        key_list_file=None,
+        model_check_interval=server_model_check_interval,
+        load_last_session_workers=False
+    )
+
+    stoppable_server = StoppableServer(host=get_host_ip(), port=8080)
+
+    def begin_server():
+        dcf_server.start_server(stoppable_server)
+    server_gl = Greenlet.spawn(begin_server)
+    sleep(2)
+
+    # half the workers get the model in the long-poll response itself.
+    workers = [SimpleLPWorker(dcf_server.server_host_ip, dcf_server.server_port, None,
+                              long_poll_returns_model=n % 2 == 0)
+               for n in range(num_workers)]
+    for worker in workers:
+        worker.worker.register_worker()
+        worker.gm_version = global_model_version
+
+    done_count = 0
+
+    def run_wg(gl_worker):
+        gl_worker.global_model_changed_callback(
+            gl_worker.worker.get_global_model())
+        nonlocal done_count
+        done_count += 1
+
+    # stagger the long-polls so as not to overflow the listen backlog of
+    # the test server.
+    for i, worker in enumerate(workers):
+        Greenlet.spawn(run_wg, worker)
+        if (i+1) % 5 == 0:
+            sleep(0.5)
+    sleep(2)
+    assert done_count == 0
+    checks_before_change = old_version_checks
+
+    global_model_version = "2"
+    dcf_server.global_model_version_changed()
+
+    start_time = datetime.now()
+    while done_count < num_workers and (datetime.now() - start_time).seconds < 10:
+        sleep(0.1)
+
+    stoppable_server.shutdown()
+
+    assert done_count == num_workers
+    assert all(worker.gm_version == global_model_version for worker in workers)
+    assert all(msgpack.unpackb(worker.update) == "Pickle dump of a string" for worker in workers)
+    # each long-poll checks the version exactly once more after the broadcast.
+    assert old_version_checks - checks_before_change == num_workers
+
+
+def test_long_polling_selected_workers():
+    # the long-poll greenlets are run directly, as the test server serves
+    # one request at a time.
+    global_model_version = "1"
+    selected_workers = set()
+    dcf_server = DCFServer(
+        register_worker_callback=lambda worker_id: None,
+        unregister_worker_callback=lambda worker_id: None,
+        return_global_model_callback=lambda: create_model_dict(
+            msgpack.packb("Pickle dump of a string"), global_model_version),
+        is_global_model_most_recent=lambda version: version == global_model_version,
+        receive_worker_update_callback=lambda worker_id, update: None,
+        server_mode_safe=False,
+        key_list_file=None,
+        model_check_interval=1000,
+        load_last_session_workers=False,
+        is_worker_selected_callback=lambda worker_id: worker_id in selected_workers
+    )
+
+    worker_ids = [f"worker_{n}" for n in range(4)]
+    bodies = {worker_id: Queue() for worker_id in worker_ids}
+    for worker_id in worker_ids:
+        dcf_server.model_version_req_dict[worker_id] = []
+    long_polls = [Greenlet.spawn(dcf_server.check_model_version_updated, worker_id, bodies[worker_id], "1")
+                  for worker_id in worker_ids]
+    sleep(0.1)
+
+    # only the long-polls of the selected workers return on a version change
+    selected_workers.update(worker_ids[:2])
+    global_model_version = "2"
+    dcf_server.global_model_version_changed()
+    sleep(0.1)
+    assert [g.ready() for g in long_polls] == [True, True, False, False]
+    assert bodies[worker_ids[0]].get() == GLOBAL_MODEL_UPDATED_STRING
+
+    selected_workers.update(worker_ids[2:])
+    dcf_server.global_model_version_changed()
+    sleep(0.1)
+    assert all(g.ready() for g in long_polls)
+
+
+def test_long_polling_model_error():
+    def test_ret_global_model_cb():
+        raise RuntimeError("Global model unavailable")
+
+    dcf_server = DCFServer(
+        register_worker_callback=lambda worker_id: None,
+        unregister_worker_callback=lambda worker_id: None,
+        return_global_model_callback=test_ret_global_model_cb,
+        is_global_model_most_recent=lambda version: version == "2",
+        receive_worker_update_callback=lambda worker_id, update: None,
+        server_mode_safe=False,
+        key_list_file=None,
+        load_last_session_workers=False
+    )
+
+    # the response is ended with the error, and the request cleaned up, if
+    # the model cannot be returned
+    body = Queue()
+    long_poll = Greenlet(dcf_server.check_model_version_updated, "worker_1", body, "1", True)
+    dcf_server.model_version_req_dict["worker_1"] = [(long_poll, body)]
+    long_poll.start()
+    long_poll.join(timeout=5)
+    assert long_poll.successful()
+    assert list(body) == ["Global model unavailable"]
+    assert dcf_server.model_version_req_dict["worker_1"] == []
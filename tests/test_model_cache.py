@@ -0,0 +1,154 @@
+"""
+Tests for the caching of the serialized global model.
+"""
+
+import zlib
+import msgpack
+
+from dc_federated.backend import DCFServer, create_model_dict
+from dc_federated.backend._constants import *
+from dc_federated.backend._model_cache import GlobalModelCache
+from dc_federated.backend._codecs import DEFAULT_CODEC
+
+
+def test_global_model_cache():
+    cache = GlobalModelCache(max_size_bytes=10)
+
+    cache.put(1, b'abcd')
+    cache.put(1, b'efgh', variant='other')
+    assert cache.get(1) == b'abcd'
+    assert cache.get(1, 'other') == b'efgh'
+    assert cache.size_bytes == 8
+
+    # over budget - the least recently used variant is evicted
+    cache.put(1, b'ijkl', variant='third')
+    assert cache.get(1) is None
+    assert cache.get(1, 'other') == b'efgh'
+    assert cache.get(1, 'third') == b'ijkl'
+
+    # entries larger than the budget are not cached
+    cache.put(1, b'x' * 11, variant='large')
+    assert cache.get(1, 'large') is None
+
+    # a new version evicts the superseded version
+    cache.put(2, b'mn')
+    assert cache.latest_version == 2
+    assert cache.get(1, 'other') is None
+    assert cache.get(1, 'third') is None
+    assert cache.get(2) == b'mn'
+    assert cache.size_bytes == 2
+
+
+def test_global_model_serialized_once_per_version():
+    global_model_version = 1
+    num_callback_calls = 0
+
+    def test_ret_global_model_cb():
+        nonlocal num_callback_calls
+        num_callback_calls += 1
+        return create_model_dict(
+            msgpack.packb(f"Model version {global_model_version}"),
+            global_model_version)
+
+    dcf_server = DCFServer(
+        register_worker_callback=lambda worker_id: None,
+        unregister_worker_callback=lambda worker_id: None,
+        return_global_model_callback=test_ret_global_model_cb,
+        is_global_model_most_recent=lambda version: version == global_model_version,
+        receive_worker_update_callback=lambda worker_id, update: None,
+        server_mode_safe=False,
+        key_list_file=None,
+        load_last_session_workers=False
+    )
+
+    for _ in range(5):
+        model_dict = msgpack.unpackb(zlib.decompress(dcf_server.get_global_model_bytes()))
+        assert model_dict[GLOBAL_MODEL_VERSION] == 1
+    assert num_callback_calls == 1
+
+    # the new version is serialized eagerly when the change is broadcast
+    global_model_version = 2
+    dcf_server.global_model_version_changed()
+    assert num_callback_calls == 2
+    for _ in range(5):
+        model_dict = msgpack.unpackb(zlib.decompress(dcf_server.get_global_model_bytes()))
+        assert model_dict[GLOBAL_MODEL_VERSION] == 2
+        assert msgpack.unpackb(model_dict[GLOBAL_MODEL]) == "Model version 2"
+    assert num_callback_calls == 2
+    assert dcf_server.global_model_cache.get(1) is None
+
+
+def test_global_model_delta_cached_per_base_version():
+    num_delta_calls = 0
+
+    def test_ret_global_model_delta_cb(base_version):
+        nonlocal num_delta_calls
+        num_delta_calls += 1
+        if base_version != 1:
+            return None
+        return {
+            GLOBAL_MODEL: msgpack.packb("Model delta"),
+            GLOBAL_MODEL_VERSION: 2,
+            GLOBAL_MODEL_BASE_VERSION: base_version
+        }
+
+    dcf_server = DCFServer(
+        register_worker_callback=lambda worker_id: None,
+        unregister_worker_callback=lambda worker_id: None,
+        return_global_model_callback=lambda: create_model_dict(msgpack.packb("Model"), 2),
+        is_global_model_most_recent=lambda version: version == 2,
+        receive_worker_update_callback=lambda worker_id, update: None,
+        server_mode_safe=False,
+        key_list_file=None,
+        load_last_session_workers=False,
+        return_global_model_delta_callback=test_ret_global_model_delta_cb
+    )
+
+    for _ in range(3):
+        model_dict = msgpack.unpackb(zlib.decompress(dcf_server.get_global_model_bytes(1)))
+        assert model_dict[GLOBAL_MODEL_BASE_VERSION] == 1
+        assert msgpack.unpackb(model_dict[GLOBAL_MODEL]) == "Model delta"
+    assert num_delta_calls == 1
+
+    # no delta is available from version 0 - the whole model is returned
+    model_dict = msgpack.unpackb(zlib.decompress(dcf_server.get_global_model_bytes(0)))
+    assert GLOBAL_MODEL_BASE_VERSION not in model_dict
+    assert msgpack.unpackb(model_dict[GLOBAL_MODEL]) == "Model"
+
+
+def test_global_model_cached_per_format():
+    num_convert_calls = 0
+
+    def test_convert_global_model_cb(model_dict, model_format):
+        nonlocal num_convert_calls
+        num_convert_calls += 1
+        if model_format != 'small':
+            return None
+        return create_model_dict(msgpack.packb("Small model"), model_dict[GLOBAL_MODEL_VERSION])
+
+    dcf_server = DCFServer(
+        register_worker_callback=lambda worker_id: None,
+        unregister_worker_callback=lambda worker_id: None,
+        return_global_model_callback=lambda: create_model_dict(msgpack.packb("Model"), 1),
+        is_global_model_most_recent=lambda version: version == 1,
+        receive_worker_update_callback=lambda worker_id, update: None,
+        server_mode_safe=False,
+        key_list_file=None,
+        load_last_session_workers=False,
+        convert_global_model_callback=test_convert_global_model_cb
+    )
+
+    for _ in range(3):
+        model_dict = msgpack.unpackb(zlib.decompress(dcf_server.get_global_model_bytes(model_format='small')))
+        assert msgpack.unpackb(model_dict[GLOBAL_MODEL]) == "Small model"
+    assert num_convert_calls == 1
+
+    # unsupported formats get the model unconverted
+    model_dict = msgpack.unpackb(zlib.decompress(dcf_server.get_global_model_bytes(model_format='unknown')))
+    assert msgpack.unpackb(model_dict[GLOBAL_MODEL]) == "Model"
+    model_dict = msgpack.unpackb(zlib.decompress(dcf_server.get_global_model_bytes()))
+    assert msgpack.unpackb(model_dict[GLOBAL_MODEL]) == "Model"
+    assert num_convert_calls == 2
+
+    # only the formats that were converted are serialized for the next versions
+    assert dcf_server.global_model_encodings == {(DEFAULT_CODEC, None), (DEFAULT_CODEC, 'small')}
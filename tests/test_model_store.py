@@ -0,0 +1,110 @@
+"""
+Tests for the on-disk store of the serialized global models.
+"""
+
+import os
+import msgpack
+from gevent import Greenlet, sleep
+
+from dc_federated.backend import DCFServer, DCFWorker, create_model_dict
+from dc_federated.backend._constants import *
+from dc_federated.backend._model_store import GlobalModelStore
+from dc_federated.utils import StoppableServer, get_host_ip
+
+
+def test_global_model_store(tmp_path):
+    store = GlobalModelStore(str(tmp_path / 'store'), max_versions=2)
+    store.put(1, b'model 1')
+    store.put(1, b'model 1 zstd', ('zstd', None, None))
+    assert store.get(1) == b'model 1'
+    assert store.get(1, ('zstd', None, None)) == b'model 1 zstd'
+    assert store.get(1, ('lz4', None, None)) is None
+
+    # the files are named by their content, so identical models are stored once
+    store.put(2, b'model 1')
+    assert len(os.listdir(store.objects_path)) == 2
+    assert store.latest_version == 2 and store.get_versions() == [1, 2]
+
+    # the index is read back by another instance, e.g. in another process
+    other_store = GlobalModelStore(store.path, max_versions=2, session=store.session)
+    assert other_store.latest_version == 2
+    with other_store.open(1, ['zstd', None, None]) as model_file:
+        assert model_file.read() == b'model 1 zstd'
+
+    # the versions beyond max_versions are removed with the files only they use
+    store.put(3, b'model 3')
+    assert store.get_versions() == [2, 3]
+    assert store.get(1) is None and store.get(2) == b'model 1'
+    assert len(os.listdir(store.objects_path)) == 2
+    assert other_store.get_versions() == [2, 3] and other_store.open(1) is None
+
+    # and so are the versions older than max_age, except the latest one
+    store.max_age = 0
+    store.put(4, b'model 4')
+    assert store.get_versions() == [4]
+    assert os.listdir(store.objects_path) == [store.entries[store.entry_key(4, None)]]
+
+    # a new session, e.g. a restarted server, does not see the versions of
+    # the previous one, which are garbage collected like any other
+    store.max_age = None
+    new_store = GlobalModelStore(store.path, max_versions=2)
+    assert new_store.latest_version is None and new_store.get(4) is None
+    new_store.put(4, b'new model 4')
+    assert new_store.get(4) == b'new model 4' and store.get(4) == b'model 4'
+    new_store.put(5, b'model 5')
+    assert store.get(4) is None and store.latest_version is None
+    assert new_store.get_versions() == [4, 5]
+
+
+def test_global_model_served_from_store(tmp_path):
+    num_callback_calls = 0
+    global_model = "Model A"
+
+    def test_ret_global_model_cb():
+        nonlocal num_callback_calls
+        num_callback_calls += 1
+        return create_model_dict(msgpack.packb(global_model), 1)
+
+    def create_server():
+        return DCFServer(
+            register_worker_callback=lambda worker_id: None,
+            unregister_worker_callback=lambda worker_id: None,
+            return_global_model_callback=test_ret_global_model_cb,
+            is_global_model_most_recent=lambda version: version == 1,
+            receive_worker_update_callback=lambda worker_id, update: None,
+            server_mode_safe=False,
+            key_list_file=None,
+            load_last_session_workers=False,
+            model_store_path=str(tmp_path / 'store')
+        )
+
+    dcf_server = create_server()
+    model_bytes = dcf_server.get_global_model_bytes()
+    assert dcf_server.global_model_store.get(1) == model_bytes
+    assert num_callback_calls == 1
+
+    # a restarted server, whose versions start over, serves its own model
+    # from the file rather than the model of the previous run
+    global_model = "Model B"
+    dcf_server = create_server()
+    stoppable_server = StoppableServer(host=get_host_ip(), port=8080)
+    server_gl = Greenlet.spawn(dcf_server.start_server, stoppable_server)
+    sleep(2)
+    try:
+        worker = DCFWorker(
+            server_protocol='http',
+            server_host_ip=dcf_server.server_host_ip,
+            server_port=dcf_server.server_port,
+            global_model_version_changed_callback=None,
+            get_worker_version_of_global_model=lambda: 0,
+            private_key_file=None
+        )
+        worker.register_worker()
+        model_dict = worker.get_global_model()
+        assert model_dict[GLOBAL_MODEL_VERSION] == 1
+        assert msgpack.unpackb(model_dict[GLOBAL_MODEL]) == "Model B"
+        model_dict = worker.get_global_model()
+        assert msgpack.unpackb(model_dict[GLOBAL_MODEL]) == "Model B"
+    finally:
+        stoppable_server.shutdown()
+    assert num_callback_calls == 2
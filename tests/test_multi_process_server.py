@@ -0,0 +1,159 @@
+"""
+Tests for the DCFServer running with several worker processes.
+"""
+import os
+import msgpack
+
+from nacl.encoding import HexEncoder
+from nacl.signing import SigningKey
+from gevent import Greenlet, Timeout, joinall, sleep
+
+from dc_federated.backend import DCFServer, DCFWorker, create_model_dict
+from dc_federated.backend._constants import *
+from dc_federated.backend._shared_state import SharedServerState, SharedWorkerRecords
+from dc_federated.backend._worker_manager import WorkerManager, WorkerRecord
+from dc_federated.backend.worker_key_pair_tool import gen_pair
+from dc_federated.utils import get_host_ip
+
+
+def test_shared_server_state(tmp_path):
+    shared_state = SharedServerState(str(tmp_path / 'shared_state.db'))
+    workers = SharedWorkerRecords(shared_state)
+    workers['worker_1'] = WorkerRecord()
+    assert 'worker_1' in workers and 'worker_2' not in workers
+    assert list(workers) == ['worker_1'] and len(workers) == 1
+
+    # the records are the same in another process' view of the state
+    record = workers['worker_1']
+    record.registered = True
+    record.challenge_phrase = 'phrase'
+    other_view = SharedWorkerRecords(SharedServerState(shared_state.path, clear=False))
+    assert other_view['worker_1'].registered
+    assert other_view['worker_1'].pop_challenge_phrase() == 'phrase'
+    assert record.challenge_phrase is None and record.pop_challenge_phrase() is None
+
+    # nonces can be claimed once, until they are forgotten
+    assert shared_state.claim_nonce('worker_1', 'nonce', 100, 10)
+    assert not other_view.shared_state.claim_nonce('worker_1', 'nonce', 105, 10)
+    assert other_view.shared_state.claim_nonce('worker_1', 'nonce', 111, 10)
+    shared_state.release_nonce('worker_1', 'nonce')
+    assert shared_state.claim_nonce('worker_1', 'nonce', 112, 10)
+
+    # the model bytes of the other versions are dropped when a version is published
+    assert shared_state.get_global_model_version() is None
+    shared_state.put_global_model_bytes("1", b'model 1')
+    shared_state.put_global_model_bytes("1", b'model 1 fp16', ['zlib', None, 'float16'])
+    shared_state.set_global_model_version("1")
+    assert other_view.shared_state.get_global_model_version() == "1"
+    assert shared_state.get_global_model_bytes("1", ['zlib', None, 'float16']) == b'model 1 fp16'
+    shared_state.put_global_model_bytes("2", b'model 2')
+    shared_state.set_global_model_version("2")
+    assert shared_state.get_global_model_bytes("1", ['zlib', None, 'float16']) is None
+    assert shared_state.get_global_model_bytes("2") == b'model 2'
+
+    del workers['worker_1']
+    assert len(other_view) == 0
+
+
+def test_worker_manager_shared_state(tmp_path):
+    signing_key = SigningKey.generate()
+    worker_id = signing_key.verify_key.encode(encoder=HexEncoder).decode('utf-8')
+    shared_state = SharedServerState(str(tmp_path / 'shared_state.db'))
+    worker_manager = WorkerManager(True, None, load_last_session_workers=False, shared_state=shared_state)
+    other_manager = WorkerManager(True, None, load_last_session_workers=False, shared_state=shared_state)
+
+    # workers added by one manager are authenticated by the other
+    worker_manager.add_worker(worker_id)
+    assert other_manager.is_worker_allowed(worker_id)
+    phrase = worker_manager.get_challenge_phrase(worker_id)
+    signed_phrase = signing_key.sign(phrase.encode()).hex()
+    assert other_manager.verify_challenge(worker_id, signed_phrase)
+    assert not worker_manager.verify_challenge(worker_id, signed_phrase)
+    assert worker_manager.workers[worker_id].last_seen is not None
+
+    worker_manager.remove_worker(worker_id)
+    assert not other_manager.authenticate_worker(worker_id, signing_key.sign(b"message").hex(), b"message")
+
+
+def test_multi_process_server(tmp_path):
+    num_workers = 4
+    private_key_files = [str(tmp_path / f'worker_key_file_{n}') for n in range(num_workers)]
+    public_keys = [gen_pair(private_key_file)[1] for private_key_file in private_key_files]
+    worker_key_file = str(tmp_path / 'worker_public_keys.txt')
+    with open(worker_key_file, 'w') as f:
+        for public_key in public_keys:
+            f.write(public_key.encode(encoder=HexEncoder).decode('utf-8') + os.linesep)
+
+    worker_ids = []
+    worker_updates = {}
+    global_model_version = "1"
+    worker_model_version = "0"
+
+    def test_ret_global_model_cb():
+        return create_model_dict(msgpack.packb(f"Global model {global_model_version}"), global_model_version)
+
+    def test_rec_server_update_cb(worker_id, update):
+        worker_updates[worker_id] = update
+        return f"Update received for worker {worker_id[0:WID_LEN]}."
+
+    dcf_server = DCFServer(
+        register_worker_callback=lambda worker_id: worker_ids.append(worker_id),
+        unregister_worker_callback=lambda worker_id: worker_ids.remove(worker_id),
+        return_global_model_callback=test_ret_global_model_cb,
+        is_global_model_most_recent=lambda version: version == global_model_version,
+        receive_worker_update_callback=test_rec_server_update_cb,
+        server_mode_safe=True,
+        key_list_file=worker_key_file,
+        load_last_session_workers=False,
+        server_host_ip=get_host_ip(),
+        server_port=8081,
+        model_check_interval=1000,
+        num_processes=2,
+        shared_state_path=str(tmp_path / 'shared_state.db')
+    )
+    server_gl = Greenlet.spawn(dcf_server.start_server)
+
+    try:
+        with Timeout(60):
+            sleep(3)
+            workers = [DCFWorker(
+                server_protocol='http',
+                server_host_ip=dcf_server.server_host_ip,
+                server_port=dcf_server.server_port,
+                global_model_version_changed_callback=None,
+                get_worker_version_of_global_model=lambda: worker_model_version,
+                private_key_file=private_key_file,
+                long_poll_returns_model=n % 2 == 0
+            ) for n, private_key_file in enumerate(private_key_files)]
+
+            # the registrations and updates reach the callbacks in this
+            # process, whichever process serves them.
+            for worker in workers:
+                worker.register_worker()
+            assert sorted(worker_ids) == sorted(worker.worker_id for worker in workers)
+
+            for worker in workers:
+                assert msgpack.unpackb(worker.get_global_model()[GLOBAL_MODEL]) == "Global model 1"
+                assert worker.send_model_update(worker.worker_id.encode()) == \
+                    f"Update received for worker {worker.worker_id[0:WID_LEN]}.".encode()
+            assert worker_updates == {worker.worker_id: worker.worker_id.encode() for worker in workers}
+
+            # the long-polls in all the processes are woken by the new version
+            worker_model_version = "1"
+            long_polls = [Greenlet.spawn(worker.get_global_model) for worker in workers]
+            sleep(1)
+            assert not any(g.ready() for g in long_polls)
+            global_model_version = "2"
+            dcf_server.global_model_version_changed()
+            joinall(long_polls, timeout=20)
+            assert [msgpack.unpackb(g.value[GLOBAL_MODEL]) for g in long_polls] == \
+                ["Global model 2"] * num_workers
+
+    finally:
+        http_process_pid = dcf_server.http_process_pid
+        dcf_server.stop_server()
+        server_gl.join(timeout=40)
+        if http_process_pid is not None and dcf_server.http_process_pid is not None:
+            DCFServer.stop_http_process(http_process_pid, timeout=0)
+
+    assert server_gl.ready() and dcf_server.http_process_pid is None
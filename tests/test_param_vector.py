@@ -0,0 +1,71 @@
+"""
+Tests for the flat parameter vector representation of torch models.
+"""
+
+import torch
+from torch import nn
+
+from dc_federated.algorithms.param_vector import ParamLayout, top_k_sparsify
+
+
+class ParamVectorTestModel(nn.Module):
+    """
+    Simple network with parameters and integer buffers.
+    """
+
+    def __init__(self):
+        super(ParamVectorTestModel, self).__init__()
+        self.lin = nn.Linear(10, 4)
+        self.bn = nn.BatchNorm1d(4)
+
+
+def test_param_layout():
+    model = ParamVectorTestModel()
+    state_dict = model.state_dict()
+    layout = ParamLayout(state_dict)
+
+    assert len(layout) == len(state_dict)
+    assert layout.numel == sum(val.numel() for val in state_dict.values())
+    assert layout.keys == list(state_dict.keys())
+
+    # round trip through the parameter vector
+    params = layout.flatten(state_dict)
+    assert params.shape == (layout.numel,)
+    unflattened = layout.unflatten(params)
+    for key, val in state_dict.items():
+        assert unflattened[key].shape == val.shape
+        assert torch.equal(unflattened[key].to(val.dtype), val)
+
+    # the unflattened tensors are views into the parameter vector
+    unflattened['lin.bias'].fill_(1.0)
+    offset = layout.offsets[layout.keys.index('lin.bias')]
+    assert torch.all(params[offset:offset + 4] == 1.0)
+
+    # flattening into an existing vector reuses it
+    other_model = ParamVectorTestModel()
+    out = layout.zeros()
+    assert layout.flatten(other_model.state_dict(), out=out) is out
+    assert torch.equal(out, layout.flatten(other_model.state_dict()))
+    assert not torch.equal(out, params)
+
+    # mismatched shapes are rejected
+    bad_state_dict = dict(state_dict)
+    bad_state_dict['lin.bias'] = torch.zeros(5)
+    try:
+        layout.flatten(bad_state_dict)
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+def test_top_k_sparsify():
+    params = torch.tensor([0.1, -3.0, 0.5, 2.0, -0.2])
+    indices, values = top_k_sparsify(params, 2)
+    assert sorted(zip(indices.tolist(), values.tolist())) == [(1, -3.0), (3, 2.0)]
+    # the residual keeps the elements not taken out
+    assert torch.equal(params, torch.tensor([0.1, 0.0, 0.5, 0.0, -0.2]))
+
+    indices, values = top_k_sparsify(params, 10)
+    assert len(indices) == 5
+    assert torch.equal(params, torch.zeros(5))
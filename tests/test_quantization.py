@@ -0,0 +1,52 @@
+"""
+Tests for the quantization of the tensors sent between the workers and the server.
+"""
+
+import torch
+
+from dc_federated.algorithms.quantization import quantize_int8, dequantize_int8_, quantize_state_dict, \
+    cast_state_dict
+
+
+def test_quantize_int8():
+    tensor = torch.randn(1000) * 3.0
+    for stochastic in [True, False]:
+        quantized, scale, zero_point = quantize_int8(tensor, stochastic)
+        assert quantized.dtype == torch.int8
+        dequantized = dequantize_int8_(quantized.float(), scale, zero_point)
+        assert torch.all((dequantized - tensor).abs() <= scale * (1.0 if stochastic else 0.5) + 1e-6)
+
+    # zeros are represented exactly, even for tensors of a single value
+    for tensor in [torch.tensor([0.0, 1.5, 3.0]), torch.full((4,), 2.0), torch.zeros(4), torch.full((4,), -2.0)]:
+        quantized, scale, zero_point = quantize_int8(tensor, stochastic=False)
+        dequantized = dequantize_int8_(quantized.float(), scale, zero_point)
+        assert torch.allclose(dequantized, tensor, atol=scale / 2)
+        assert dequantized[tensor == 0.0].eq(0.0).all()
+
+    # stochastic rounding is unbiased
+    tensor = torch.full((100000,), 0.3)
+    tensor[0] = 1.0
+    quantized, scale, zero_point = quantize_int8(tensor)
+    dequantized = dequantize_int8_(quantized.float(), scale, zero_point)
+    assert abs(dequantized[1:].mean().item() - 0.3) < 1e-3
+
+
+def test_quantize_state_dict():
+    state_dict = {'weight': torch.randn(3, 4), 'count': torch.tensor(7)}
+    quantized, quantization = quantize_state_dict(state_dict)
+    assert quantized['weight'].dtype == torch.int8 and quantized['weight'].shape == (3, 4)
+    assert quantized['count'] is state_dict['count']
+    assert list(quantization.keys()) == ['weight']
+
+    # differences from a base state_dict are quantized over their own range
+    base_state_dict = {'weight': state_dict['weight'] + 0.01, 'count': torch.tensor(5)}
+    quantized, quantization = quantize_state_dict(state_dict, stochastic=False, base_state_dict=base_state_dict)
+    scale, zero_point = quantization['weight']
+    assert scale < 0.02 / 255 + 1e-9
+    dequantized = dequantize_int8_(quantized['weight'].float(), scale, zero_point)
+    assert torch.allclose(dequantized + base_state_dict['weight'], state_dict['weight'], atol=scale)
+    assert quantized['count'] is state_dict['count']
+
+    cast = cast_state_dict(state_dict, torch.float16)
+    assert cast['weight'].dtype == torch.float16
+    assert cast['count'].dtype == torch.int64
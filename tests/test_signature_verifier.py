@@ -0,0 +1,81 @@
+"""
+Tests for the batching signature verifier.
+"""
+import gevent
+from gevent.threadpool import ThreadPool
+from nacl.encoding import HexEncoder
+from nacl.exceptions import BadSignatureError
+from nacl.signing import SigningKey
+
+from dc_federated.backend._signature_verifier import BatchSignatureVerifier
+from dc_federated.backend._worker_manager import WorkerManager
+
+
+class CountingPool(object):
+    """
+    Thread pool that counts the number of calls made to it.
+    """
+    def __init__(self):
+        self.pool = ThreadPool(2)
+        self.num_calls = 0
+
+    def apply(self, func, args, kwargs):
+        self.num_calls += 1
+        return self.pool.apply(func, args, kwargs)
+
+
+def test_batch_signature_verifier():
+    signing_keys = [SigningKey.generate() for _ in range(20)]
+    messages = [f"message {n}".encode() for n in range(20)]
+    signed_messages = [key.sign(message).hex() for key, message in zip(signing_keys, messages)]
+    # every third message is checked against the wrong key
+    verify_keys = [signing_keys[(n + 1) % 20 if n % 3 == 0 else n].verify_key for n in range(20)]
+
+    pool = CountingPool()
+    verifier = BatchSignatureVerifier(pool, max_batch_size=8)
+
+    def verify(n):
+        try:
+            return verifier.verify(verify_keys[n], signed_messages[n])
+        except BadSignatureError:
+            return None
+
+    greenlets = [gevent.spawn(verify, n) for n in range(20)]
+    gevent.joinall(greenlets)
+    for n, g in enumerate(greenlets):
+        assert g.value == (None if n % 3 == 0 else messages[n])
+
+    # the signatures that arrived together are verified in 2 full batches
+    # and the remainder
+    assert pool.num_calls == 3
+    assert len(verifier.pending) == 0 and verifier.flush_greenlet is None
+
+    # a single request is verified without waiting for others
+    with gevent.Timeout(0.05):
+        assert verifier.verify(verify_keys[1], signed_messages[1]) == messages[1]
+    assert pool.num_calls == 4
+
+    # the signatures arriving while a batch is verified form the next batch
+    greenlets = [gevent.spawn(verify, 1)]
+    gevent.sleep(0)
+    greenlets += [gevent.spawn(verify, n) for n in [2, 4, 5]]
+    gevent.joinall(greenlets)
+    assert [g.value for g in greenlets] == [messages[1], messages[2], messages[4], messages[5]]
+    assert pool.num_calls == 6
+
+
+def test_worker_manager_batch_verification():
+    signing_keys = [SigningKey.generate() for _ in range(10)]
+    worker_ids = [key.verify_key.encode(encoder=HexEncoder).decode('utf-8') for key in signing_keys]
+    worker_manager = WorkerManager(True, None, load_last_session_workers=False,
+                                   cpu_pool=ThreadPool(2), batch_signature_verification=True)
+    for worker_id in worker_ids:
+        worker_manager.add_worker(worker_id)
+
+    greenlets = [gevent.spawn(worker_manager.authenticate_worker, worker_id,
+                              key.sign(b"model update").hex(), b"model update")
+                 for worker_id, key in zip(worker_ids, signing_keys)]
+    greenlets.append(gevent.spawn(worker_manager.authenticate_worker, worker_ids[0],
+                                  signing_keys[1].sign(b"model update").hex(), b"model update"))
+    gevent.joinall(greenlets)
+    assert [g.value for g in greenlets] == [True] * 10 + [False]
@@ -0,0 +1,78 @@
+"""
+Tests for the tensor container format used to send state_dicts between the
+workers and the server.
+"""
+
+import mmap
+import tempfile
+
+import numpy as np
+import torch
+from torch import nn
+
+from dc_federated.algorithms.tensor_container import serialize_state_dict, deserialize_state_dict, \
+    ALIGNMENT
+
+
+class TensorContainerTestModel(nn.Module):
+    """
+    Simple network with parameters and integer buffers.
+    """
+
+    def __init__(self):
+        super(TensorContainerTestModel, self).__init__()
+        self.lin = nn.Linear(10, 4)
+        self.bn = nn.BatchNorm1d(4)
+
+
+def assert_state_dicts_equal(state_dict_1, state_dict_2):
+    assert list(state_dict_1.keys()) == list(state_dict_2.keys())
+    for key, val in state_dict_1.items():
+        assert state_dict_2[key].dtype == val.dtype
+        assert torch.equal(state_dict_2[key], val)
+
+
+def test_tensor_container():
+    state_dict = TensorContainerTestModel().state_dict()
+    state_dict['half'] = torch.randn(3, 5).half()
+    state_dict['mask'] = torch.tensor([True, False, True])
+    state_dict['empty'] = torch.zeros(0, 3)
+
+    data = serialize_state_dict(state_dict, {'update_size': 15})
+
+    # all the bytes-like types give back the same state_dict and metadata
+    for buffer in [data, bytes(data), memoryview(data)]:
+        ret_state_dict, metadata = deserialize_state_dict(buffer)
+        assert metadata == {'update_size': 15}
+        assert_state_dicts_equal(state_dict, ret_state_dict)
+
+    # the tensors are aligned views into the buffer
+    ret_state_dict, _ = deserialize_state_dict(data)
+    buffer_ptr = np.frombuffer(data, dtype=np.uint8).ctypes.data
+    for val in ret_state_dict.values():
+        assert val.numel() == 0 or (val.data_ptr() - buffer_ptr) % ALIGNMENT == 0
+    ret_state_dict['lin.bias'].fill_(1.0)
+    assert torch.all(deserialize_state_dict(data)[0]['lin.bias'] == 1.0)
+    ret_state_dict['lin.bias'].copy_(state_dict['lin.bias'])
+
+    # the result loads straight into a model
+    model = TensorContainerTestModel()
+    model.load_state_dict(deserialize_state_dict(serialize_state_dict(state_dict))[0], strict=False)
+    assert torch.equal(model.lin.weight.data, state_dict['lin.weight'])
+
+    # memory mapped files are read without copying
+    with tempfile.TemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            ret_state_dict, _ = deserialize_state_dict(mm)
+            assert_state_dicts_equal(state_dict, ret_state_dict)
+            del ret_state_dict
+
+    # anything else is rejected
+    try:
+        deserialize_state_dict(b"Pickle dump of a string")
+    except ValueError:
+        assert True
+    else:
+        assert False
@@ -0,0 +1,156 @@
+"""
+Tests for the worker state kept by the WorkerManager.
+"""
+import time
+
+import gevent
+from gevent.threadpool import ThreadPool
+from nacl.encoding import HexEncoder
+from nacl.signing import SigningKey
+
+from dc_federated.backend._constants import INVALID_WORKER, WORKER_ID_KEY, REGISTRATION_STATUS_KEY, \
+    RETURN_GLOBAL_MODEL_ROUTE, RECEIVE_WORKER_UPDATE_ROUTE
+from dc_federated.backend.backend_utils import json_body_digest, signed_request_message
+from dc_federated.backend._worker_manager import WorkerManager
+
+
+def test_worker_records():
+    signing_keys = [SigningKey.generate() for _ in range(3)]
+    worker_ids = [key.verify_key.encode(encoder=HexEncoder).decode('utf-8') for key in signing_keys]
+
+    worker_manager = WorkerManager(True, None, load_last_session_workers=False)
+    for worker_id in worker_ids:
+        assert worker_manager.add_worker(worker_id) == (worker_id, True)
+    assert worker_manager.add_worker(worker_ids[0]) == (worker_ids[0], False)
+    assert len(worker_manager.allowed_workers) == 3
+    assert all(worker_manager.is_worker_allowed(worker_id) for worker_id in worker_ids)
+    assert not worker_manager.is_worker_allowed("unknown worker")
+
+    # registration
+    assert not worker_manager.is_worker_registered(worker_ids[0])
+    assert worker_manager.set_registration_status(worker_ids[0], True) == worker_ids[0]
+    assert worker_manager.is_worker_registered(worker_ids[0])
+    assert worker_manager.set_registration_status("unknown worker", True) == INVALID_WORKER
+
+    # each challenge phrase can be verified once, and marks the worker as seen
+    assert worker_manager.workers[worker_ids[1]].last_seen is None
+    phrase = worker_manager.get_challenge_phrase(worker_ids[1])
+    signed_phrase = signing_keys[1].sign(phrase.encode()).hex()
+    assert worker_manager.verify_challenge(worker_ids[1], signed_phrase)
+    assert worker_manager.workers[worker_ids[1]].last_seen is not None
+    assert not worker_manager.verify_challenge(worker_ids[1], signed_phrase)
+    assert worker_manager.get_challenge_phrase("unknown worker") == INVALID_WORKER
+
+    # removed workers are no longer allowed or listed
+    assert worker_manager.remove_worker(worker_ids[0]) == worker_ids[0]
+    assert not worker_manager.is_worker_allowed(worker_ids[0])
+    assert not worker_manager.is_worker_registered(worker_ids[0])
+    assert worker_manager.get_worker_list() == [
+        {WORKER_ID_KEY: worker_id, REGISTRATION_STATUS_KEY: False} for worker_id in worker_ids[1:]]
+    assert worker_manager.remove_worker(worker_ids[0]) == INVALID_WORKER
+
+
+def test_signed_request_authentication():
+    signing_key = SigningKey.generate()
+    worker_id = signing_key.verify_key.encode(encoder=HexEncoder).decode('utf-8')
+    worker_manager = WorkerManager(True, None, load_last_session_workers=False, signed_request_window=60)
+    worker_manager.add_worker(worker_id)
+
+    def sign(route, timestamp, nonce, body_digest):
+        return signing_key.sign(
+            signed_request_message(route, worker_id, timestamp, nonce, body_digest)).hex()
+
+    body_digest = json_body_digest({WORKER_ID_KEY: worker_id})
+    now = int(time.time())
+    signed_request = sign(RETURN_GLOBAL_MODEL_ROUTE, now, 'nonce_1', body_digest)
+    assert worker_manager.authenticate_request(
+        worker_id, RETURN_GLOBAL_MODEL_ROUTE, signed_request, now, 'nonce_1', body_digest)
+
+    # the same request cannot be replayed
+    assert not worker_manager.authenticate_request(
+        worker_id, RETURN_GLOBAL_MODEL_ROUTE, signed_request, now, 'nonce_1', body_digest)
+
+    # the signature covers the route, the body, the timestamp and the nonce
+    signed_request = sign(RETURN_GLOBAL_MODEL_ROUTE, now, 'nonce_2', body_digest)
+    assert not worker_manager.authenticate_request(
+        worker_id, RECEIVE_WORKER_UPDATE_ROUTE, signed_request, now, 'nonce_2', body_digest)
+    assert not worker_manager.authenticate_request(
+        worker_id, RETURN_GLOBAL_MODEL_ROUTE, signed_request, now, 'nonce_2',
+        json_body_digest({WORKER_ID_KEY: 'other worker'}))
+    assert not worker_manager.authenticate_request(
+        worker_id, RETURN_GLOBAL_MODEL_ROUTE, signed_request, now + 1, 'nonce_2', body_digest)
+    assert not worker_manager.authenticate_request(
+        worker_id, RETURN_GLOBAL_MODEL_ROUTE, signed_request, now, 'nonce_3', body_digest)
+    assert worker_manager.authenticate_request(
+        worker_id, RETURN_GLOBAL_MODEL_ROUTE, signed_request, now, 'nonce_2', body_digest)
+
+    # requests outside the window are rejected
+    stale = now - 120
+    assert not worker_manager.authenticate_request(
+        worker_id, RETURN_GLOBAL_MODEL_ROUTE, sign(RETURN_GLOBAL_MODEL_ROUTE, stale, 'nonce_4', body_digest),
+        stale, 'nonce_4', body_digest)
+
+    # old nonces are forgotten once they can no longer be replayed
+    worker_manager.request_nonces[(worker_id, 'nonce_1')] = now - 121
+    worker_manager.authenticate_request(
+        worker_id, RETURN_GLOBAL_MODEL_ROUTE, sign(RETURN_GLOBAL_MODEL_ROUTE, now, 'nonce_5', body_digest),
+        now, 'nonce_5', body_digest)
+    assert list(worker_manager.request_nonces.keys()) == [(worker_id, 'nonce_2'), (worker_id, 'nonce_5')]
+
+
+def test_session_tokens():
+    worker_ids = [SigningKey.generate().verify_key.encode(encoder=HexEncoder).decode('utf-8') for _ in range(2)]
+    worker_manager = WorkerManager(True, None, load_last_session_workers=False, session_token_lifetime=60)
+    for worker_id in worker_ids:
+        worker_manager.add_worker(worker_id)
+
+    session_token, expiry = worker_manager.issue_session_token(worker_ids[0])
+    assert expiry > time.time()
+    assert worker_manager.verify_session_token(worker_ids[0], session_token)
+    assert worker_manager.workers[worker_ids[0]].last_seen is not None
+
+    # tokens are bound to the worker, the expiry and the server key
+    assert not worker_manager.verify_session_token(worker_ids[1], session_token)
+    mac = session_token.split('.')[1]
+    assert not worker_manager.verify_session_token(worker_ids[0], f"{expiry + 60}.{mac}")
+    assert not worker_manager.verify_session_token(worker_ids[0], "not a token")
+    expired = int(time.time()) - 1
+    assert not worker_manager.verify_session_token(
+        worker_ids[0], f"{expired}.{worker_manager.session_token_mac(worker_ids[0], expired)}")
+    other_manager = WorkerManager(True, None, load_last_session_workers=False, session_token_lifetime=60)
+    other_manager.add_worker(worker_ids[0])
+    assert not other_manager.verify_session_token(worker_ids[0], session_token)
+
+    # removed workers can no longer use their tokens
+    worker_manager.remove_worker(worker_ids[0])
+    assert not worker_manager.verify_session_token(worker_ids[0], session_token)
+    assert worker_manager.issue_session_token(worker_ids[0]) == (INVALID_WORKER, None)
+
+    # session tokens are disabled by default
+    worker_manager = WorkerManager(True, None, load_last_session_workers=False)
+    worker_manager.add_worker(worker_ids[1])
+    assert worker_manager.issue_session_token(worker_ids[1]) == (INVALID_WORKER, None)
+
+
+def test_verification_in_cpu_pool():
+    signing_key = SigningKey.generate()
+    worker_id = signing_key.verify_key.encode(encoder=HexEncoder).decode('utf-8')
+    worker_manager = WorkerManager(True, None, load_last_session_workers=False, cpu_pool=ThreadPool(4))
+    worker_manager.add_worker(worker_id)
+
+    # concurrent copies of a request are only accepted once, even though
+    # other requests are served while the signatures are verified.
+    body_digest = json_body_digest({WORKER_ID_KEY: worker_id})
+    now = int(time.time())
+    signed_request = signing_key.sign(
+        signed_request_message(RETURN_GLOBAL_MODEL_ROUTE, worker_id, now, 'nonce', body_digest)).hex()
+    greenlets = [gevent.spawn(worker_manager.authenticate_request, worker_id, RETURN_GLOBAL_MODEL_ROUTE,
+                              signed_request, now, 'nonce', body_digest) for _ in range(8)]
+    gevent.joinall(greenlets)
+    assert sorted(g.value for g in greenlets) == [False] * 7 + [True]
+
+    phrase = worker_manager.get_challenge_phrase(worker_id)
+    signed_phrase = signing_key.sign(phrase.encode()).hex()
+    greenlets = [gevent.spawn(worker_manager.verify_challenge, worker_id, signed_phrase) for _ in range(8)]
+    gevent.joinall(greenlets)
+    assert sorted(g.value for g in greenlets) == [False] * 7 + [True]
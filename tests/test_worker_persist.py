@@ -126,8 +126,8 @@ def test_worker_persistence():
 
     assert len(server.worker_manager.public_keys_db) == 6
 
-    for doc in server.worker_manager.public_keys_db.all():
-        assert doc[PUBLIC_KEY_STR] in public_keys
+    for key in server.worker_manager.public_keys_db.get_keys():
+        assert key in public_keys
 
     # Send updates and receive global updates for the registered workers
     # This should succeed
@@ -180,8 +180,8 @@ def test_worker_persistence():
 
     assert len(server.worker_manager.public_keys_db) == 6
     assert len(server.worker_manager.allowed_workers) == 6
-    for doc in server.worker_manager.public_keys_db.all():
-        assert doc[PUBLIC_KEY_STR] in server.worker_manager.allowed_workers
+    for key in server.worker_manager.public_keys_db.get_keys():
+        assert key in server.worker_manager.allowed_workers
 
     stoppable_server = StoppableServer(host=get_host_ip(), port=8080)
     server_gl = Greenlet.spawn(begin_server, server, stoppable_server)
@@ -198,8 +198,8 @@ def test_worker_persistence():
 
     assert len(server.worker_manager.public_keys_db) == 3
     assert len(server.worker_manager.allowed_workers) == 3
-    for doc in server.worker_manager.public_keys_db.all():
-        assert doc[PUBLIC_KEY_STR] in server.worker_manager.allowed_workers
+    for key in server.worker_manager.public_keys_db.get_keys():
+        assert key in server.worker_manager.allowed_workers
 
     stoppable_server.shutdown()
 
@@ -0,0 +1,73 @@
+"""
+Tests for the persistent stores of the workers' public keys.
+"""
+
+import os
+import tempfile
+
+from nacl.encoding import HexEncoder
+from nacl.signing import SigningKey
+
+from dc_federated.backend._worker_store import WORKER_STORES, create_worker_store
+from dc_federated.backend._worker_manager import WorkerManager
+
+
+def gen_public_key():
+    return SigningKey.generate().verify_key.encode(encoder=HexEncoder).decode('utf-8')
+
+
+def test_worker_stores():
+    for keys_db_backend in WORKER_STORES:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path_to_keys_db = os.path.join(tmp_dir, 'workers_db')
+            store = create_worker_store(keys_db_backend, path_to_keys_db)
+            assert len(store) == 0
+
+            # duplicates within and across batches are ignored
+            store.add_keys(['key_1', 'key_2', 'key_1'])
+            store.add_key('key_2')
+            store.add_key('key_3')
+            assert len(store) == 3
+            assert sorted(store.get_keys()) == ['key_1', 'key_2', 'key_3']
+
+            assert store.remove_key('key_2')
+            assert not store.remove_key('key_2')
+            assert sorted(store.get_keys()) == ['key_1', 'key_3']
+            store.close()
+
+            # the keys persist across sessions
+            store = create_worker_store(keys_db_backend, path_to_keys_db)
+            assert sorted(store.get_keys()) == ['key_1', 'key_3']
+            store.close()
+
+    try:
+        create_worker_store('unknown', 'workers_db')
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+def test_worker_manager_sqlite_store():
+    public_keys = [gen_public_key() for _ in range(4)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_to_keys_db = os.path.join(tmp_dir, 'workers_db.sqlite')
+        key_list_file = os.path.join(tmp_dir, 'worker_public_keys.txt')
+        with open(key_list_file, 'w') as f:
+            f.write(os.linesep.join(public_keys[0:2]))
+
+        worker_manager = WorkerManager(True, key_list_file, True, path_to_keys_db, 'sqlite')
+        assert len(worker_manager.public_keys_db) == 2
+        worker_manager.add_worker(public_keys[2])
+        worker_manager.add_worker(public_keys[3])
+        worker_manager.remove_worker(public_keys[0])
+        assert sorted(worker_manager.public_keys_db.get_keys()) == sorted(public_keys[1:])
+
+        # invalid keys in the database are dropped on the next startup
+        worker_manager.public_keys_db.add_key('not a valid key')
+        worker_manager.public_keys_db.close()
+
+        worker_manager = WorkerManager(True, None, True, path_to_keys_db, 'sqlite')
+        assert sorted(worker_manager.allowed_workers) == sorted(public_keys[1:])
+        assert sorted(worker_manager.public_keys_db.get_keys()) == sorted(public_keys[1:])
+        worker_manager.public_keys_db.close()